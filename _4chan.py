@@ -1,138 +1,162 @@
 import datetime
+import html
 import json
 import os
 import random
 import re
-import shutil
 import subprocess
+import threading
+import time
 
-import bs4
-import requests
 from telegram import ChatAction, Update
 from telegram.constants import PARSEMODE_MARKDOWN_V2
 from telegram.ext import CallbackContext
 from telegram.utils.helpers import escape_markdown
 
-from utils import _config, _config_list, logger
+from uploads import send_media
+from utils import (_config, _config_list, fetch_media, get_next_hour, get_random_string, logger,
+                   media_cache, Prefetched, requests_session)
 
 
 class _4chan:
-    CATALOG_URL = 'https://boards.4chan.org/%s/catalog'
+    API_URL = 'https://a.4cdn.org'
+    MEDIA_URL = 'https://i.4cdn.org/%s/%d%s'
     THREAD_URL = 'https://boards.4chan.org/%s/thread/%d'
 
     def __init__(self):
-        self.rx_catalog = re.compile(r'var catalog = (.*);var style_group = "')
         self.rx_general = re.compile(r'\/[a-z]*\/', re.I)
-
-    @staticmethod
-    def _download_file(url, name):
-        if os.path.exists(name):
-            return name
-
-        if url.startswith('//'):
-            url = 'https:' + url
-        logger.info('downloading from %s to %s', url, name)
-        with requests.get(url, stream=True) as r:
-            with open(name, 'wb') as f:
-                shutil.copyfileobj(r.raw, f)
-        logger.info('done downloading from %s', url)
-
-        return name
-
-    @staticmethod
-    def _soup_to_text(soup):
-        """turn a soup element into plain text"""
-        text = ''
-
-        if not soup:
-            return text
-
-        for element in soup.contents:
-            if isinstance(element, bs4.element.Tag) and element.name == 'br':
-                text += '\n'
-            elif element.string:
-                text += element.string
-            elif element.text:
-                text += element.text
-
-        return text
-
-    def _request_thread(self, board, thread):
-        """makes an http request to obtain a thread and parses it"""
-        url = self.THREAD_URL % (board, thread,)
-        logger.info('requesting %s ...', url)
-
-        r = requests.get(url)
-        if r.status_code != requests.codes.ok:
+        self.rx_tags = re.compile(r'<[^>]+>')
+        # board -> {'threads': ..., 'fetched_at': ..., 'etag': ..., 'last_modified': ...}
+        self.catalogs = {}
+        self.lock = threading.Lock()
+
+    def _comment_to_text(self, comment):
+        """turn the html of a post into plain text"""
+        return html.unescape(self.rx_tags.sub('', (comment or '').replace('<br>', '\n')))
+
+    def _api_url(self, path):
+        return (_config('4chan_api_url') or self.API_URL) + path
+
+    def catalog(self, board):
+        """returns all the threads in the catalog of a board. the catalog is cached
+        for a while, and then revalidated with a conditional request"""
+        with self.lock:
+            cached = self.catalogs.get(board)
+            if cached and time.monotonic() - cached['fetched_at'] < int(_config('4chan_catalog_ttl') or 300):
+                return cached['threads']
+
+            headers = {}
+            if cached and cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached and cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+            logger.info('retrieving catalog of /%s/', board)
+            r = requests_session.get(self._api_url(f'/{board}/catalog.json'), headers=headers)
+            if r.status_code == 304 and cached:
+                logger.info('catalog of /%s/ has not changed', board)
+                cached['fetched_at'] = time.monotonic()
+                return cached['threads']
+            if r.status_code != 200:
+                raise RuntimeError("couldn't request the board catalog: %d" % r.status_code)
+
+            threads = [thread for page in r.json() for thread in page['threads']]
+            self.catalogs[board] = {
+                'threads': threads,
+                'fetched_at': time.monotonic(),
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+            }
+            return threads
+
+    def _request_op(self, board, thread):
+        """returns the op of a thread, from the cached catalog if it's there"""
+        for op in self.catalog(board):
+            if op['no'] == thread:
+                return op
+        logger.info('/%s/%d is not in the catalog, requesting it', board, thread)
+        r = requests_session.get(self._api_url(f'/{board}/thread/{thread}.json'))
+        if r.status_code != 200:
             raise RuntimeError("couldn't request a thread: %d" % r.status_code)
+        return r.json()['posts'][0]
 
-        soup = bs4.BeautifulSoup(r.text, features='html.parser')
-        # find the op message container
-        soup_op = soup.find('div', class_='opContainer')
-        # inside, the metadata
-        soup_info = soup_op.find('div', class_='postInfo')
-        # and inside the metadata, the subject if any
-        subject = soup_info.find('span', class_='subject').string
-        if subject:
-            subject = str(subject)
-        # file: get info and download and store it
-        soup_file = soup_op.find('div', class_='file')
-        try:
-            image_info = ' '.join(soup_file.find('div', class_='fileText').strings)
-            image_url = soup_file.find('a', class_='fileThumb')['href']
-            image_file = self._download_file(image_url, 'image_%s_%d.%s' %
-                                             (board, thread, image_url.split('.')[-1]))
-        except AttributeError:
+    def thread_info(self, board, thread):
+        """returns info about a thread"""
+        logger.info('retrieving thread /%s/%s', board, thread)
+        op = self._request_op(board, thread)
+
+        subject = html.unescape(op['sub']) if op.get('sub') else None
+        # file: only get info, it's downloaded when the thread is prepared
+        if op.get('tim') and not op.get('filedeleted'):
+            image_info = '%s%s (%d KB, %dx%d)' % (html.unescape(op['filename']), op['ext'],
+                                                  op['fsize'] // 1024, op['w'], op['h'])
+            image_url = self.MEDIA_URL % (board, op['tim'], op['ext'])
+        else:
             image_info = '(file deleted)'
-            image_url, image_file = None, None
-        # and finally the text
-        soup_message = soup_op.find('blockquote', class_='postMessage')
-        text = self._soup_to_text(soup_message)
+            image_url = None
 
+        logger.info('done retrieving thread /%s/%s', board, thread)
         return {'url': self.THREAD_URL % (board, thread,),
                 'subject': subject,
                 'image_url': image_url,
-                'image_file': image_file,
+                'image_file': None,
+                'image_cached': False,
                 'image_info': image_info,
-                'text': text}
-
-    def thread_info(self, board, thread):
-        """returns info about a thread"""
-        logger.info('retrieving thread /%s/%s', board, thread)
-        thread_content = self._request_thread(board, thread)
-        logger.info('done retrieving thread /%s/%s', board, thread)
-        return thread_content
+                'text': self._comment_to_text(op.get('com'))}
 
     def threads_in_board(self, board):
         """returns a list of all threads in a board"""
-        logger.info('retrieving board /%s/', board)
-        r = requests.get(self.CATALOG_URL % board)
-        if r.status_code != requests.codes.ok:
-            raise RuntimeError("couldn't request the board catalog: %d" % r.status_code)
-        # extract threads from the catalog in json format
-        rx_match = self.rx_catalog.search(r.text)
-        if not rx_match:
-            raise RuntimeError("couldn't parse catalog")
         # filter undesirable threads (general threads, threads that point somewhere else...)
-        threads = [(int(x), y) for x, y in json.loads(rx_match.group(1))['threads'].items()
-                   if '&gt;&gt;' not in y['teaser'] and len(y['teaser']) < 1000 and
-                   (not y['sub'] or (y['sub'] and
-                                     'general' not in y['sub'].lower() and
-                                     'thread' not in y['sub'].lower() and
-                                     not self.rx_general.search(y['sub'])))]
+        threads = []
+        for thread in self.catalog(board):
+            text = self._comment_to_text(thread.get('com'))
+            subject = html.unescape(thread.get('sub') or '')
+            if ('>>' not in text and len(text) < 1000 and
+                    (not subject or ('general' not in subject.lower() and
+                                     'thread' not in subject.lower() and
+                                     not self.rx_general.search(subject)))):
+                threads.append(thread)
         # sort list of threads by number of replies and extract top fifth
-        sorted_threads = sorted(threads, key=lambda x: x[1]['r'], reverse=True)[:len(threads) // 5]
-        logger.info('done retrieving /%s/, %d threads matched', board, len(sorted_threads))
-        return [x for x, _ in sorted_threads]
+        sorted_threads = sorted(threads, key=lambda x: x['replies'], reverse=True)[:len(threads) // 5]
+        logger.info('/%s/: %d threads matched', board, len(sorted_threads))
+        return [x['no'] for x in sorted_threads]
+
+
+def _is_cron_hour(hour: int) -> bool:
+    return not (hour % 2 == 1 or 2 < hour < 10)
 
 
 def cron_4chan(context: CallbackContext) -> None:
     if not _config('4chan_cron_chat_id'):
         return
     hour = datetime.datetime.now().astimezone().hour
-    if hour % 2 == 1 or 2 < hour < 10:
+    if not _is_cron_hour(hour):
         return
-    post_thread(int(_config('4chan_cron_chat_id')), context)
+    chat_id = int(_config('4chan_cron_chat_id'))
+    if thread := prefetched.take():
+        try:
+            send_thread(chat_id, context, thread)
+            return
+        except:
+            logger.exception('failed to send the prefetched thread, fetching another one')
+            discard_thread(thread)
+    post_thread(chat_id, context)
+
+
+def prefetch_4chan(context: CallbackContext) -> None:
+    """runs a few minutes before cron_4chan and prepares the post in a worker, so
+    only sending it is left when the time comes"""
+    if not _config('4chan_cron_chat_id'):
+        return
+    if not _is_cron_hour(get_next_hour()):
+        return
+
+    def prefetch():
+        try:
+            prefetched.put(prepare_thread(random.choice(_config_list('4chan_boards'))))
+        except:
+            logger.exception('failed to prefetch a thread')
+
+    context.dispatcher.run_async(prefetch)
 
 
 def command_thread(update: Update, context: CallbackContext) -> None:
@@ -144,15 +168,42 @@ def command_thread(update: Update, context: CallbackContext) -> None:
         raise
 
 
+FFPROBE_CMD = "ffprobe -v error -show_entries stream=codec_type,codec_name,width,height -of json '{source}'"
+FFMPEG_CMD_REMUX = "ffmpeg -hide_banner -i '{source}' -c copy -movflags +faststart '{dest}'"
 FFMPEG_CMD = "ffmpeg -hide_banner -i '{source}' -vf 'pad=ceil(iw/2)*2:ceil(ih/2)*2' -preset veryfast '{dest}'"
+def _can_remux(file: str) -> bool:
+    """whether the streams of a file can be copied into a mp4 as they are. telegram
+    only plays h264 with aac or mp3 inline, so vp8 and vp9 webms (with vorbis or opus)
+    are always re-encoded. anything else may arrive as a document"""
+    try:
+        output = subprocess.check_output(FFPROBE_CMD.format(source=file), shell=True)
+        streams = json.loads(output)['streams']
+    except (subprocess.CalledProcessError, ValueError, KeyError):
+        return False
+    video_codecs = _config_list('media_remux_codecs') or ['h264']
+    for stream in streams:
+        if stream.get('codec_type') == 'video':
+            if (stream.get('codec_name') not in video_codecs or
+                    stream.get('width', 1) % 2 or stream.get('height', 1) % 2):
+                return False
+        elif stream.get('codec_type') == 'audio':
+            if stream.get('codec_name') not in ('aac', 'mp3'):
+                return False
+    return True
+
+
 def _webm_convert(file: str) -> str:
-    """converts a webm to a mp4 file"""
+    """converts a webm to a mp4 file. the streams are copied as they are if
+    possible, and only re-encoded if not"""
     new_file = file + '.mp4'
-    if os.path.exists(new_file):
-        return new_file
-
-    logger.info('converting %s to %s', file, new_file)
-    subprocess.call(FFMPEG_CMD.format(source=file, dest=new_file), shell=True)
+    if _can_remux(file):
+        logger.info('remuxing %s to %s', file, new_file)
+        subprocess.call(FFMPEG_CMD_REMUX.format(source=file, dest=new_file), shell=True)
+    if not os.path.exists(new_file) or os.path.getsize(new_file) == 0:
+        if os.path.exists(new_file):
+            os.remove(new_file)
+        logger.info('converting %s to %s', file, new_file)
+        subprocess.call(FFMPEG_CMD.format(source=file, dest=new_file), shell=True)
     if not os.path.exists(new_file) or os.path.getsize(new_file) == 0:
         raise RuntimeError("for some reason, %s wasn't created" % new_file)
 
@@ -161,16 +212,32 @@ def _webm_convert(file: str) -> str:
     return new_file
 
 
+def _fetch_thread_media(thread: dict) -> None:
+    """downloads the media of a thread. webms are converted once and then kept in
+    the media cache, since the same thread is often picked again"""
+    url = thread['image_url']
+    if url.endswith('.webm'):
+        if cached := media_cache.get(url, 'mp4'):
+            thread['image_file'], thread['image_cached'] = cached, True
+            return
+        file = fetch_media(url, f'image_{get_random_string(12)}.webm', content_types=('video/',))
+        thread['image_file'] = media_cache.put(url, 'mp4', _webm_convert(file))
+        thread['image_cached'] = True
+    else:
+        extension = os.path.splitext(url)[1]
+        thread['image_file'] = fetch_media(url, f'image_{get_random_string(12)}{extension}',
+                                           content_types=('image/', 'video/'))
+
+
 _4c = _4chan()
 RX_GREENTEXT = re.compile(r'^(\\>.*)$', re.MULTILINE)
-def post_thread(chat_id: int, context: CallbackContext, args: list = None) -> None:
+def prepare_thread(board: str) -> dict:
+    """picks a thread, downloads and converts its media and formats its text, so
+    all that's left is sending it"""
     def _e(text):
         """escapes text with markdown v2 syntax"""
         return escape_markdown(text, 2)
 
-    context.bot_data['actions'].append(chat_id, ChatAction.TYPING)
-
-    board = args[0] if args else random.choice(_config_list('4chan_boards'))
     threads = _4c.threads_in_board(board)
     thread = _4c.thread_info(board, random.choice(threads))
 
@@ -189,22 +256,44 @@ def post_thread(chat_id: int, context: CallbackContext, args: list = None) -> No
     else:
         text = thread_text
 
-    text += '\n\n' + _e(thread['url'])
+    thread['markdown'] = text + '\n\n' + _e(thread['url'])
 
     if thread['image_url']:
-        if thread['image_url'].endswith('.webm'):
-            thread['image_file'] = _webm_convert(thread['image_file'])
+        _fetch_thread_media(thread)
         if thread['image_url'].endswith('.gif') or thread['image_url'].endswith('.webm'):
-            fun = context.bot.send_video
+            thread['image_kind'] = 'video'
         else:
-            fun = context.bot.send_photo
-        with open(thread['image_file'], 'rb') as fp:
-            fun(chat_id, fp)
+            thread['image_kind'] = 'photo'
 
-    os.remove(thread['image_file'])
+    return thread
 
-    context.bot.send_message(chat_id, '%s' % text,
+
+def discard_thread(thread: dict) -> None:
+    """removes the media of a thread that was prepared but won't be sent"""
+    if (thread['image_file'] and not thread['image_cached'] and
+            os.path.exists(thread['image_file'])):
+        os.remove(thread['image_file'])
+
+
+prefetched = Prefetched(discard_thread)
+
+
+def send_thread(chat_id: int, context: CallbackContext, thread: dict) -> None:
+    if thread['image_file']:
+        fun = getattr(context.bot, f'send_{thread["image_kind"]}')
+        with open(thread['image_file'], 'rb') as fp:
+            send_media(fun, chat_id, fp, key=thread['image_url'])
+        discard_thread(thread)
+
+    context.bot.send_message(chat_id, '%s' % thread['markdown'],
                              parse_mode=PARSEMODE_MARKDOWN_V2,
                              disable_web_page_preview=True)
 
-    context.bot_data['actions'].remove(chat_id, ChatAction.TYPING)
+
+def post_thread(chat_id: int, context: CallbackContext, args: list = None) -> None:
+    context.bot_data['actions'].append(chat_id, ChatAction.TYPING)
+    try:
+        board = args[0] if args else random.choice(_config_list('4chan_boards'))
+        send_thread(chat_id, context, prepare_thread(board))
+    finally:
+        context.bot_data['actions'].remove(chat_id, ChatAction.TYPING)
@@ -60,6 +60,15 @@ def _video_to_voice(filename: str) -> str:
     return filename + '.ogg'
 
 
+def get_attachment_unique_id(message) -> str:
+    """returns the file_unique_id of the attachment _download_anything would download,
+        which stays the same for the same file even if it is sent again"""
+    for attr in ('photo', 'animation', 'video', 'sticker', 'voice', 'video_note', 'audio'):
+        if obj := getattr(message, attr):
+            return (obj[-1] if attr == 'photo' else obj).file_unique_id
+    return None
+
+
 def get_attachment_type(message):
     if getattr(message, 'photo'):
         return AttachmentType.PHOTO
@@ -0,0 +1,90 @@
+"""times /fortune with the fortune index against reading and splitting the whole
+database on every command, like it used to be done. it uses a made up database
+unless one is given. run it from the root of the repo:
+python benchmarks/fortune.py [fortunes or path to a database] [searches]"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text import clean_fortune, FortuneStore
+
+WORDS = ('ola que ase kease troll fortuna pan caracola calor nada ver internet foro '
+         'hilo mensaje respuesta usuario moderador baneo meme imagen video').split()
+
+
+def make_database(filename: str, count: int) -> None:
+    random.seed(count)
+    with open(filename, 'wt', encoding='utf8') as fp:
+        for _ in range(count):
+            lines = [' '.join(random.choices(WORDS, k=random.randint(3, 12)))
+                     for _ in range(random.randint(1, 4))]
+            fp.write('\n'.join(lines) + '\n%\n')
+
+
+def all_fortunes(filename: str) -> list[str]:
+    with open(filename, 'rt', encoding='utf8') as fp:
+        return fp.read().split('\n%\n')[:-1]
+
+
+def random_like_before(filename: str) -> str:
+    return clean_fortune(random.choice(all_fortunes(filename)))
+
+
+def search_like_before(filename: str, criteria: str, max_results: int) -> list[str]:
+    results = []
+    for fortune in all_fortunes(filename):
+        clean = clean_fortune(fortune)
+        if criteria.lower() in clean.lower():
+            results.append(clean)
+            if len(results) >= max_results:
+                break
+    return results
+
+
+def best_of(fun, *args, runs=5) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fun(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def repeat(fun, times: int, *args) -> None:
+    for _ in range(times):
+        fun(*args)
+
+
+def run(filename: str, searches: int) -> None:
+    store = FortuneStore(filename)
+    start = time.perf_counter()
+    store.refresh()
+    build = time.perf_counter() - start
+    print(f'{len(store.fortunes)} fortunes, indexed in {build * 1000:.1f}ms')
+
+    before = best_of(repeat, random_like_before, searches, filename)
+    after = best_of(repeat, store.random, searches)
+    print(f'{searches} random fortunes: before {before * 1000:.1f}ms, indexed {after * 1000:.1f}ms '
+          f'({before / after:.1f}x)')
+    # a common word, a rare prefix and one that doesn't match anything
+    for criteria in ('troll', 'mod', 'zzz'):
+        before = best_of(repeat, search_like_before, searches, filename, criteria, 5)
+        after = best_of(repeat, store.search, searches, criteria, 5)
+        print(f'{searches} searches for {criteria!r}: before {before * 1000:.1f}ms, '
+              f'indexed {after * 1000:.1f}ms ({before / after:.1f}x)')
+
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else '20000'
+    searches = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    if os.path.exists(source):
+        run(source, searches)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'trolldb.txt')
+            make_database(filename, int(source))
+            run(filename, searches)
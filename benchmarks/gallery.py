@@ -0,0 +1,59 @@
+"""times create_gallery against decoding the tiles one by one, like it used to be
+done. run it from the root of the repo: python benchmarks/gallery.py [tiles] [size]"""
+from math import ceil, sqrt
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wand.image import Image
+
+from utils import create_gallery
+
+
+def make_tiles(count: int, size: int) -> list[bytes]:
+    tiles = []
+    for i in range(count):
+        # some tiles are smaller so they have to be fitted
+        side = size if i % 3 else size // 2
+        with Image(width=side, height=side, pseudo='plasma:') as image:
+            tiles.append(image.make_blob(format='jpeg'))
+    return tiles
+
+
+def serial_gallery(blobs: list[bytes]) -> bytes:
+    images = [Image(blob=blob) for blob in blobs]
+    try:
+        size = max(max(image.width, image.height) for image in images)
+        for image in images:
+            if max(image.width, image.height) != size:
+                image.transform(resize=f'{size}x{size}')
+        side = ceil(sqrt(len(images)))
+        with Image(width=size * side, height=size * side) as canvas:
+            for i, image in enumerate(images):
+                canvas.composite(image, left=i % side * size + (size - image.width) // 2,
+                                 top=i // side * size + (size - image.height) // 2)
+            return canvas.make_blob(format='jpeg')
+    finally:
+        for image in images:
+            image.close()
+
+
+def best_of(fun, *args, runs=5) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fun(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 9
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    blobs = make_tiles(count, size)
+    serial = best_of(serial_gallery, blobs)
+    parallel = best_of(create_gallery, blobs)
+    print(f'{count} tiles of {size}px: serial {serial:.3f}s, create_gallery {parallel:.3f}s '
+          f'({serial / parallel:.2f}x)')
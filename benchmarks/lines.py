@@ -0,0 +1,49 @@
+"""times picking random lines from a file with get_random_line against reading
+the whole file with readlines() every time, like it used to be done.
+run it from the root of the repo: python benchmarks/lines.py [lines] [picks]"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import get_random_line, MmapIndex
+
+
+def readlines_random_line(filename: str) -> str:
+    with open(filename, 'rt', encoding='utf8') as fp:
+        return random.choice(fp.readlines())
+
+
+def pick(fun, filename: str, count: int) -> None:
+    for _ in range(count):
+        fun(filename)
+
+
+def best_of(fun, *args, runs=5) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fun(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    picks = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'lines.txt')
+        with open(filename, 'wt', encoding='utf8') as fp:
+            for i in range(count):
+                fp.write(f'line {i} ' + 'x' * random.randint(10, 120) + '\n')
+        build = best_of(lambda: MmapIndex(filename).refresh())
+        # the first call builds the index, every other one just checks the mtime
+        get_random_line(filename)
+        indexed = best_of(pick, get_random_line, filename, picks)
+        serial = best_of(pick, readlines_random_line, filename, picks)
+    print(f'{count} lines, indexed in {build * 1000:.1f}ms')
+    print(f'{picks} random lines: readlines {serial * 1000:.1f}ms, index {indexed * 1000:.1f}ms '
+          f'({serial / indexed:.1f}x)')
@@ -0,0 +1,111 @@
+"""times polling nitter feeds from local stand-in instances, one by one like it
+used to be done against FeedPoller, first with every feed new and then with none
+changed. one of the instances is slow and another one is down.
+run it from the root of the repo: python benchmarks/nitter.py [feeds] [delay]"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import feedparser
+
+from twitter import FeedPoller
+from utils import requests_session
+
+ITEM = '''<item><title>tweet {id}</title><dc:creator>@{term}</dc:creator>
+<guid>http://nitter.invalid/{term}/status/{id}#m</guid></item>'''
+FEED = '''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/"><channel><title>{term}</title>
+{items}</channel></rss>'''
+
+
+def make_feed(term: str, items: int = 20) -> bytes:
+    # terms are user<n>, and every one has its own tweets
+    base = 1700000000000000000 + int(term[4:]) * 1000
+    return FEED.format(term=term, items='\n'.join(ITEM.format(term=term, id=base + i)
+                                                  for i in range(items))).encode()
+
+
+def start_instance(delay: float, status: int = 200) -> tuple[str, dict]:
+    """serves /<term>/with_replies/rss after delay seconds, with etags. returns
+    the host and a dict that counts the requests by status"""
+    counts = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            term = self.path.split('/')[1]
+            etag = f'"{term}"'
+            code = status
+            if code == 200 and self.headers.get('If-None-Match') == etag:
+                code = 304
+            counts[code] = counts.get(code, 0) + 1
+            self.send_response(code)
+            if code == 200:
+                body = make_feed(term)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Type', 'application/rss+xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'127.0.0.1:{server.server_address[1]}', counts
+
+
+class LocalPoller(FeedPoller):
+    """a FeedPoller for the stand-in instances, which only speak http"""
+    def __init__(self, instances: list):
+        super().__init__()
+        self.instances.instances = lambda: instances
+
+    @staticmethod
+    def _feed_url(instance: str, term: str) -> str:
+        return f'http://{instance}/{term}/with_replies/rss'
+
+
+def one_by_one(instance: str, terms: list) -> int:
+    entries = 0
+    for term in terms:
+        r = requests_session.get(f'http://{instance}/{term}/with_replies/rss')
+        entries += len(feedparser.parse(r.content).entries)
+    return entries
+
+
+def timed(fun, *args):
+    start = time.perf_counter()
+    result = fun(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else .05
+    fast, fast_counts = start_instance(delay)
+    slow, slow_counts = start_instance(delay * 10)
+    down, down_counts = start_instance(0, 503)
+    terms = [f'user{i}' for i in range(count)]
+    feeds = [(term, [1]) for term in terms]
+
+    serial, entries = timed(one_by_one, fast, terms)
+    print(f'{count} feeds, {delay * 1000:.0f}ms per request: one by one {serial:.2f}s, {entries} entries')
+
+    poller = LocalPoller([down, slow, fast])
+    cold, entries = timed(poller.poll, feeds)
+    print(f'FeedPoller, every feed new: {cold:.2f}s ({serial / cold:.2f}x), {len(entries)} entries')
+    for term in terms:
+        poller.feed(term)['next_poll'] = 0
+    warm, entries = timed(poller.poll, feeds)
+    print(f'FeedPoller, nothing changed: {warm:.2f}s ({serial / warm:.2f}x), {len(entries)} entries')
+    print(f'requests: fast {fast_counts}, slow {slow_counts}, down {down_counts}')
+    print(poller.instances.dump())
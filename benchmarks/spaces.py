@@ -0,0 +1,117 @@
+"""times running many Hugging Face jobs at once against a local stand-in for the
+queue of a Gradio space. the jobs run on the shared loop, and then each one blocks
+a worker thread of a small pool until it's done, like it used to be done.
+run it from the root of the repo: python benchmarks/spaces.py [jobs] [seconds per job]"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+import json
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import websockets
+
+from huggingface import HuggingFaceFormat, HuggingFaceWS, loop
+
+# how many jobs the stand-in space runs at the same time, like the
+# concurrency_count of a gradio queue
+SPACE_CONCURRENCY = 8
+# the workers of the dispatcher, which used to run a job each
+WORKERS = 4
+
+
+class Space:
+    """speaks the queue/join protocol: asks for the hash and the data, reports the
+    place in the queue and answers after job_time seconds"""
+    def __init__(self, job_time: float):
+        self.job_time = job_time
+        self.slots = None
+        self.waiting = 0
+        self.completed = 0
+
+    async def handler(self, ws, *_):
+        await ws.send(json.dumps({'msg': 'send_hash'}))
+        session_hash = json.loads(await ws.recv())['session_hash']
+        self.waiting += 1
+        try:
+            await ws.send(json.dumps({'msg': 'estimation', 'rank': self.waiting,
+                                      'rank_eta': self.waiting * self.job_time / SPACE_CONCURRENCY}))
+            async with self.slots:
+                await ws.send(json.dumps({'msg': 'send_data'}))
+                data = json.loads(await ws.recv())['data']
+                await ws.send(json.dumps({'msg': 'process_starts'}))
+                await asyncio.sleep(self.job_time)
+        finally:
+            self.waiting -= 1
+        self.completed += 1
+        await ws.send(json.dumps({'msg': 'process_completed', 'success': True,
+                                  'output': {'data': [f'{data[0]} done for {session_hash}']}}))
+        await ws.wait_closed()
+
+    def start(self) -> int:
+        """serves in a loop of its own, so the jobs can't be helped by sharing it.
+        returns the port"""
+        started = threading.Event()
+        space_loop = asyncio.new_event_loop()
+
+        async def serve():
+            self.slots = asyncio.Semaphore(SPACE_CONCURRENCY)
+            server = await websockets.serve(self.handler, '127.0.0.1', 0)
+            self.port = server.sockets[0].getsockname()[1]
+            started.set()
+            await asyncio.Future()
+
+        threading.Thread(target=space_loop.run_until_complete, args=(serve(),), daemon=True).start()
+        started.wait()
+        return self.port
+
+
+def make_job(port: int, i: int) -> HuggingFaceWS:
+    job = HuggingFaceWS(SimpleNamespace(append_edit=lambda *_: None), None, {
+        'name': f'job {i}',
+        'space': 'stand-in',
+        'in_format': [f'prompt {i}'],
+        'out_format': HuggingFaceFormat.TEXT,
+        'times': 1,
+        'quiet_progress': True,
+    })
+    job.QUEUE_URL = f'ws://127.0.0.1:{port}/{{space}}/queue/join'
+    job.ORIGIN = f'http://127.0.0.1:{port}'
+    return job
+
+
+def on_the_loop(port: int, count: int) -> list:
+    futures = [asyncio.run_coroutine_threadsafe(make_job(port, i).run(), loop) for i in range(count)]
+    return [future.result() for future in futures]
+
+
+def on_workers(port: int, count: int) -> list:
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        futures = [executor.submit(asyncio.run, make_job(port, i).run()) for i in range(count)]
+        wait(futures)
+    return [future.result() for future in futures]
+
+
+def timed(fun, *args) -> float:
+    start = time.perf_counter()
+    results = fun(*args)
+    elapsed = time.perf_counter() - start
+    assert all(results), 'some jobs failed'
+    return elapsed
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    job_time = float(sys.argv[2]) if len(sys.argv) > 2 else .5
+    space = Space(job_time)
+    port = space.start()
+    workers = timed(on_workers, port, count)
+    shared = timed(on_the_loop, port, count)
+    print(f'{count} jobs of {job_time}s, the space runs {SPACE_CONCURRENCY} at a time '
+          f'(at best {count * job_time / SPACE_CONCURRENCY:.1f}s)')
+    print(f'a worker each ({WORKERS} workers): {workers:.2f}s, {count / workers:.1f} jobs/s')
+    print(f'shared loop: {shared:.2f}s, {count / shared:.1f} jobs/s ({workers / shared:.2f}x)')
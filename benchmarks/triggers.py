@@ -0,0 +1,96 @@
+"""times matching messages against a large triggers.txt with the single
+expression against trying every trigger one by one, like it used to be done.
+run it from the root of the repo: python benchmarks/triggers.py [triggers] [messages]"""
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from triggers import Triggers
+
+
+def make_triggers(count: int) -> list[tuple[str, str]]:
+    random.seed(count)
+    words = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(4, 9)))
+             for _ in range(count)]
+    lines = []
+    for i, word in enumerate(words):
+        if i % 3 == 0:
+            lines.append((word, f'exact {i}'))
+        elif i % 3 == 1:
+            lines.append((f'in:{word}', f'substring {i}'))
+        elif i % 30 == 2:
+            # a few have backreferences and are matched on their own
+            lines.append((f're:({word[0]}){word[1:]}\\1', f'backreference {i}'))
+        else:
+            lines.append((f're:\\b{word}s?\\b', f'regex {i}'))
+    return lines
+
+
+def make_messages(lines: list[tuple[str, str]], count: int) -> list[str]:
+    messages = []
+    for i in range(count):
+        words = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz ', k=60))
+        if i % 10 == 0:
+            # most messages don't trigger anything
+            words += ' ' + random.choice(lines)[0].split(':', 1)[-1]
+        messages.append(words)
+    return messages
+
+
+def one_by_one(lines: list[tuple[str, str]]):
+    exact, compiled = {}, []
+    for trigger, answer in lines:
+        if trigger.startswith('in:'):
+            compiled.append((re.compile(re.escape(trigger[3:]), re.I), answer))
+        elif trigger.startswith('re:'):
+            compiled.append((re.compile(trigger[3:], re.I), answer))
+        else:
+            exact.setdefault(trigger.casefold(), answer)
+
+    def match(text):
+        if (answer := exact.get(text.casefold())) is not None:
+            return answer
+        for rx, answer in compiled:
+            if rx.search(text):
+                return answer
+        return None
+    return match
+
+
+def best_of(fun, *args, runs=5) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fun(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def match_all(match, messages):
+    for message in messages:
+        match(message)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    lines = make_triggers(count)
+    messages = make_messages(lines, message_count)
+    with tempfile.TemporaryDirectory() as tmp:
+        triggers = Triggers()
+        triggers.FILENAME = os.path.join(tmp, 'triggers.txt')
+        with open(triggers.FILENAME, 'wt', encoding='utf8') as fp:
+            fp.writelines(f'{trigger}\t{answer}\n' for trigger, answer in lines)
+        start = time.perf_counter()
+        triggers.refresh()
+        load = time.perf_counter() - start
+        combined = best_of(match_all, triggers.match, messages)
+    serial = best_of(match_all, one_by_one(lines), messages)
+    print(f'{count} triggers, loaded in {load:.3f}s, {len(triggers.separate)} matched on their own')
+    print(f'{message_count} messages: one by one {serial:.3f}s, combined {combined:.3f}s '
+          f'({serial / combined:.2f}x)')
@@ -1,7 +1,6 @@
 import datetime
 from glob import glob
 import html
-from inspect import getdoc
 import os
 import signal
 import socket
@@ -10,27 +9,32 @@ from bs4 import BeautifulSoup
 import requests
 from telegram import Bot, Update
 from telegram.constants import MAX_MESSAGE_LENGTH, PARSEMODE_HTML
-from telegram.ext import (CallbackContext, CommandHandler, DispatcherHandlerStop,
-                          Filters, MessageHandler, TypeHandler, Updater)
+from telegram.ext import (CallbackContext, DispatcherHandlerStop, Filters, MessageHandler,
+                          TypeHandler, Updater)
 from telegram.utils.request import Request
 
-from _4chan import cron_4chan, command_thread
+from _4chan import cron_4chan, command_thread, prefetch_4chan
 from calc import command_calc
+from chatbot_state import ChatbotState
+from commands import CommandRouter
 from craiyon import command_dalle, command_craiyon
-from distort import (command_photo, command_distort, command_distort_caption,
-                     command_invert, command_voice, command_wtf)
+from distort import command_photo, command_distort, command_invert, command_voice, command_wtf, distort_cost
 from hf_spaces import (command_gfpgan, command_caption,
                        command_anime, command_clip, command_chatbot_start,
                        command_chatbot_check, command_sd)
+from huggingface import space_router
 from message_history import MessageHistory
-from queues import Actions, Edits
+from queues import Actions, Edits, Relays
 from relay import (command_relay_chat_photo, command_relay_text, command_relay_photo,
-                   cron_delete)
+                   cron_delete, queued)
+from scheduler import controller, dump as dump_pools, fair_pooled, pooled
 from sound import command_sound, command_sound_list
-from soyjak import command_soyjak, cron_soyjak
+from soyjak import command_soyjak, cron_soyjak, cron_soyjak_pool, pool as soyjak_pool, prefetch_soyjak
 from text import command_fortune, command_imp, command_haiku, command_tip, command_oiga
 from translate import command_translate
-from twitter import command_twitter, cron_twitter
+from triggers import triggers
+from twitter import command_twitter, cron_twitter, SeenTweets
+from uploads import file_ids
 from utils import (_config, _config_list, clean_up, ellipsis,
                    get_command_args, get_relays, logger, is_admin,
                    send_admin_message, MyPrettyPrinter, get_url)
@@ -61,12 +65,10 @@ def command_restart(update: Update, _: CallbackContext) -> None:
 def command_debug(update: Update, context: CallbackContext) -> None:
     """replies with some debug info"""
     if is_admin(update.message.from_user.id):
-        update.message.reply_text(ellipsis(f'{actions.dump()}\n{edits.dump()}', MAX_MESSAGE_LENGTH))
-        if len(context.bot_data['chatbot_state']):
-            chats = ', '.join((f'{chat_id}#{len(lines["history"])}' for chat_id, lines in context.bot_data['chatbot_state'].items()))
-            update.message.reply_text(ellipsis(f'There is chatbot state for the following chats: {chats}', MAX_MESSAGE_LENGTH))
-        else:
-            update.message.reply_text('There is no chatbot state saved for any chats.')
+        update.message.reply_text(ellipsis(f'{actions.dump()}\n{edits.dump()}\n{relays.dump()}\n{dump_pools()}\n{space_router.dump()}\n'
+                                           f'{soyjak_pool.dump()}\n{file_ids.dump()}',
+                                           MAX_MESSAGE_LENGTH))
+        update.message.reply_text(ellipsis(context.bot_data['chatbot_state'].dump(), MAX_MESSAGE_LENGTH))
     else:
         update.message.reply_animation(_config('error_animation'))
 
@@ -128,12 +130,9 @@ def command_trigger(update: Update, _: CallbackContext) -> None:
         return
     if update.message.chat.id in _config_list('muted_groups', int):
         return
-    with open('triggers.txt', 'rt', encoding='utf8') as fp:
-        triggers = [x.split('\t') for x in fp.readlines()]
-    for trigger, answer in triggers:
-        if update.message.text.lower() == trigger.lower():
-            update.message.reply_text(answer, quote=False)
-            raise DispatcherHandlerStop()
+    if (answer := triggers.match(update.message.text)) is not None:
+        update.message.reply_text(answer, quote=False)
+        raise DispatcherHandlerStop()
 
 
 def command_send(update: Update, context: CallbackContext) -> None:
@@ -299,13 +298,7 @@ def command_ip(update: Update, _: CallbackContext) -> None:
 
 def command_help(update: Update, _: CallbackContext) -> None:
     """returns a list of all available commands"""
-    commands = []
-    for _, handlers in dispatcher.handlers.items():
-        for handler in handlers:
-            if isinstance(handler, CommandHandler):
-                doc = getdoc(handler.callback).replace('\n', ' ')
-                slashes = ' '.join(['/' + x for x in handler.command])
-                commands.append(f'<strong>{slashes}</strong> - {doc}')
+    commands = router.help()
     message = ('\n'.join(commands) +
                '\n\nUse the <b>/contact</b> command to contact the admin(s) of the bot.')
     update.message.reply_text(message, parse_mode=PARSEMODE_HTML)
@@ -350,9 +343,11 @@ if __name__ == '__main__':
 
     message_history = MessageHistory()
     actions_cron_interval = int(_config('actions_cron_interval'))
-    actions = Actions(bot, updater.dispatcher.job_queue, actions_cron_interval)
+    actions = Actions(bot, actions_cron_interval)
     edits_cron_interval = int(_config('edits_cron_interval'))
     edits = Edits(bot, updater.dispatcher.job_queue, edits_cron_interval)
+    relays = Relays(get_relays().keys(), int(_config('relay_max_workers') or 4),
+                    int(_config('relay_max_queued') or 1000))
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
@@ -360,22 +355,24 @@ if __name__ == '__main__':
         'message_history': message_history,
         'actions': actions,
         'edits': edits,
+        'relays': relays,
         'me': bot.get_me(),
-        'seen_twitter_ids': None,
-        'chatbot_state': {},
+        'seen_twitter_ids': SeenTweets(),
+        'chatbot_state': ChatbotState(),
     })
 
     logger.info('Adding handlers...')
 
-    # relays
+    # relays. these are not async: they only queue the update in the relay
+    # executor, which keeps the order of every chat and runs chats in parallel
     sources = get_relays().keys()
     dispatcher.add_handler(MessageHandler(Filters.chat(sources) & Filters.text & ~Filters.command & Filters.update.message,
-                                          command_relay_text, run_async=True), group=-20)
+                                          queued(command_relay_text)), group=-20)
     dispatcher.add_handler(MessageHandler(Filters.chat(sources) & (Filters.photo | Filters.sticker) & Filters.update.message,
-                                          command_relay_photo, run_async=True), group=-20)
+                                          queued(command_relay_photo)), group=-20)
     dispatcher.add_handler(MessageHandler(Filters.chat(sources) & (Filters.status_update.new_chat_photo |
                                                                    Filters.status_update.delete_chat_photo),
-                                          command_relay_chat_photo, run_async=True), group=-20)
+                                          queued(command_relay_chat_photo)), group=-20)
 
     # banned users and muted groups
     dispatcher.add_handler(TypeHandler(Update, callback_all), group=-10)
@@ -383,63 +380,66 @@ if __name__ == '__main__':
     # automated responses
     dispatcher.add_handler(MessageHandler(Filters.chat(sources) & Filters.text, command_trigger), group=30)
 
-    # commands
-    dispatcher.add_handler(CommandHandler('help', command_help), group=40)
-    dispatcher.add_handler(CommandHandler('start', command_fortune), group=40)
-    dispatcher.add_handler(CommandHandler('fortune', command_fortune), group=40)
-    dispatcher.add_handler(CommandHandler('tip', command_tip), group=40)
-    dispatcher.add_handler(CommandHandler('oiga', command_oiga), group=40)
-    # this one needs to be async because we call an external program and we wait for it to die.
-    dispatcher.add_handler(CommandHandler('calc', command_calc, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('normalize', command_normalize), group=40)
-    dispatcher.add_handler(CommandHandler('restart', command_restart), group=40)
-    dispatcher.add_handler(CommandHandler('debug', command_debug), group=40)
-    dispatcher.add_handler(CommandHandler('flush', command_flush), group=40)
-    dispatcher.add_handler(CommandHandler('info', command_info), group=40)
-    dispatcher.add_handler(CommandHandler('text', command_text), group=40)
-    dispatcher.add_handler(CommandHandler('send', command_send), group=40)
-    dispatcher.add_handler(CommandHandler('sound', command_sound_list), group=40)
-    dispatcher.add_handler(CommandHandler('load', command_load), group=40)
-    dispatcher.add_handler(CommandHandler('config', command_config), group=40)
-    dispatcher.add_handler(CommandHandler('haiku', command_haiku), group=40)
-    dispatcher.add_handler(CommandHandler('imp', command_imp), group=40)
-    dispatcher.add_handler(CommandHandler('leave', command_leave), group=40)
-    dispatcher.add_handler(CommandHandler('strip', command_strip), group=40)
-    dispatcher.add_handler(CommandHandler('contact', command_contact), group=40)
-    dispatcher.add_handler(CommandHandler('twitter', command_twitter), group=40)
-    dispatcher.add_handler(CommandHandler('thread', command_thread, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler(['clear', 'clean'], command_clear, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('translate', command_translate, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler(['distort', 'scramble'], command_distort, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('voice', command_voice, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('invert', command_invert, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('photo', command_photo, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('dalle', command_dalle, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('gfpgan', command_gfpgan, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('ip', command_ip, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('soyjak', command_soyjak, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('caption', command_caption, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('anime', command_anime, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('wtf', command_wtf, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('clip', command_clip, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('chiste', command_chiste, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler(['chatbot', 'falcon'], command_chatbot_start, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('craiyon', command_craiyon, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('sd', command_sd, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('ai', command_craiyon, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler('ai', command_sd, run_async=True), group=41)
+    # commands. they are all looked up by a single handler
+    router = CommandRouter()
+    router.add('help', command_help)
+    router.add('start', command_fortune)
+    router.add('fortune', command_fortune, description='🥠')
+    router.add('tip', command_tip)
+    router.add('oiga', command_oiga)
+    router.add('calc', pooled('cpu', command_calc), description='🧮')
+    router.add('normalize', command_normalize)
+    router.add('restart', command_restart)
+    router.add('debug', command_debug)
+    router.add('flush', command_flush)
+    router.add('info', command_info)
+    router.add('text', command_text)
+    router.add('send', command_send)
+    router.add('sound', command_sound_list)
+    router.add('load', command_load)
+    router.add('config', command_config)
+    router.add('haiku', command_haiku)
+    router.add('imp', command_imp, description='😈')
+    router.add('leave', command_leave)
+    router.add('strip', command_strip)
+    router.add('contact', command_contact)
+    router.add('twitter', command_twitter)
+    router.add('thread', pooled('network', command_thread), description='🍀')
+    router.add(['clear', 'clean'], pooled('subprocess', command_clear))
+    router.add('translate', pooled('network', command_translate), description='㊙️')
+    # CommandHandlers didn't work on captions, so this one is also run for photos with
+    # the command in the caption
+    router.add(['distort', 'scramble'], fair_pooled('distort', 'cpu', command_distort, distort_cost),
+               captions=True, description='🔨')
+    router.add('voice', pooled('subprocess', command_voice))
+    router.add('invert', pooled('cpu', command_invert))
+    router.add('photo', pooled('cpu', command_photo))
+    router.add('dalle', pooled('network', command_dalle))
+    router.add('gfpgan', pooled('network', command_gfpgan), description='📈')
+    router.add('ip', pooled('network', command_ip))
+    router.add('soyjak', pooled('network', command_soyjak), description='🥛')
+    router.add('caption', pooled('network', command_caption), description='🔤')
+    router.add('anime', pooled('network', command_anime), description='🌸')
+    router.add('wtf', pooled('subprocess', command_wtf), description='🤔')
+    router.add('clip', pooled('network', command_clip))
+    router.add('chiste', pooled('network', command_chiste), description='😂')
+    router.add(['chatbot', 'falcon'], pooled('network', command_chatbot_start), description='🤖')
+    router.add('craiyon', pooled('network', command_craiyon), description='🎨')
+    router.add('sd', pooled('network', command_sd), description='🖼️')
+    router.add('ai', pooled('network', command_craiyon))
+    router.add('ai', pooled('network', command_sd))
+    router.add([x.replace('sound/', '') for x in glob('sound/*')], pooled('subprocess', command_sound))
+    dispatcher.add_handler(router, group=40)
+
+    # this runs before the commands so a photo with a command in the caption still
+    # gets its automatic caption
     dispatcher.add_handler(MessageHandler(Filters.photo & ~Filters.command & Filters.chat_type.groups & Filters.chat(_config_list('auto_captions', int)),
-                                          command_caption, run_async=True), group=40)
-    dispatcher.add_handler(CommandHandler([x.replace('sound/', '') for x in glob('sound/*')], command_sound, run_async=True), group=40)
+                                          pooled('network', command_caption)), group=39)
 
     # responses in private
-    dispatcher.add_handler(MessageHandler(~Filters.command & Filters.chat_type.private, command_distort, run_async=True), group=40)
+    dispatcher.add_handler(MessageHandler(~Filters.command & Filters.chat_type.private,
+                                          fair_pooled('distort', 'cpu', command_distort, distort_cost)), group=40)
     dispatcher.add_handler(MessageHandler(Filters.chat_type.private, command_unhandled, run_async=True), group=40)
-    # CommandHandlers don't work on captions, so all photos with a caption are sent to a
-    # fun that will check for the command and then run command_distort if necessary
-    dispatcher.add_handler(MessageHandler(Filters.caption & Filters.chat_type.group,
-                                          command_distort_caption, run_async=True), group=41)
-
     # this one checks all messages to see if they are chatbot conversations
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command & Filters.update.message & (Filters.chat_type.private | Filters.reply),
                                           command_chatbot_check, run_async=True), group=42)
@@ -450,8 +450,6 @@ if __name__ == '__main__':
 
     dispatcher.job_queue.run_repeating(cron_twitter, interval=60, first=1)
 
-    if actions_cron_interval > 0:
-        dispatcher.job_queue.run_repeating(actions.cron, interval=actions_cron_interval, name='actions').enabled = False
     if edits_cron_interval > 0:
         dispatcher.job_queue.run_repeating(edits.cron, interval=edits_cron_interval, name='edits').enabled = False
 
@@ -459,26 +457,21 @@ if __name__ == '__main__':
     first_cron = first_cron.replace(minute=0, second=0, microsecond=0)
     dispatcher.job_queue.run_repeating(cron_4chan, first=first_cron, interval=60 * 60)
     dispatcher.job_queue.run_repeating(cron_soyjak, first=first_cron, interval=60 * 60)
+    # scheduled posts are prepared a few minutes early so only sending them is left
+    first_prefetch = first_cron - datetime.timedelta(minutes=int(_config('prefetch_minutes') or 5))
+    if first_prefetch < datetime.datetime.now().astimezone():
+        first_prefetch += datetime.timedelta(hours=1)
+    dispatcher.job_queue.run_repeating(prefetch_4chan, first=first_prefetch, interval=60 * 60)
+    dispatcher.job_queue.run_repeating(prefetch_soyjak, first=first_prefetch, interval=60 * 60)
+    dispatcher.job_queue.run_repeating(cron_soyjak_pool, first=1,
+                                       interval=int(_config('soyjak_pool_interval') or 5 * 60))
+    dispatcher.job_queue.run_repeating(file_ids.save, interval=int(_config('file_ids_save_interval') or 60))
+    dispatcher.job_queue.run_repeating(controller.cron, first=1,
+                                       interval=int(_config('load_controller_interval') or 15))
 
     logger.info('Setting commands...')
 
-    bot.set_my_commands([
-        ('fortune',      '🥠'),
-        ('imp',          '😈'),
-        ('translate',    '㊙️'),
-        ('distort',      '🔨'),
-        ('thread',       '🍀'),
-        ('calc',         '🧮'),
-        ('craiyon',      '🎨'),
-        ('sd',           '🖼️'),
-        ('gfpgan',       '📈'),
-        ('soyjak',       '🥛'),
-        ('caption',      '🔤'),
-        ('anime',        '🌸'),
-        ('wtf',          '🤔'),
-        ('chatbot',      '🤖'),
-        ('chiste',       '😂'),
-    ])
+    bot.set_my_commands(router.bot_commands())
 
     logger.info('Booting poller...')
 
@@ -1,17 +1,336 @@
+from decimal import Context, Decimal, ROUND_DOWN
 import re
-import subprocess
 
-from telegram import ChatAction, Update
+from telegram import Update
 from telegram.ext import CallbackContext
 
 from utils import _config, ellipsis, get_command_args
 
 
+# calculations are done in-process following the rules of bc -l with scale=3, so
+# the results are the same that bc would give
+SCALE = 3
+RX_TOKEN = re.compile(r'\s*(?:(\d+\.?\d*|\.\d*)|([a-z][a-z0-9]*)|(\+\+|--|[-+*/%^()]))')
+KEYWORDS = {'auto', 'break', 'continue', 'define', 'else', 'for', 'halt', 'if', 'limits',
+            'print', 'quit', 'read', 'return', 'warranty', 'while'}
+# the names that used to be rewritten to their bc equivalents
+ALIASES = {'sin': 's', 'cos': 'c', 'arc': 'a', 'ln': 'l', 'exp': 'e'}
+SPECIAL_VARIABLES = {'scale': Decimal(SCALE), 'ibase': Decimal(10), 'obase': Decimal(10), 'last': Decimal(0)}
+# parentheses and function calls are the only things parsed recursively
+MAX_DEPTH = 100
+
+
+def parse(text: str) -> tuple:
+    """parses an expression into a tree of tuples. chains of operators of the same
+    precedence are kept in a single node, so long expressions don't nest"""
+    tokens = []
+    depth = 0
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = RX_TOKEN.match(text, position)
+        if not match:
+            raise ValueError('syntax error')
+        number, name, operator = match.groups()
+        if number is not None:
+            tokens.append(('number', number))
+        elif name is not None:
+            if name in KEYWORDS:
+                raise ValueError('syntax error')
+            tokens.append(('name', ALIASES.get(name, name)))
+        else:
+            tokens.append(('op', operator))
+        position = match.end()
+    tokens.append(('end', None))
+
+    def peek():
+        return tokens[0]
+
+    def take(kind=None, value=None):
+        token = tokens.pop(0)
+        if (kind and token[0] != kind) or (value and token[1] != value):
+            raise ValueError('syntax error')
+        return token
+
+    # from lowest to highest precedence: + -, * / %, ^ (right associative), unary -
+    def chain(operand, operators):
+        """a left associative chain as ('chain', first, ((operator, operand), ...))"""
+        node = operand()
+        rest = []
+        while peek()[0] == 'op' and peek()[1] in operators:
+            rest.append((take()[1], operand()))
+        return ('chain', node, tuple(rest)) if rest else node
+
+    def expression():
+        return chain(term, ('+', '-'))
+
+    def term():
+        return chain(power, ('*', '/', '%'))
+
+    def power():
+        operands = [unary()]
+        while peek() == ('op', '^'):
+            take()
+            operands.append(unary())
+        return ('^', tuple(operands)) if len(operands) > 1 else operands[0]
+
+    def unary():
+        negations = 0
+        while peek() == ('op', '-'):
+            take()
+            negations += 1
+        if peek() in (('op', '++'), ('op', '--')):
+            operator = take()[1]
+            node = ('pre' + operator, take('name')[1])
+        else:
+            node = primary()
+        return ('neg', node) if negations % 2 else node
+
+    def nested():
+        nonlocal depth
+        depth += 1
+        if depth > MAX_DEPTH:
+            raise ValueError('too many nested parentheses')
+        node = expression()
+        take('op', ')')
+        depth -= 1
+        return node
+
+    def primary():
+        kind, value = take()
+        if kind == 'number':
+            return ('number', Decimal(value if value != '.' else '0'))
+        if kind == 'op' and value == '(':
+            return nested()
+        if kind == 'name':
+            if value == 'pi':
+                return ('chain', ('number', Decimal(4)), (('*', ('call', 'a', ('number', Decimal(1)))),))
+            if peek() == ('op', '('):
+                take()
+                return ('call', value, nested())
+            if peek() in (('op', '++'), ('op', '--')):
+                return ('post' + take()[1], value)
+            return ('name', value)
+        raise ValueError('syntax error')
+
+    tree = expression()
+    take('end')
+    return tree
+
+
+def to_bc(value: Decimal) -> str:
+    """formats a number like bc does: no leading zero and 0 is always 0"""
+    if not value:
+        return '0'
+    text = format(value, 'f')
+    if text.startswith('0.'):
+        return text[1:]
+    if text.startswith('-0.'):
+        return '-' + text[2:]
+    return text
+
+
+class Evaluator:
+    """evaluates a tree from parse. every operation counts against a budget of
+    operations, and no number can grow over a budget of digits"""
+    def __init__(self, max_operations: int, max_digits: int):
+        self.operations = max_operations
+        self.max_digits = max_digits
+        # enough to do every operation exactly within the digit budget
+        self.context = Context(prec=2 * max_digits + 2 * SCALE + 10, Emax=10 ** 9, Emin=-10 ** 9)
+        self.variables = {}
+
+    def spend(self, operations: int = 1) -> None:
+        self.operations -= operations
+        if self.operations < 0:
+            raise ValueError('too many operations')
+
+    def check(self, value: Decimal) -> Decimal:
+        if len(value.as_tuple().digits) > self.max_digits:
+            raise ValueError('number too large')
+        return value
+
+    @staticmethod
+    def scale(value: Decimal) -> int:
+        return max(0, -value.as_tuple().exponent)
+
+    @staticmethod
+    def coefficient(value: Decimal) -> int:
+        """returns the digits of the number as an integer, without the point"""
+        sign, digits, exponent = value.as_tuple()
+        coefficient = int(''.join(map(str, digits))) * 10 ** max(0, exponent)
+        return -coefficient if sign else coefficient
+
+    def truncate(self, value: Decimal, scale: int) -> Decimal:
+        if self.scale(value) <= scale:
+            return value
+        return value.quantize(Decimal(1).scaleb(-scale), rounding=ROUND_DOWN, context=self.context)
+
+    def rescale(self, value: Decimal, scale: int) -> Decimal:
+        """truncates or pads to exactly scale digits, like x/1 does in bc"""
+        return value.quantize(Decimal(1).scaleb(-scale), rounding=ROUND_DOWN, context=self.context)
+
+    def divide(self, a: Decimal, b: Decimal, scale: int) -> Decimal:
+        if not b:
+            raise ValueError('divide by zero')
+        sa, sb = self.scale(a), self.scale(b)
+        numerator = self.coefficient(a) * 10 ** (scale + sb)
+        denominator = self.coefficient(b) * 10 ** sa
+        quotient = abs(numerator) // abs(denominator)
+        if (numerator < 0) != (denominator < 0):
+            quotient = -quotient
+        return Decimal(f'{quotient}E-{scale}')
+
+    def evaluate(self, node: tuple) -> Decimal:
+        self.spend()
+        kind = node[0]
+        if kind == 'number':
+            return self.check(node[1])
+        if kind == 'name':
+            return self.variables.get(node[1], SPECIAL_VARIABLES.get(node[1], Decimal(0)))
+        if kind in ('pre++', 'pre--', 'post++', 'post--'):
+            old = self.variables.get(node[1], SPECIAL_VARIABLES.get(node[1], Decimal(0)))
+            new = self.context.add(old, 1) if kind.endswith('++') else self.context.subtract(old, 1)
+            self.variables[node[1]] = self.check(new)
+            return new if kind.startswith('pre') else old
+        if kind == 'neg':
+            return self.context.minus(self.evaluate(node[1]))
+        if kind == 'call':
+            return self.call(node[1], self.evaluate(node[2]))
+        if kind == 'chain':
+            value = self.evaluate(node[1])
+            for operator, operand in node[2]:
+                value = self.binary(operator, value, self.evaluate(operand))
+            return value
+        if kind == '^':
+            # right associative, so from the last one
+            operands = [self.evaluate(operand) for operand in node[1]]
+            value = operands.pop()
+            while operands:
+                self.spend()
+                value = self.power(operands.pop(), value)
+            return value
+        raise ValueError('syntax error')
+
+    def binary(self, kind: str, a: Decimal, b: Decimal) -> Decimal:
+        self.spend()
+        if kind == '+':
+            return self.check(self.context.add(a, b))
+        if kind == '-':
+            return self.check(self.context.subtract(a, b))
+        if kind == '*':
+            scale = min(self.scale(a) + self.scale(b), max(SCALE, self.scale(a), self.scale(b)))
+            return self.check(self.truncate(self.context.multiply(a, b), scale))
+        if kind == '/':
+            return self.check(self.divide(a, b, SCALE))
+        if kind == '%':
+            # bc computes a - (a / b) * b with the division at the current scale
+            if not b:
+                raise ValueError('divide by zero')
+            product = self.context.multiply(self.divide(a, b, SCALE), b)
+            return self.check(self.context.subtract(a, product))
+        raise ValueError('syntax error')
+
+    def power(self, a: Decimal, b: Decimal) -> Decimal:
+        if self.scale(b):
+            raise ValueError('non-zero scale in exponent')
+        exponent = int(b)
+        sa = self.scale(a)
+        if exponent == 0:
+            return Decimal(1)
+        coefficient = self.coefficient(a)
+        if coefficient in (-1, 0, 1) and not sa:
+            if not coefficient and exponent < 0:
+                raise ValueError('divide by zero')
+            return Decimal(coefficient ** abs(exponent))
+        if len(str(abs(coefficient))) * abs(exponent) > self.max_digits:
+            raise ValueError('number too large')
+        self.spend(abs(exponent).bit_length())
+        result = Decimal(f'{coefficient ** abs(exponent)}E-{sa * abs(exponent)}')
+        if exponent < 0:
+            return self.check(self.divide(Decimal(1), result, SCALE))
+        return self.check(self.truncate(result, min(sa * exponent, max(SCALE, sa))))
+
+    def call(self, name: str, x: Decimal) -> Decimal:
+        if name == 'sqrt':
+            if x < 0:
+                raise ValueError('square root of a negative number')
+            scale = max(SCALE, self.scale(x))
+            context = Context(prec=len(x.as_tuple().digits) + scale + 10)
+            return self.check(self.rescale(context.sqrt(x), scale))
+        if name == 'length':
+            return Decimal(len(x.as_tuple().digits))
+        if name == 'scale':
+            return Decimal(self.scale(x))
+        if name not in ('s', 'c', 'a', 'l', 'e'):
+            raise ValueError(f'function {name} not defined')
+
+        # the math library computes with some extra digits and truncates to the scale
+        integer_digits = max(0, x.adjusted() + 1)
+        if name == 'e':
+            if x > 0 and x / Decimal('2.302585') > self.max_digits:
+                raise ValueError('number too large')
+            integer_digits = int(max(x, 0) / Decimal('2.302585')) + 1
+        context = Context(prec=integer_digits + SCALE + 20)
+        if name == 'e':
+            value = context.exp(x)
+        elif name == 'l':
+            if x <= 0:
+                # this is what the math library returns for these
+                return Decimal(1 - 10 ** SCALE)
+            value = context.ln(x)
+        elif name == 'a':
+            value = self.atan(x, context)
+        else:
+            value = self.sin_cos(x, context, name == 'c')
+        return self.check(self.rescale(context.plus(value), SCALE))
+
+    def atan(self, x: Decimal, context: Context) -> Decimal:
+        # atan(x) = 2 * atan(x / (1 + sqrt(1 + x^2))) until x is small enough
+        halvings = 0
+        while abs(x) > Decimal('0.1'):
+            self.spend()
+            x = context.divide(x, context.add(1, context.sqrt(context.add(1, context.multiply(x, x)))))
+            halvings += 1
+        # x - x^3/3 + x^5/5 - ...
+        square = context.multiply(x, x)
+        total, power, n = x, x, 1
+        epsilon = Decimal(1).scaleb(-context.prec)
+        while abs(power) > epsilon:
+            self.spend()
+            power = context.minus(context.multiply(power, square))
+            n += 2
+            total = context.add(total, context.divide(power, n))
+        return context.multiply(total, 2 ** halvings)
+
+    def sin_cos(self, x: Decimal, context: Context, cosine: bool) -> Decimal:
+        pi = context.multiply(self.atan(Decimal(1), context), 4)
+        x = context.remainder_near(x, context.multiply(pi, 2))
+        # sin: x - x^3/3! + ..., cos: 1 - x^2/2! + ...
+        square = context.multiply(x, x)
+        term, n = (Decimal(1), 0) if cosine else (x, 1)
+        total = term
+        epsilon = Decimal(1).scaleb(-context.prec)
+        while abs(term) > epsilon:
+            self.spend()
+            term = context.divide(context.minus(context.multiply(term, square)), (n + 1) * (n + 2))
+            total = context.add(total, term)
+            n += 2
+        return total
+
+
+def calculate(text: str) -> str:
+    """calculates an expression and returns the result formatted like bc"""
+    evaluator = Evaluator(int(_config('calc_max_operations') or 10000),
+                          int(_config('calc_max_digits') or 1000))
+    return to_bc(evaluator.evaluate(parse(text)))
+
+
 RX_VALID = re.compile(r'^[0-9\+\-\*\/\(\)\.\^\%a-z ]*$')
 RX_WHITESPACE = re.compile(r'\s+')
 RX_TRAILING_ZEROS = re.compile(r'\.?0+$')
 def command_calc(update: Update, context: CallbackContext) -> None:
-    """calculates something using bc"""
+    """calculates something like bc would"""
     text = get_command_args(update)
     if not text:
         update.message.reply_text('Include a statement to calculate. 2+2, 5^3, sqrt(36), cos(4*pi), etc.')
@@ -26,35 +345,18 @@ def command_calc(update: Update, context: CallbackContext) -> None:
     if statement == '2+2':
         update.message.reply_text(text + ' = 5', quote=False)
         return
-    statement = text.replace('cos(', 'c(').\
-                     replace('sin(', 's(').\
-                     replace('arc(', 'a(').\
-                     replace('ln(',  'l(').\
-                     replace('exp(', 'e(').\
-                     replace('pi', '(4*a(1))')
-
-    context.bot_data['actions'].append(update.message.chat_id, ChatAction.TYPING)
-
-    with subprocess.Popen(['bc', '-l'], stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
-        proc.stdin.write(bytes('scale=3; ' + statement + '\n', encoding='utf8'))
-
-        try:
-            stdout, stderr = proc.communicate(timeout=int(_config('calc_timeout')))
-            stdout = stdout.decode('utf8').strip().replace(r'\n', '')
-            stderr = stderr.decode('utf8').strip().replace(r'\n', '')
-
-            if stderr:
-                update.message.reply_text(f'Error: {stderr}', quote=False)
-            elif stdout:
-                if '.' in stdout:
-                    stdout = RX_TRAILING_ZEROS.sub('', stdout)
-                nag = '. Seems obvious.' if statement == stdout else ''
-                update.message.reply_text(ellipsis(f'{text} = {stdout}{nag}', 4096), quote=False)
-            else:
-                update.message.reply_text('Something came up.', quote=False)
-            proc.wait()
-        except subprocess.TimeoutExpired:
-            update.message.reply_text('Timeout.', quote=False)
-            proc.kill()
-
-    context.bot_data['actions'].remove(update.message.chat_id, ChatAction.TYPING)
+
+    try:
+        result = calculate(text)
+    except (ValueError, ArithmeticError) as exc:
+        update.message.reply_text(f'Error: {exc}', quote=False)
+        return
+    except RecursionError:
+        # shouldn't happen with the depth limit, but never let it reach the error handler
+        update.message.reply_text('Error: expression too complex', quote=False)
+        return
+
+    if '.' in result:
+        result = RX_TRAILING_ZEROS.sub('', result)
+    nag = '. Seems obvious.' if text == result else ''
+    update.message.reply_text(ellipsis(f'{text} = {result}{nag}', 4096), quote=False)
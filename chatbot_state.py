@@ -0,0 +1,138 @@
+from collections import OrderedDict
+import gzip
+import json
+import os
+import threading
+import time
+
+from utils import _config, get_random_string, logger
+
+
+class ChatbotState:
+    """keeps the chatbot conversation of every chat. histories are trimmed to a
+    budget of characters so every turn sends a bounded amount of text upstream,
+    idle conversations are evicted and everything is saved to disk so
+    conversations survive restarts"""
+    FILENAME = 'chatbot_state.json.gz'
+    MAX_MESSAGE_IDS = 1000
+
+    def __init__(self):
+        # chat_id -> session, least recently used first
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.max_chars = int(_config('chatbot_max_history_chars') or 6000)
+        self.max_sessions = int(_config('chatbot_max_sessions') or 100)
+        self.max_idle = int(_config('chatbot_max_idle_hours') or 24) * 60 * 60
+        self.load()
+
+    def __contains__(self, chat_id):
+        with self.lock:
+            self.gc()
+            return chat_id in self.sessions
+
+    def start(self, chat_id, message_id):
+        with self.lock:
+            self.sessions[chat_id] = {
+                'history': [],
+                'hash': get_random_string(11),
+                'message_ids': {message_id: None},
+                'last_used': time.time(),
+            }
+            self.touch(chat_id)
+        self.save()
+
+    def remove(self, chat_id):
+        with self.lock:
+            self.sessions.pop(chat_id, None)
+        self.save()
+
+    def touch(self, chat_id):
+        self.sessions[chat_id]['last_used'] = time.time()
+        self.sessions.move_to_end(chat_id)
+        self.gc()
+
+    def gc(self):
+        """evicts idle sessions and the least recently used ones over the limit"""
+        while self.sessions:
+            chat_id, session = next(iter(self.sessions.items()))
+            if (len(self.sessions) <= self.max_sessions and
+                    time.time() - session['last_used'] < self.max_idle):
+                break
+            logger.info('evicting chatbot session for %d', chat_id)
+            del self.sessions[chat_id]
+
+    def get_history(self, chat_id) -> list:
+        with self.lock:
+            return list(self.sessions[chat_id]['history'])
+
+    def get_hash(self, chat_id) -> str:
+        with self.lock:
+            return self.sessions[chat_id]['hash']
+
+    def set_history(self, chat_id, history):
+        """stores the history of a conversation, dropping the oldest turns until it
+        fits in the budget. the last turn is always kept"""
+        history = list(history)
+        size = sum(len(x or '') for turn in history for x in turn)
+        while len(history) > 1 and size > self.max_chars:
+            size -= sum(len(x or '') for x in history.pop(0))
+        with self.lock:
+            if chat_id not in self.sessions:
+                # the conversation was ended meanwhile
+                return
+            self.sessions[chat_id]['history'] = history
+            self.touch(chat_id)
+        self.save()
+
+    def add_message_id(self, chat_id, message_id):
+        with self.lock:
+            if chat_id not in self.sessions:
+                return
+            message_ids = self.sessions[chat_id]['message_ids']
+            message_ids[message_id] = None
+            if len(message_ids) > self.MAX_MESSAGE_IDS:
+                del message_ids[next(iter(message_ids))]
+
+    def is_chatbot_message(self, chat_id, message_id) -> bool:
+        with self.lock:
+            return chat_id in self.sessions and message_id in self.sessions[chat_id]['message_ids']
+
+    def save(self):
+        with self.lock:
+            data = [[chat_id, session['history'], session['hash'],
+                     list(session['message_ids']), int(session['last_used'])]
+                    for chat_id, session in self.sessions.items()]
+        try:
+            with self.save_lock:
+                with gzip.open(self.FILENAME + '.tmp', 'wt', encoding='utf8') as fp:
+                    json.dump(data, fp, ensure_ascii=False, separators=(',', ':'))
+                os.replace(self.FILENAME + '.tmp', self.FILENAME)
+        except:
+            logger.exception("couldn't save the chatbot state")
+
+    def load(self):
+        try:
+            with gzip.open(self.FILENAME, 'rt', encoding='utf8') as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return
+        except:
+            logger.exception("couldn't load the chatbot state")
+            return
+        for chat_id, history, hash_, message_ids, last_used in data:
+            self.sessions[chat_id] = {
+                'history': history,
+                'hash': hash_,
+                'message_ids': dict.fromkeys(message_ids),
+                'last_used': last_used,
+            }
+        self.gc()
+        logger.info('loaded %d chatbot sessions', len(self.sessions))
+
+    def dump(self) -> str:
+        with self.lock:
+            if self.sessions:
+                chats = ', '.join(f'{chat_id}#{len(session["history"])}' for chat_id, session in self.sessions.items())
+                return f'There is chatbot state for the following chats: {chats}'
+        return 'There is no chatbot state saved for any chats.'
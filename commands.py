@@ -0,0 +1,68 @@
+from inspect import getdoc
+import re
+
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher, Handler
+
+
+RX_COMMAND = re.compile(r'^/([a-z0-9_]+)(?:@([a-z0-9_]+))?(?:\s|$)', re.IGNORECASE)
+
+
+class CommandRouter(Handler):
+    """a single handler for every command. the command is extracted once from the
+    message and looked up in a dict, instead of every CommandHandler checking it
+    in turn. the same registry feeds /help and the command list of the bot"""
+    def __init__(self):
+        super().__init__(self.route)
+        # command -> [(callback, run_async, captions), ...]
+        self.commands = {}
+        # (commands, callback, description) in the order they were added
+        self.registry = []
+
+    def add(self, commands, callback, run_async: bool = False, captions: bool = False,
+            description: str = None) -> None:
+        """registers a callback for one or several commands. if captions is True, it
+        also runs for media with the command in the caption. commands with a
+        description are shown in the command list of the bot"""
+        commands = [commands] if isinstance(commands, str) else list(commands)
+        for command in commands:
+            self.commands.setdefault(command.lower(), []).append((callback, run_async, captions))
+        self.registry.append((commands, callback, description))
+
+    def check_update(self, update: object):
+        # only new messages. CommandHandler also let edited messages and channel
+        # posts through, but every callback uses update.message, so they failed
+        if not isinstance(update, Update) or not update.message:
+            return None
+        message = update.message
+        text = message.text or message.caption
+        if not text or not (match := RX_COMMAND.match(text)):
+            return None
+        command, username = match.groups()
+        if username and username.lower() != message.bot.username.lower():
+            return None
+        callbacks = [x for x in self.commands.get(command.lower(), []) if message.text or x[2]]
+        if not callbacks:
+            return None
+        return callbacks, text.split()[1:]
+
+    def handle_update(self, update: Update, dispatcher: Dispatcher, check_result, context: CallbackContext = None):
+        callbacks, context.args = check_result
+        for callback, run_async, _ in callbacks:
+            if run_async:
+                dispatcher.run_async(callback, update, context, update=update)
+            else:
+                callback(update, context)
+
+    @staticmethod
+    def route(*_):
+        """every update is handled in handle_update"""
+
+    def help(self) -> list[str]:
+        """returns a line for every registered callback with its commands and what
+        it does"""
+        return [f'<strong>{" ".join("/" + x for x in commands)}</strong> - {getdoc(callback).replace(chr(10), " ")}'
+                for commands, callback, _ in self.registry]
+
+    def bot_commands(self) -> list[tuple[str, str]]:
+        return [(commands[0], description) for commands, _, description in self.registry if description]
@@ -1,59 +1,112 @@
-from time import sleep
+from math import ceil
+import random
+import time
 
 from telegram import Update
 from telegram.ext import CallbackContext
-from wand.image import Image
 
+from scheduler import fair
 from utils import (_config, create_gallery, logger, get_command_args, image_from_b64,
-                   requests_session, get_url)
+                   requests_session)
 
 
-def command_dalle(update: Update, _: CallbackContext) -> None:
+class GeneratorJob:
+    """a request to an image generator that is retried in the background with
+    jittered exponential backoff until it works, runs out of attempts or runs out
+    of time. no thread is kept busy while waiting for the next attempt: retries
+    are scheduled in the job queue and run in a worker"""
+
+    def __init__(self, update: Update, context: CallbackContext, name: str, progress_msg, fun):
+        self.update = update
+        self.context = context
+        self.name = name
+        self.progress_msg = progress_msg
+        # fun makes a single attempt and returns True if it worked
+        self.fun = fun
+        self.attempts = 0
+        self.max_attempts = int(_config('generator_max_attempts') or 10)
+        self.deadline = None
+
+    @classmethod
+    def start(cls, update: Update, context: CallbackContext, name: str, message: str, fun) -> None:
+        progress_msg = update.message.reply_text(message, quote=False)
+        job = cls(update, context, name, progress_msg, fun)
+        # wait for our turn without keeping a worker. users take turns, and every user
+        # can only ask for so many. the first attempt runs like the retries do
+        if not fair['generators'].submit(update.message.from_user.id, update.message.chat_id, 1,
+                                         lambda: context.dispatcher.run_async(job.attempt)):
+            progress_msg.edit_text('You have too many images waiting to be generated. Try again later.')
+
+    def attempt(self) -> None:
+        if self.deadline is None:
+            # the time spent waiting for our turn doesn't count
+            self.deadline = time.monotonic() + int(_config('generator_deadline') or 300)
+        self.attempts += 1
+        try:
+            if self.fun(self.update):
+                self.finish()
+                return
+        except Exception:
+            logger.exception('%s: attempt %d failed', self.name, self.attempts)
+
+        delay = min(2 ** self.attempts, 60) * random.uniform(.5, 1.5)
+        if self.attempts >= self.max_attempts:
+            self.finish(f'{self.name} failed {self.attempts} times in a row. Giving up.')
+        elif time.monotonic() + delay > self.deadline:
+            self.finish(f'{self.name} timed out after {self.attempts} attempts.')
+        else:
+            logger.info('%s: retrying in %.1f seconds', self.name, delay)
+            self.context.bot_data['edits'].append_edit(
+                self.progress_msg, f'{self.name} failed (attempt {self.attempts} of {self.max_attempts}). '
+                                   f'Retrying in {ceil(delay)} seconds…')
+            self.context.job_queue.run_once(lambda context: context.dispatcher.run_async(self.attempt), delay)
+
+    def finish(self, error: str = None) -> None:
+        fair['generators'].release()
+        self.context.bot_data['edits'].flush_edits(self.progress_msg)
+        if error:
+            self.progress_msg.edit_text(error)
+        else:
+            self.progress_msg.delete()
+
+
+def command_dalle(update: Update, context: CallbackContext) -> None:
     """requests images for a specific prompt from dalle mini"""
     prompt = get_command_args(update, use_quote=True)
     if not prompt:
         update.message.reply_text('Must specify or quote a prompt.')
         return
 
-    progress_msg = update.message.reply_text(
-        f'Asking DALL·E mini to generate images for prompt "{prompt[:4000]}"…',
-        quote=False
-    )
-
-    while True:
+    def dalle(update):
         r = requests_session.post('https://bf.dallemini.ai/generate', json={'prompt': prompt})
-        if r.ok:
-            images = [Image(blob=image_from_b64('data:image/jpeg;base64,' + blob)) for blob in r.json()['images']]
-            update.message.reply_photo(create_gallery(images))
-            break
-        logger.info('dalle request failed. retrying...')
-        sleep(1)
-
-    progress_msg.delete()
-
-def get_craiyon(prompt: str, model: str = 'none') -> Image:
-    while True:
-        r = requests_session.post('https://api.craiyon.com/v3', json={
-            'prompt': prompt,
-            'negative_prompt': _config('negative_prompt'),
-            'model': model,
-            'version': '35s5hfwn9n78gb06',
-            'token': None,
-        }, timeout=60)
-        if r.ok:
-            json = r.json()
-            try:
-                images = create_gallery([Image(blob=get_url(f'https://img.craiyon.com/{path}')) for path in json['images']])
-            except Exception as exc:
-                logger.info('craiyon: error loading images: %s', exc)
-                continue
-            next_prompt = json['next_prompt'] if not json['next_prompt'].startswith('Sorry,') else None
-            return images, next_prompt
-        logger.info('craiyon request failed: "%s". retrying...', r.text)
-        sleep(1)
-
-
-def command_craiyon(update: Update, _: CallbackContext) -> None:
+        if not r.ok:
+            logger.info('dalle request failed: "%s"', r.text)
+            return False
+        update.message.reply_photo(create_gallery([image_from_b64(blob) for blob in r.json()['images']]))
+        return True
+
+    GeneratorJob.start(update, context, 'DALL·E mini',
+                       f'Asking DALL·E mini to generate images for prompt "{prompt[:4000]}"…', dalle)
+
+
+def get_craiyon(prompt: str, model: str = 'none') -> tuple[bytes, str]:
+    """makes a single request to craiyon. raises if it fails"""
+    r = requests_session.post('https://api.craiyon.com/v3', json={
+        'prompt': prompt,
+        'negative_prompt': _config('negative_prompt'),
+        'model': model,
+        'version': '35s5hfwn9n78gb06',
+        'token': None,
+    }, timeout=60)
+    if not r.ok:
+        raise RuntimeError(f'craiyon request failed: "{r.text}"')
+    json = r.json()
+    images = create_gallery([f'https://img.craiyon.com/{path}' for path in json['images']])
+    next_prompt = json['next_prompt'] if not json['next_prompt'].startswith('Sorry,') else None
+    return images, next_prompt
+
+
+def command_craiyon(update: Update, context: CallbackContext) -> None:
     """requests images for a specific prompt from craiyon"""
     prompt = get_command_args(update, use_quote=True)
     if not prompt:
@@ -68,9 +121,9 @@ def command_craiyon(update: Update, _: CallbackContext) -> None:
             prompt = prompt.replace(f'+{arg}', '').strip()
             message = f'Asking Craiyon to generate images for prompt "{prompt[:4000]}" using model "{arg}"…'
 
-    progress_msg = update.message.reply_text(message, quote=False)
-
-    gallery, next_prompt = get_craiyon(prompt, model)
-    update.message.reply_photo(gallery, caption=f'Suggestion:\n{next_prompt}' if next_prompt else None)
+    def craiyon(update):
+        gallery, next_prompt = get_craiyon(prompt, model)
+        update.message.reply_photo(gallery, caption=f'Suggestion:\n{next_prompt}' if next_prompt else None)
+        return True
 
-    progress_msg.delete()
\ No newline at end of file
+    GeneratorJob.start(update, context, 'Craiyon', message, craiyon)
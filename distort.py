@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from glob import glob
 import gzip
 import json
@@ -7,6 +8,7 @@ import re
 from shutil import copy2
 import subprocess
 import threading
+import time
 
 from telegram import ChatAction, Update
 from telegram.constants import MAX_MESSAGE_LENGTH
@@ -14,8 +16,10 @@ from telegram.error import BadRequest
 from telegram.ext import CallbackContext
 from wand.image import Image
 
-from attachments import AttachmentType, download_attachment, get_attachment_type
+from attachments import AttachmentType, download_attachment, get_attachment_type, get_attachment_unique_id
+from scheduler import controller
 from translate import sub_scramble
+from uploads import send_media
 from utils import _config, clamp, ellipsis, get_command_args, get_random_string, logger, remove_command
 
 
@@ -25,6 +29,15 @@ MAX_SCORE = int(_config('distort_video_max_score'))
 wand_semaphore = threading.Semaphore(int(_config('distort_max_concurrent')))
 
 
+@contextmanager
+def _wand_slot():
+    """holds the semaphore, telling the load controller how long it took to get it"""
+    start = time.monotonic()
+    with wand_semaphore:
+        controller.waited(time.monotonic() - start)
+        yield
+
+
 def sub_distort(source: str, output: str = '', scale: float = -1, dimension: str = '') -> str:
     """distorts an image. returns the file name of the distorted image."""
     if not output:
@@ -37,7 +50,7 @@ def sub_distort(source: str, output: str = '', scale: float = -1, dimension: str
     if dimension not in ('h', 'w', '*'):
         dimension = '*'
 
-    with wand_semaphore, Image(filename=source) as img:
+    with _wand_slot(), Image(filename=source) as img:
         w, h = img.width, img.height
         new_w = int(w * (1 - (scale / 100))) if dimension in ('*', 'w') else w
         new_h = int(w * (1 - (scale / 100))) if dimension in ('*', 'h') else h
@@ -54,7 +67,7 @@ def sub_invert(source: str, output: str = '') -> str:
     if not output:
         output = 'inverted_' + source
 
-    with wand_semaphore, Image(filename=source) as img:
+    with _wand_slot(), Image(filename=source) as img:
         img.negate()
         img.compression_quality = 100
         img.save(filename=output)
@@ -76,22 +89,26 @@ def _get_video_info(filename):
     return width, height, frame_count, fps
 
 
-FFMPEG_CMD_EXTRACT = "ffmpeg -hide_banner -i '{source}' -vsync vfr -map 0:v:0 -q:v 2 '{prefix}-%06d." + DISTORT_FORMAT + "'"
+FFMPEG_CMD_EXTRACT = "ffmpeg -hide_banner -i '{source}' -vsync vfr -map 0:v:0 {scale}-q:v 2 '{prefix}-%06d." + DISTORT_FORMAT + "'"
+FFMPEG_SCALE = "-vf 'scale=w=min(iw\\,{size}):h=min(ih\\,{size}):force_original_aspect_ratio=decrease' "
 def _extract_video_frames(filename, prefix):
-    if subprocess.call(FFMPEG_CMD_EXTRACT.format(source=filename, prefix=prefix), shell=True) != 0:
+    size = controller.resolution()
+    scale = FFMPEG_SCALE.format(size=size) if size else ''
+    if subprocess.call(FFMPEG_CMD_EXTRACT.format(source=filename, prefix=prefix, scale=scale), shell=True) != 0:
         raise ValueError('Error extracting frames.')
     return sorted(glob(f'{prefix}*.{DISTORT_FORMAT}'))
 
 
 FFMPEG_CMD_HAS_AUDIO = "ffprobe -v error -select_streams a:0 -show_entries stream=index -of csv=p=0 '{source}'"
-FFMPEG_CMD_COMPOSE = "ffmpeg -framerate {fps} -i '{prefix}-distort-%06d." + DISTORT_FORMAT + "' -map_metadata -1 -vf 'pad=ceil(iw/2)*2:ceil(ih/2)*2' -c:v libx264 -pix_fmt yuv420p '{prefix}.mp4'"
-FFMPEG_CMD_COMPOSE_WITH_AUDIO = "ffmpeg -framerate {fps} -i '{prefix}-distort-%06d." + DISTORT_FORMAT + "' -i '{original}' -map_metadata -1 -map 0:v -map 1:a -af 'vibrato=d=1,vibrato=d=.5,aformat=s16p' -vf 'pad=ceil(iw/2)*2:ceil(ih/2)*2' -c:v libx264 -pix_fmt yuv420p '{prefix}.mp4'"
+FFMPEG_CMD_COMPOSE = "ffmpeg -framerate {fps} -i '{prefix}-distort-%06d." + DISTORT_FORMAT + "' -map_metadata -1 -vf 'pad=ceil(iw/2)*2:ceil(ih/2)*2' -c:v libx264 -preset {preset} -pix_fmt yuv420p '{prefix}.mp4'"
+FFMPEG_CMD_COMPOSE_WITH_AUDIO = "ffmpeg -framerate {fps} -i '{prefix}-distort-%06d." + DISTORT_FORMAT + "' -i '{original}' -map_metadata -1 -map 0:v -map 1:a -af 'vibrato=d=1,vibrato=d=.5,aformat=s16p' -vf 'pad=ceil(iw/2)*2:ceil(ih/2)*2' -c:v libx264 -preset {preset} -pix_fmt yuv420p '{prefix}.mp4'"
 def _compose_video(filename, fps, prefix):
     if len(subprocess.check_output(FFMPEG_CMD_HAS_AUDIO.format(source=filename), shell=True)) > 1:
-        if subprocess.call(FFMPEG_CMD_COMPOSE_WITH_AUDIO.format(fps=fps, prefix=prefix, original=filename), shell=True) != 0:
+        if subprocess.call(FFMPEG_CMD_COMPOSE_WITH_AUDIO.format(fps=fps, prefix=prefix, original=filename,
+                                                                preset=controller.preset()), shell=True) != 0:
             raise ValueError('Error generating video.')
     else:
-        if subprocess.call(FFMPEG_CMD_COMPOSE.format(fps=fps, prefix=prefix), shell=True) != 0:
+        if subprocess.call(FFMPEG_CMD_COMPOSE.format(fps=fps, prefix=prefix, preset=controller.preset()), shell=True) != 0:
             raise ValueError('Error generating video.')
 
 
@@ -118,9 +135,18 @@ def sub_distort_animation(filename: str, context: CallbackContext, progress_msg)
         context.bot_data['edits'].append_edit(progress_msg, 'Extracting frames…')
         frames = _extract_video_frames(filename, prefix)
     else:
-        frames = [filename] * int(_config('distort_photo_to_animation_frames'))
-        fps = 30
         prefix = filename[:-4]
+        source = filename
+        if size := controller.resolution():
+            with Image(filename=filename) as img:
+                if img.width > size or img.height > size:
+                    # when busy, work on a smaller copy. the original is kept as it is
+                    source = f'{prefix}-small{filename[-4:]}'
+                    prefix = source[:-4]
+                    img.transform(resize=f'{size}x{size}>')
+                    img.save(filename=source)
+        frames = [source] * controller.frames(int(_config('distort_photo_to_animation_frames')))
+        fps = 30
 
     distorted = []
     for i, frame in enumerate(frames):
@@ -137,6 +163,8 @@ def sub_distort_animation(filename: str, context: CallbackContext, progress_msg)
     if filename.endswith('.mp4') or filename.endswith('.webm'):
         for frame in frames:
             os.remove(frame)
+    elif frames[0] != filename:
+        os.remove(frames[0])
     for file in distorted:
         os.remove(file)
 
@@ -196,11 +224,35 @@ def command_voice(update: Update, context: CallbackContext) -> None:
         update.message.reply_text('Quote an audio or video file to have it converted into a voice message.')
         return
 
-    update.message.reply_voice(voice=open(filename, 'rb'), quote=False)
+    with open(filename, 'rb') as fp:
+        update.message.reply_voice(fp, quote=False)
 
     os.remove(filename)
 
 
+def distort_cost(update: Update, _: CallbackContext) -> float:
+    """estimates how expensive distorting a message is, in megapixels times frames,
+    from what telegram says about the attachment, before downloading it"""
+    message = update.message.reply_to_message or update.message
+    params = remove_command(update.message.caption or update.message.text or '').split(' ')
+    if message.photo:
+        media, frames = message.photo[-1], 1
+        if 'gif' in params:
+            frames = controller.frames(int(_config('distort_photo_to_animation_frames')))
+    elif message.video or message.animation:
+        media = message.video or message.animation
+        # the frame rate isn't known yet
+        frames = max(media.duration or 1, 1) * 30
+    elif message.video_note:
+        return message.video_note.length ** 2 * max(message.video_note.duration or 1, 1) * 30 / 1000000
+    elif message.sticker and not message.sticker.is_animated:
+        media, frames = message.sticker, 1
+    else:
+        # text, audio and animated stickers
+        return 1
+    return media.width * media.height * frames / 1000000
+
+
 def command_distort(update: Update, context: CallbackContext) -> None:
     """handles the /distort command"""
     filename = download_attachment(update, context)
@@ -217,7 +269,7 @@ def command_distort(update: Update, context: CallbackContext) -> None:
     else:
         if update.message.chat.type == 'private' and update.message.chat.id in context.bot_data['chatbot_state']:
             if update.message.text == '/distort' and not update.message.reply_to_message:
-                del context.bot_data['chatbot_state'][update.message.chat.id]
+                context.bot_data['chatbot_state'].remove(update.message.chat.id)
                 update.message.reply_text('Automatically distorting all incoming text. To start a new conversation, use /chatbot again.')
             return
         text = get_command_args(update, use_quote=update.message.text.startswith('/distort'))
@@ -233,6 +285,14 @@ def command_distort(update: Update, context: CallbackContext) -> None:
             update.message.reply_text('Nothing to distort. Upload or quote text, a photo, video, GIF, sticker, audio, or voice or video note.')
 
 
+def _output_key(operation: str, update: Update) -> str:
+    """the same attachment always gives the same output in these commands, so it
+        can be remembered by the attachment and the operation"""
+    if unique_id := get_attachment_unique_id(update.message.reply_to_message or update.message):
+        return f'{operation}:{unique_id}'
+    return None
+
+
 def command_invert(update: Update, context: CallbackContext) -> None:
     """handles the /invert command"""
     filename = download_attachment(update, context, AttachmentType.PHOTO)
@@ -242,7 +302,8 @@ def command_invert(update: Update, context: CallbackContext) -> None:
 
     inverted_filename = sub_invert(filename)
 
-    update.message.reply_photo(open(inverted_filename, 'rb'))
+    with open(inverted_filename, 'rb') as fp:
+        send_media(update.message.reply_photo, fp, key=_output_key('invert', update))
 
     os.remove(filename)
     os.remove(inverted_filename)
@@ -255,7 +316,8 @@ def command_photo(update: Update, context: CallbackContext) -> None:
         update.message.reply_text('Quote a compatible message.')
         return
 
-    update.message.reply_photo(open(filename, 'rb'))
+    with open(filename, 'rb') as fp:
+        send_media(update.message.reply_photo, fp, key=_output_key('photo', update))
 
     os.remove(filename)
 
@@ -286,7 +348,8 @@ def command_distort_animated_sticker(update: Update, context: CallbackContext, f
     finally:
         context.bot_data['actions'].remove(update.message.chat_id, ChatAction.CHOOSE_STICKER)
 
-    update.message.reply_sticker(open(sticker, 'rb'))
+    with open(sticker, 'rb') as fp:
+        update.message.reply_sticker(fp)
 
     os.remove(filename)
     os.remove(sticker)
@@ -304,7 +367,8 @@ def command_distort_audio(update: Update, context: CallbackContext, filename: st
     finally:
         context.bot_data['actions'].remove(update.message.chat_id, ChatAction.RECORD_VOICE)
 
-    update.message.reply_voice(voice=open(voice, 'rb'))
+    with open(voice, 'rb') as fp:
+        update.message.reply_voice(fp)
 
     os.remove(filename)
     os.remove(voice)
@@ -326,7 +390,8 @@ def command_distort_animation(update: Update, context: CallbackContext, filename
     finally:
         context.bot_data['actions'].remove(update.message.chat_id, ChatAction.UPLOAD_VIDEO)
 
-    update.message.reply_animation(animation=open(animation, 'rb'))
+    with open(animation, 'rb') as fp:
+        update.message.reply_animation(fp)
 
     os.remove(filename)
     os.remove(animation)
@@ -397,14 +462,6 @@ def command_distort_photo(update: Update, context: CallbackContext, filename: st
     os.remove(distorted_filename)
 
 
-RX_COMMAND_CHECK = re.compile(r'^/distort(@aryan_bot)?(\s|$)', re.IGNORECASE)
-def command_distort_caption(update: Update, context: CallbackContext) -> None:
-    """check if a photo with caption has a distort command. if so, distorts it.
-    else, it does nothing."""
-    if RX_COMMAND_CHECK.match(update.message.caption):
-        command_distort(update, context)
-
-
 FFMPEG_WTF = ("ffmpeg -stream_loop -1 -i '{source}' -i assets/wtf.mp4 "
               "-filter_complex '[0:v]scale=w=800:h=600:force_original_aspect_ratio=2,crop=800:600[imgout];[1:v]colorkey=0x00ff01:0.35[ckout];[imgout][ckout]overlay[out]' "
               "-map '[out]' -map 1:a -c:a copy -aspect 800/600 -shortest -y -preset veryfast '{output}'")
@@ -423,7 +480,8 @@ def command_wtf(update: Update, context: CallbackContext) -> None:
     if subprocess.call(FFMPEG_WTF.format(source=filename, output=output), shell=True) != 0:
         update.message.reply_text('Ooops, I messed up!')
     else:
-        update.message.reply_video(open(output, 'rb'))
+        with open(output, 'rb') as fp:
+            send_media(update.message.reply_video, fp, key=_output_key('wtf', update))
 
     os.remove(filename)
     os.remove(output)
@@ -5,7 +5,7 @@ from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.ext import CallbackContext
 
 from huggingface import HuggingFaceFormat, huggingface
-from utils import _config, get_random_string
+from utils import _config, _config_list
 
 
 def command_sd(update: Update, context: CallbackContext) -> None:
@@ -13,6 +13,7 @@ def command_sd(update: Update, context: CallbackContext) -> None:
     huggingface(update, context, {
         'name': 'Stable Diffusion 2.1',
         'space': 'stabilityai-stable-diffusion',
+        'mirrors': _config_list('hf_mirrors_sd'),
         'in_format': [HuggingFaceFormat.TEXT, _config('negative_prompt'), 9],
         'out_format': [HuggingFaceFormat.PHOTO],
         'fn_index': 2,
@@ -24,11 +25,14 @@ def command_gfpgan(update: Update, context: CallbackContext) -> None:
     huggingface(update, context, {
         'name': 'GFPGAN',
         'space': 'algoworks-image-face-upscale-restoration-gfpgan-pub',
+        'mirrors': _config_list('hf_mirrors_gfpgan'),
         'in_format': [HuggingFaceFormat.PHOTO, 'v1.4', '4'],
+        'max_input_size': 1024,
         'out_format': HuggingFaceFormat.PHOTO,
         'fn_index': 0,
         'multiple': True,
         'hash_on_open': True,
+        'cache': True,
     })
 
 
@@ -37,9 +41,12 @@ def command_caption(update: Update, context: CallbackContext) -> None:
     huggingface(update, context, {
         'name': 'Caption',
         'space': 'srddev-image-caption',
+        'mirrors': _config_list('hf_mirrors_caption'),
         'in_format': [HuggingFaceFormat.PHOTO],
+        'max_input_size': 512,
         'out_format': HuggingFaceFormat.TEXT,
         'method': 'push',
+        'cache': True,
     })
 
 
@@ -48,7 +55,9 @@ def command_anime(update: Update, context: CallbackContext) -> None:
     huggingface(update, context, {
         'name': 'AnimeGANv1',
         'space': 'akhaliq-animeganv1',
+        'mirrors': _config_list('hf_mirrors_anime'),
         'in_format': [HuggingFaceFormat.PHOTO],
+        'max_input_size': 1024,
         'out_format': HuggingFaceFormat.PHOTO,
         'multiple': True,
     })
@@ -59,9 +68,12 @@ def command_clip(update: Update, context: CallbackContext) -> None:
     huggingface(update, context, {
         'name': 'CLIP Interrogator',
         'space': 'pharma-clip-interrogator',
+        'mirrors': _config_list('hf_mirrors_clip'),
         'in_format': [HuggingFaceFormat.PHOTO, 'ViT-L (best for Stable Diffusion 1.*)', 'best'],
+        'max_input_size': 768,
         'out_format': HuggingFaceFormat.TEXT,
         'fn_index': 3,
+        'cache': True,
     })
 
 
@@ -75,11 +87,7 @@ def command_chatbot_start(update: Update, context: CallbackContext) -> None:
         message = ('Started a new conversation. '
                    'Remember to quote any of my messages if you want me to reply. '
                    'You can restart the conversation by using /chatbot again.')
-    context.bot_data['chatbot_state'][update.message.chat.id] = {
-        'history': [],
-        'hash': get_random_string(11),
-        'message_ids': [update.message.reply_text(message).message_id],
-    }
+    context.bot_data['chatbot_state'].start(update.message.chat.id, update.message.reply_text(message).message_id)
 
 
 def command_chatbot_check(update: Update, context: CallbackContext) -> None:
@@ -91,12 +99,17 @@ def command_chatbot_check(update: Update, context: CallbackContext) -> None:
         return
     # do nothing if in public but they weren't quoting a chatbot response
     if update.message.chat.type != 'private' and (not hasattr(update.message, 'reply_to_message') or not state_exists or
-            update.message.reply_to_message.message_id not in context.bot_data['chatbot_state'][update.message.chat.id]['message_ids']):
+            not context.bot_data['chatbot_state'].is_chatbot_message(update.message.chat.id, update.message.reply_to_message.message_id)):
         return
 
-    previous_history = context.bot_data['chatbot_state'][update.message.chat.id]['history'] if state_exists else []
+    previous_history = context.bot_data['chatbot_state'].get_history(update.message.chat.id) if state_exists else []
 
-    conversation = huggingface(update, context, {
+    def save_history(future):
+        # don't save history if chatbot failed
+        if conversation := future.result():
+            context.bot_data['chatbot_state'].set_history(update.message.chat.id, conversation)
+
+    future = huggingface(update, context, {
         'name': 'ChatGML2-6B',
         'space': 'mikeee-chatglm2-6b-4bit',
         'in_format': [False,
@@ -109,9 +122,7 @@ def command_chatbot_check(update: Update, context: CallbackContext) -> None:
                       None,],
         'out_format': HuggingFaceFormat.CHATBOT,
         'quiet_progress': True,
-        'hash': context.bot_data['chatbot_state'][update.message.chat.id]['hash'],
+        'hash': context.bot_data['chatbot_state'].get_hash(update.message.chat.id),
     })
-
-    # don't save history if chatbot failed
-    if conversation:
-        context.bot_data['chatbot_state'][update.message.chat.id]['history'] = conversation
+    if future:
+        future.add_done_callback(save_history)
@@ -1,9 +1,16 @@
+import asyncio
+from base64 import b64encode
+from collections import OrderedDict
+from concurrent.futures import Future
 from enum import Enum, auto
+from functools import partial
+from hashlib import sha1
 import html
 import json
 from math import ceil
 import os
-import socket
+import random
+import threading
 import time
 
 from bs4 import BeautifulSoup
@@ -11,10 +18,11 @@ from telegram import Update
 from telegram.constants import MAX_MESSAGE_LENGTH, PARSEMODE_HTML
 from telegram.ext import CallbackContext
 from wand.image import Image
-import websocket
+import websockets
 
 from attachments import AttachmentType, download_attachment
-from utils import (create_gallery, get_command_args, get_url, get_random_string, image_from_b64, image_to_b64,
+from scheduler import fair_space
+from utils import (_config, create_gallery, get_command_args, get_random_string, image_from_b64,
                    is_admin, logger, requests_session)
 
 
@@ -26,6 +34,155 @@ class HuggingFaceFormat(Enum):
     CHATBOT = auto()
 
 
+class HuggingFaceRouter:
+    """keeps track of how every space is doing (queue eta from estimation messages
+    and success rate) to pick the best of a list of equivalent spaces. spaces that
+    fail too many times in a row are skipped for a while (circuit breaker)"""
+    ALPHA = .3
+    DEFAULT_ETA = 30
+
+    def __init__(self):
+        self.stats = {}
+
+    def _stats(self, space):
+        if space not in self.stats:
+            self.stats[space] = {'eta': self.DEFAULT_ETA, 'success_rate': 1., 'failures': 0, 'open_until': 0}
+        return self.stats[space]
+
+    def estimation(self, space, eta):
+        stats = self._stats(space)
+        stats['eta'] += self.ALPHA * (eta - stats['eta'])
+
+    def success(self, space):
+        stats = self._stats(space)
+        stats['success_rate'] += self.ALPHA * (1 - stats['success_rate'])
+        stats['failures'] = 0
+        stats['open_until'] = 0
+
+    def failure(self, space):
+        stats = self._stats(space)
+        stats['success_rate'] -= self.ALPHA * stats['success_rate']
+        stats['failures'] += 1
+        threshold = int(_config('hf_breaker_failures') or 3)
+        if stats['failures'] >= threshold:
+            backoff = min(30 * 2 ** (stats['failures'] - threshold),
+                          int(_config('hf_breaker_max_backoff') or 600))
+            stats['open_until'] = time.monotonic() + backoff
+            logger.info('%s failed %d times in a row, skipping it for %d seconds',
+                        space, stats['failures'], backoff)
+
+    def pick(self, spaces, exclude=()):
+        """returns the space with the best score, or None if there is none"""
+        candidates = [x for x in spaces if x not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        if closed := [x for x in candidates if self._stats(x)['open_until'] <= now]:
+            return min(closed, key=lambda x: self._stats(x)['eta'] / max(self._stats(x)['success_rate'], .1))
+        # every circuit is open: go with the one that will be retried first
+        return min(candidates, key=lambda x: self._stats(x)['open_until'])
+
+    def dump(self) -> str:
+        if self.stats:
+            return 'Spaces: ' + ', '.join(f'{space} eta={stats["eta"]:.0f}s ok={stats["success_rate"]:.2f}'
+                                          f'{" (open)" if stats["open_until"] > time.monotonic() else ""}'
+                                          for space, stats in self.stats.items())
+        return 'No spaces used yet.'
+
+
+space_router = HuggingFaceRouter()
+
+
+class HuggingFaceAttempt:
+    """a single try of a job in a specific space"""
+    def __init__(self, space, slow=None):
+        self.space = space
+        # set when the queue of this space looks too long, so a hedge can be started
+        self.slow = slow
+        self.results = None
+
+
+class HuggingFaceUpload:
+    """an image that is sent to a space. it's kept in binary form across refeeds and
+    only turned into base64 (or uploaded as a file) when a request is serialized"""
+    def __init__(self, blob, mime):
+        self.blob = blob
+        self.mime = mime
+        self._b64 = None
+        # paths of the file in every space it has been uploaded to
+        self.paths = {}
+
+    @classmethod
+    def prepare(cls, blob, max_size):
+        """downsizes an image to the max size the space accepts. images that are
+        small enough already are sent as they are, otherwise they are encoded once"""
+        start = time.perf_counter()
+        # ping only reads the headers, no need to decode the whole thing
+        with Image.ping(blob=blob) as image:
+            format_ = image.format
+            fits = image.width <= max_size and image.height <= max_size
+        if fits and format_ in ('JPEG', 'PNG'):
+            upload = cls(blob, f'image/{format_.lower()}')
+        else:
+            with Image(blob=blob) as image:
+                image.transform(resize=f'{max_size}x{max_size}>')
+                image.compression_quality = int(_config('hf_upload_quality') or 90)
+                upload = cls(image.make_blob(format='jpeg'), 'image/jpeg')
+        logger.info('prepared upload: %d -> %d bytes in %.1f ms',
+                    len(blob), len(upload.blob), (time.perf_counter() - start) * 1000)
+        return upload
+
+    @property
+    def b64(self):
+        if not self._b64:
+            self._b64 = f'data:{self.mime};base64,' + b64encode(self.blob).decode('utf-8')
+        return self._b64
+
+    async def upload(self, space):
+        """uploads the image to a space that supports file uploads"""
+        if space not in self.paths:
+            boundary = get_random_string(32)
+            body = (f'--{boundary}\r\n'
+                    f'Content-Disposition: form-data; name="files"; filename="image.{self.mime.split("/")[1]}"\r\n'
+                    f'Content-Type: {self.mime}\r\n\r\n').encode() + self.blob + f'\r\n--{boundary}--\r\n'.encode()
+            r = await asyncio.get_running_loop().run_in_executor(None, partial(
+                requests_session.post, f'https://{space}.hf.space/upload', data=body,
+                headers={'Content-Type': f'multipart/form-data; boundary={boundary}'}
+            ))
+            self.paths[space] = r.json()[0]
+            logger.info('uploaded %d bytes to %s', len(self.blob), space)
+        return {'name': self.paths[space], 'data': None, 'is_file': True}
+
+
+class ChatbotStream:
+    """decides when a partial chatbot answer is worth an edit. the answer is only
+    parsed when an edit is actually going to be sent: when it has grown enough or
+    reached the end of a sentence, and the chat hasn't been edited too recently"""
+    SENTENCE_ENDS = ('.', '!', '?', ':', '</p>', '<br>')
+    # chat_id -> time of the last streamed edit, shared by every stream in a chat
+    last_edit = {}
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.sent_length = 0
+        self.min_chars = int(_config('chatbot_stream_min_chars') or 40)
+        self.interval = float(_config('chatbot_stream_interval') or _config('edits_cron_interval') or 5)
+
+    def feed(self, answer: str) -> str:
+        """returns the text to edit the message with, or None if it's not worth it"""
+        new_chars = len(answer) - self.sent_length
+        if new_chars <= 0:
+            return None
+        if new_chars < self.min_chars and not answer.rstrip().endswith(self.SENTENCE_ENDS):
+            return None
+        now = time.monotonic()
+        if now - self.last_edit.get(self.chat_id, 0) < self.interval:
+            return None
+        self.last_edit[self.chat_id] = now
+        self.sent_length = len(answer)
+        return HuggingFace.chatbot_parse_html(answer) + '[…]'
+
+
 class HuggingFace:
     def __init__(self, edits, progress_msg, data):
         self.edits = edits
@@ -35,6 +192,8 @@ class HuggingFace:
         self.results = None
         self.hash = self.data.get('hash') or get_random_string(11)
         self.progress = 1
+        if self.data['out_format'] == HuggingFaceFormat.CHATBOT and self.progress_msg:
+            self.stream = ChatbotStream(self.progress_msg.chat_id)
 
     @property
     def name(self):
@@ -55,56 +214,134 @@ class HuggingFace:
                 ret += html.escape(node.text)
         return ret.strip()
 
-
-class HuggingFaceWS(HuggingFace):
-    def run(self):
+    async def run(self):
         for _ in range(self.data['times']):
-            while True:
-                ws = websocket.WebSocketApp(f'wss://{self.data["space"]}.hf.space/queue/join',
-                                            on_message=self.on_message, on_open=self.on_open, on_close=self.on_close)
-                ws.run_forever(origin=f'https://{self.data["space"]}.hf.space', sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),))
-
-                if self.results == 'queue_full' and self.progress_msg:
-                    self.edits.append_edit(self.progress_msg, (f'{self.name}: queue is full, this is going to take a while.'))
-                else:
-                    break
+            self.results = await self.run_once()
 
             if self.data['times'] > 1:
-                # refeed
-                self.progress += 1
-                for k, v in enumerate(self.data['in_format']):
-                    if isinstance(v, str) and v.startswith('data:'):
-                        # some effects increase the size of an image. don't let it get out of hand
-                        with Image(blob=image_from_b64(self.results)) as image:
-                            if image.width > 1280 or image.height > 1280:
-                                image.transform(resize='1280x1280>')
-                                self.results = image_to_b64(image.make_blob(format='jpeg'))
-                        self.data['in_format'][k] = self.results
+                # wand is slow, don't block the loop
+                await asyncio.get_running_loop().run_in_executor(None, self.refeed)
 
         return self.results
 
-    def on_open(self, ws):
+    async def run_once(self):
+        """runs one iteration in the best space available. if its queue is too long
+        and there are mirrors, the same request is sent to a second space and
+        whichever finishes first wins"""
+        spaces = [self.data['space']] + self.data.get('mirrors', [])
+        can_hedge = len(spaces) > 1 and self.data['out_format'] != HuggingFaceFormat.CHATBOT
+        delay = 1
+        while True:
+            primary = HuggingFaceAttempt(space_router.pick(spaces), asyncio.Event() if can_hedge else None)
+            tasks = {asyncio.create_task(self.attempt(primary)): primary}
+
+            if can_hedge:
+                slow = asyncio.create_task(primary.slow.wait())
+                await asyncio.wait([slow, *tasks], return_when=asyncio.FIRST_COMPLETED)
+                slow.cancel()
+                if primary.slow.is_set() and (space := space_router.pick(spaces, exclude=(primary.space,))):
+                    logger.info('%s: queue in %s is too long, also trying %s', self.name, primary.space, space)
+                    hedge = HuggingFaceAttempt(space)
+                    tasks[asyncio.create_task(self.attempt(hedge))] = hedge
+
+            results = None
+            for task in asyncio.as_completed(tasks):
+                results = await task
+                if results and results != 'queue_full':
+                    break
+            for task in tasks:
+                task.cancel()
+
+            if results == 'queue_full':
+                if self.progress_msg:
+                    self.edits.append_edit(self.progress_msg, (f'{self.name}: queue is full, this is going to take a while.'))
+                await asyncio.sleep(delay * random.uniform(.5, 1.5))
+                delay = min(delay * 2, 60)
+                continue
+
+            if results:
+                # files have to be downloaded from the space that generated them
+                self.data['result_space'] = next(x.space for x in tasks.values() if x.results is results)
+            return results
+
+    async def attempt(self, attempt):
+        """runs an iteration in the space of this attempt and keeps the router
+        informed. returns the results, 'queue_full' or None"""
+        try:
+            await self.predict(attempt)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('%s: failed in %s', self.name, attempt.space)
+            attempt.results = None
+        if attempt.results and attempt.results != 'queue_full':
+            space_router.success(attempt.space)
+        else:
+            space_router.failure(attempt.space)
+        return attempt.results
+
+    def estimation(self, attempt, eta):
+        space_router.estimation(attempt.space, eta)
+        if attempt.slow and eta > int(_config('hf_hedge_eta') or 120):
+            attempt.slow.set()
+
+    async def payload(self, attempt):
+        """returns the input ready to be sent to the space of the attempt"""
+        payload = []
+        for v in self.data['in_format']:
+            if isinstance(v, HuggingFaceUpload):
+                v = await v.upload(attempt.space) if self.data.get('file_upload') else v.b64
+            payload.append(v)
+        return payload
+
+    def refeed(self):
+        """feeds the results of the last iteration back into the input"""
+        self.progress += 1
+        for k, v in enumerate(self.data['in_format']):
+            if isinstance(v, HuggingFaceUpload):
+                # some effects increase the size of an image. don't let it get out of hand
+                self.data['in_format'][k] = HuggingFaceUpload.prepare(image_from_b64(self.results),
+                                                                      self.data.get('max_input_size') or 1280)
+
+
+class HuggingFaceWS(HuggingFace):
+    QUEUE_URL = 'wss://{space}.hf.space/queue/join'
+    ORIGIN = 'https://{space}.hf.space'
+
+    async def predict(self, attempt):
+        try:
+            async with websockets.connect(self.QUEUE_URL.format(space=attempt.space),
+                                          origin=self.ORIGIN.format(space=attempt.space),
+                                          max_size=None) as ws:
+                await self.on_open(ws)
+                async for message in ws:
+                    await self.on_message(ws, message, attempt)
+        except (OSError, websockets.WebSocketException) as exc:
+            logger.info('%s: connection error: %s', self.name, exc)
+        logger.info('%s: socket closed', self.name)
+
+    async def on_open(self, ws):
         logger.info('%s: connected', self.name)
         self.edits.append_edit(self.progress_msg, (f'{self.name}: connected.'))
         if self.data.get('hash_on_open'):
             logger.info('%s: sending on_open hash', self.name)
-            ws.send(json.dumps({'hash': self.hash}))
+            await ws.send(json.dumps({'hash': self.hash}))
 
-    def on_close(self, *_):
-        logger.info('%s: socket closed', self.name)
-
-    def on_message(self, ws, message):
+    async def on_message(self, ws, message, attempt):
         message = json.loads(message)
         if message['msg'] == 'send_data':
             logger.info('%s asked for data', self.name)
-            ws.send(json.dumps({
+            payload = json.dumps({
                 'fn_index': self.data['fn_index'],
-                'data': self.data['in_format'],
+                'data': await self.payload(attempt),
                 'session_hash': self.hash
-            }))
+            })
+            logger.info('%s: sending %d bytes', self.name, len(payload))
+            await ws.send(payload)
         elif message['msg'] == 'estimation':
             if message.get('rank') and message.get('rank_eta'):
                 logger.info('%s says we are at rank %d with %d seconds left', self.name, message['rank'], message['rank_eta'])
+                self.estimation(attempt, message['rank_eta'])
                 time_left = f'{ceil(message["rank_eta"] / 60)} minutes' if message['rank_eta'] > 60 else f'{ceil(message["rank_eta"])} seconds'
                 if self.progress_msg and not self.data.get('quiet_progress'):
                     self.edits.append_edit(self.progress_msg, (f'{self.name}: in queue, {time_left} left…'))
@@ -117,77 +354,144 @@ class HuggingFaceWS(HuggingFace):
                 self.edits.append_edit(self.progress_msg, (f'{self.name}: generating…'))
         elif message['msg'] == 'process_generating':
             if self.data['out_format'] == HuggingFaceFormat.CHATBOT and self.progress_msg:
-                self.edits.append_edit(self.progress_msg, HuggingFace.chatbot_parse_html(message['output']['data'][0][-1][-1]) + '[…]')
+                # the final answer is always sent when the process is completed
+                if text := self.stream.feed(message['output']['data'][0][-1][-1]):
+                    self.edits.append_edit(self.progress_msg, text)
         elif message['msg'] == 'process_completed':
             logger.info("%s says it's done", self.name)
             try:
-                self.results = message['output']['data'][0]
+                attempt.results = message['output']['data'][0]
             except KeyError:
                 logger.exception('wrong set of results: %s', message)
-                self.results = None
-            ws.close()
+                attempt.results = None
+            await ws.close()
         elif message['msg'] == 'queue_full':
             logger.info('%s says queue is full', self.name)
-            self.results = message['msg']
-            ws.close()
+            attempt.results = message['msg']
+            await ws.close()
         elif message['msg'] == 'send_hash':
-            ws.send(json.dumps({'fn_index': self.data['fn_index'], 'session_hash': self.hash}))
+            await ws.send(json.dumps({'fn_index': self.data['fn_index'], 'session_hash': self.hash}))
         else:
             logger.info('unhandled message %s', message)
 
 
 class HuggingFacePush(HuggingFace):
-    def run(self):
-        for _ in range(self.data['times']):
-            logger.info('%s: getting hash', self.name)
-            r = requests_session.post(f'https://{self.data["space"]}.hf.space/api/queue/push/', json={
-                'fn_index': self.data['fn_index'],
-                'data': self.data['in_format'],
-                'action': 'predict',
-                'session_hash': self.hash,
-            }).json()
-            hash_ = r['hash']
-
-            while True:
-                r = requests_session.post(f'https://{self.data["space"]}.hf.space/api/queue/status/', json={
-                    'hash': hash_,
-                }).json()
-
-                if r['status'] == 'COMPLETE':
-                    logger.info('%s: complete', self.name)
-                    if self.data['out_format'] in (HuggingFaceFormat.PHOTO, HuggingFaceFormat.TEXT):
-                        self.results = r['data']['data'][0]
-                        break
-                    # TODO more formats
-                    raise ValueError('unknown output format')
-                elif r['status'] == 'PENDING':
-                    logger.info('%s: pending', self.name)
-                    self.edits.append_edit(self.progress_msg, (f'{self.name}: pending…'))
-                elif r['status'] == 'QUEUED':
-                    logger.info('%s: in queue', self.name)
-                    self.edits.append_edit(self.progress_msg, (f'{self.name}: queued…'))
-                else:
-                    logger.info('%s: unknown status "%s"', self.name, r['status'])
+    async def post(self, attempt, endpoint, payload):
+        """posts using the shared session (and its pooled connections) without
+        blocking the loop"""
+        return (await asyncio.get_running_loop().run_in_executor(None, partial(
+            requests_session.post, f'https://{attempt.space}.hf.space/api/queue/{endpoint}/', json=payload
+        ))).json()
+
+    async def predict(self, attempt):
+        logger.info('%s: getting hash', self.name)
+        r = await self.post(attempt, 'push', {
+            'fn_index': self.data['fn_index'],
+            'data': await self.payload(attempt),
+            'action': 'predict',
+            'session_hash': self.hash,
+        })
+        hash_ = r['hash']
+
+        while True:
+            r = await self.post(attempt, 'status', {
+                'hash': hash_,
+            })
+
+            if r['status'] == 'COMPLETE':
+                logger.info('%s: complete', self.name)
+                if self.data['out_format'] in (HuggingFaceFormat.PHOTO, HuggingFaceFormat.TEXT):
+                    attempt.results = r['data']['data'][0]
+                    return
+                # TODO more formats
+                raise ValueError('unknown output format')
+            elif r['status'] == 'PENDING':
+                logger.info('%s: pending', self.name)
+                self.edits.append_edit(self.progress_msg, (f'{self.name}: pending…'))
+            elif r['status'] == 'QUEUED':
+                logger.info('%s: in queue', self.name)
+                self.edits.append_edit(self.progress_msg, (f'{self.name}: queued…'))
+            else:
+                logger.info('%s: unknown status "%s"', self.name, r['status'])
 
-                time.sleep(.5)
+            await asyncio.sleep(.5)
 
-            if self.data['times'] > 1:
-                # refeed
-                self.progress += 1
-                for k, v in enumerate(self.data['in_format']):
-                    if isinstance(v, str) and v.startswith('data:'):
-                        # some effects increase the size of an image. don't let it get out of hand
-                        with Image(blob=image_from_b64(self.results)) as image:
-                            if image.width > 1280 or image.height > 1280:
-                                image.transform(resize='1280x1280>')
-                                self.results = image_to_b64(image.make_blob(format='jpeg'))
-                        self.data['in_format'][k] = self.results
 
-        return self.results
+class HuggingFaceCache:
+    """keeps the results of deterministic spaces for a while. it also keeps track
+    of the jobs that are running so identical requests can share the same job"""
+    def __init__(self):
+        self.results = OrderedDict()
+        # this one is only touched from the loop, so it doesn't need the lock
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(data) -> str:
+        """space, function and a hash of the resolved input"""
+        payload = json.dumps([data['in_format'], data['times']], sort_keys=True,
+                             default=lambda x: sha1(x.blob).hexdigest()).encode('utf8')
+        return f'{data["space"]}#{data.get("fn_index") or 0}#{sha1(payload).hexdigest()}'
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.results:
+                return None
+            stored_at, result = self.results[key]
+            if time.monotonic() - stored_at > int(_config('hf_cache_ttl') or 3600):
+                del self.results[key]
+                return None
+            self.results.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.results[key] = (time.monotonic(), result)
+            self.results.move_to_end(key)
+            while len(self.results) > int(_config('hf_cache_max_entries') or 100):
+                self.results.popitem(last=False)
+
+
+cache = HuggingFaceCache()
+# all the jobs run in this loop, in a thread of its own, so a job waiting for its
+# turn in a queue doesn't keep a dispatcher worker busy
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, name='huggingface', daemon=True).start()
+
+
+async def _run(job, update: Update, context: CallbackContext, progress_msg, key=None):
+    """runs a job in the loop and hands over the results to a worker thread. if
+    there is already a job running for the same key, waits for that one instead"""
+    if key in cache.in_flight:
+        logger.info('%s: identical request in flight, sharing its results', job.name)
+        try:
+            result = await asyncio.shield(cache.in_flight[key])
+        except Exception:
+            result = None
+    else:
+        task = loop.create_task(job.run())
+        if key:
+            cache.in_flight[key] = task
+        try:
+            result = await task
+        except Exception:
+            logger.exception('%s: job failed', job.name)
+            result = None
+        finally:
+            cache.in_flight.pop(key, None)
+        if key and result:
+            cache.put(key, result)
+    try:
+        await loop.run_in_executor(None, _deliver, update, context, job.data, progress_msg, result)
+    except Exception:
+        logger.exception('%s: failed to deliver the results', job.name)
+    return result
 
 
-def huggingface(update: Update, context: CallbackContext, data) -> None:
-    """huggingface generic implementation"""
+def huggingface(update: Update, context: CallbackContext, data) -> Future:
+    """huggingface generic implementation. submits the job and returns right away
+    with a future that resolves to the results, or None if the job could not be
+    submitted"""
     # first, we have to check if we have what we need as specified by the format
     for k, v in enumerate(data['in_format']):
         if v == HuggingFaceFormat.PHOTO:
@@ -196,7 +500,7 @@ def huggingface(update: Update, context: CallbackContext, data) -> None:
                 update.message.reply_text('This command requires a photo. Post or quote one.')
                 return
             with open(photo, 'rb') as fp:
-                data['in_format'][k] = image_to_b64(fp.read())
+                data['in_format'][k] = HuggingFaceUpload.prepare(fp.read(), data.get('max_input_size') or 1280)
             os.remove(photo)
         elif v == HuggingFaceFormat.TEXT:
             data['in_format'][k] = get_command_args(update, use_quote=data['out_format'] != HuggingFaceFormat.CHATBOT)
@@ -213,6 +517,14 @@ def huggingface(update: Update, context: CallbackContext, data) -> None:
         except (TypeError, ValueError):
             pass
 
+    key = HuggingFaceCache.key(data) if data.get('cache') else None
+    if key and (result := cache.get(key)):
+        logger.info('%s: cache hit', data['name'])
+        _deliver(update, context, data, None, result)
+        future = Future()
+        future.set_result(result)
+        return future
+
     progress_msg = update.message.reply_text(
         '[…]' if data.get('quiet_progress') else f'{data["name"]}: connecting…',
         quote=False
@@ -221,12 +533,49 @@ def huggingface(update: Update, context: CallbackContext, data) -> None:
 
     # if chatbot, add immediately to list of chatbot messages in this chat
     if data['out_format'] == HuggingFaceFormat.CHATBOT:
-        context.bot_data['chatbot_state'][update.message.chat.id]['message_ids'].append(progress_msg.message_id)
+        context.bot_data['chatbot_state'].add_message_id(update.message.chat.id, progress_msg.message_id)
 
-    cls = HuggingFacePush if data.get('method') == 'push' else HuggingFaceWS
-    result = cls(context.bot_data['edits'], progress_msg, data).run()
+    # chatbot replies are short and someone is waiting for them, so they go straight
+    # to the loop. everything else waits for its turn in the queue of its space, so a
+    # user asking for many runs doesn't hold up everyone else
+    if data['out_format'] == HuggingFaceFormat.CHATBOT:
+        cls = HuggingFacePush if data.get('method') == 'push' else HuggingFaceWS
+        job = cls(context.bot_data['edits'], progress_msg, data)
+        return asyncio.run_coroutine_threadsafe(_run(job, update, context, progress_msg, key), loop)
+
+    # the job is only submitted to the loop when it may start
+    scheduler = fair_space(data['space'])
+    future = Future()
+
+    def done(job_future):
+        scheduler.release()
+        if job_future.exception():
+            future.set_exception(job_future.exception())
+        else:
+            future.set_result(job_future.result())
 
-    context.bot_data['edits'].flush_edits(progress_msg)
+    def start():
+        try:
+            cls = HuggingFacePush if data.get('method') == 'push' else HuggingFaceWS
+            job = cls(context.bot_data['edits'], progress_msg, data)
+            job_future = asyncio.run_coroutine_threadsafe(_run(job, update, context, progress_msg, key), loop)
+        except Exception as exc:
+            # the scheduler releases the slot
+            future.set_exception(exc)
+            raise
+        job_future.add_done_callback(done)
+
+    if not scheduler.submit(update.message.from_user.id, update.message.chat_id, data['times'], start):
+        progress_msg.edit_text('You have too many requests waiting. Try again in a while.')
+        return None
+    return future
+
+
+def _deliver(update: Update, context: CallbackContext, data, progress_msg, result) -> None:
+    """sends the results of a job once it's done. progress_msg is None if the
+    results come from the cache"""
+    if progress_msg:
+        context.bot_data['edits'].flush_edits(progress_msg)
 
     if result:
         if data['out_format'] == HuggingFaceFormat.PHOTO:
@@ -234,7 +583,7 @@ def huggingface(update: Update, context: CallbackContext, data) -> None:
         elif data['out_format'] == [HuggingFaceFormat.PHOTO]:
             if isinstance(result[0], list) and result[0].get('is_file'):
                 # TODO actually implement this
-                result = [get_url(f'https://{data["space"]}.hf.space/file={path}') for path in result['images']]
+                result = [f'https://{data["result_space"]}.hf.space/file={path}' for path in result['images']]
             else:
                 result = [image_from_b64(x) for x in result]
         elif data['out_format'] in (HuggingFaceFormat.TEXT, HuggingFaceFormat.CHATBOT):
@@ -251,15 +600,12 @@ def huggingface(update: Update, context: CallbackContext, data) -> None:
                 else:
                     update.message.reply_photo(result)
         elif data['out_format'] == [HuggingFaceFormat.PHOTO]:
-            images = [Image(blob=image) for image in result]
-            update.message.reply_photo(create_gallery(images))
+            update.message.reply_photo(create_gallery(result))
         elif data['out_format'] == HuggingFaceFormat.TEXT:
             update.message.reply_text(result[:MAX_MESSAGE_LENGTH])
         elif data['out_format'] == HuggingFaceFormat.CHATBOT:
             progress_msg.edit_text(HuggingFace.chatbot_parse_html(result[-1][-1][:MAX_MESSAGE_LENGTH]), parse_mode=PARSEMODE_HTML)
-        if data['out_format'] != HuggingFaceFormat.CHATBOT:
+        if data['out_format'] != HuggingFaceFormat.CHATBOT and progress_msg:
             progress_msg.delete()
     else:
         progress_msg.edit_text(f'{data["name"]}: failed.')
-
-    return result
@@ -1,56 +1,97 @@
+from collections import deque
+import queue
+import threading
+import time
+
 from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.error import BadRequest
 
+from utils import logger
+
 
 class Actions:
-    """this class handles all chat actions: stores thems and sends them
-    periodically using a cron method"""
-    def __init__(self, bot, job_queue, actions_cron_interval):
-        self.pending_actions = []
+    """this class handles all chat actions (typing, sending a photo...). every chat
+    has a refcounted set of actions and the latest one wins. a background thread
+    sends them and repeats them while they last, so handlers never wait for the api"""
+    # telegram shows an action for 5 seconds
+    LIFETIME = 5
+
+    def __init__(self, bot, interval):
         self.bot = bot
-        self.job_queue = job_queue
-        self.actions_cron_interval = actions_cron_interval
+        # repeat the current action this often, or never if 0
+        self.interval = min(interval, self.LIFETIME)
+        # chat_id -> {action: refcount}, the latest action last
+        self.chats = {}
+        # chat_id -> when its current action has to be sent
+        self.due = {}
+        # chat_id -> (action, when it was sent)
+        self.sent = {}
+        self.condition = threading.Condition()
+        threading.Thread(target=self.sender, name='actions', daemon=True).start()
 
     def append(self, chat_id, action):
-        self.pending_actions.append((chat_id, action))
-        # send it immediately - don't wait for next cron
-        self.bot.send_chat_action(chat_id=chat_id, action=action)
-        if self.actions_cron_interval > 0:
-            self.job_queue.get_jobs_by_name('actions')[0].enabled = True
+        with self.condition:
+            actions = self.chats.setdefault(chat_id, {})
+            actions[action] = actions.pop(action, 0) + 1
+            action_, sent_at = self.sent.get(chat_id, (None, 0))
+            # the same action is still showing, so there is no need to send it again
+            if action_ != action or time.monotonic() - sent_at >= self.LIFETIME:
+                self.due[chat_id] = time.monotonic()
+                self.condition.notify()
 
     def remove(self, chat_id, action):
-        try:
-            self.pending_actions.remove((chat_id, action))
-        except ValueError:
-            pass
-        if self.actions_cron_interval > 0 and len(self.pending_actions) == 0:
-            self.job_queue.get_jobs_by_name('actions')[0].enabled = False
-
-        # sending a message clears the current action, so check if there are
-        # more actions for this chat_id and send the latest one immediately
-        # (the same thing cron does) -- a small delay is necessary, otherwise
-        # this won't work, so we need the job queue
-        if chat_id in dict(self.pending_actions):
-            self.job_queue.run_once(
-                lambda context: self.bot.send_chat_action(chat_id=context.job.context[0],
-                                                          action=context.job.context[1]),
-                .1,  # 100 msec
-                context=(chat_id, dict(self.pending_actions)[chat_id])
-            )
+        with self.condition:
+            actions = self.chats.get(chat_id, {})
+            if action in actions:
+                actions[action] -= 1
+                if not actions[action]:
+                    del actions[action]
+            if actions:
+                # sending a message clears the current action, so send the latest
+                # one again. it needs a small delay, otherwise it won't show
+                self.due[chat_id] = time.monotonic() + .1
+                self.sent.pop(chat_id, None)
+                self.condition.notify()
+            else:
+                self.chats.pop(chat_id, None)
+                self.due.pop(chat_id, None)
+                self.sent.pop(chat_id, None)
 
     def flush(self):
-        self.pending_actions = []
+        with self.condition:
+            self.chats = {}
+            self.due = {}
+            self.sent = {}
 
-    def cron(self, _):
-        """checks which chats have pending actions (typing/sending photo) and
-        sends them"""
-        # turn it into a dict so there is only one value per key
-        for chat_id, action in dict(self.pending_actions).items():
-            self.bot.send_chat_action(chat_id=chat_id, action=action)
+    def sender(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                while not self.due or min(self.due.values()) > now:
+                    self.condition.wait(min(self.due.values()) - now if self.due else None)
+                    now = time.monotonic()
+                pending = []
+                for chat_id, due in list(self.due.items()):
+                    if due > now:
+                        continue
+                    action = next(reversed(self.chats[chat_id]))
+                    pending.append((chat_id, action))
+                    self.sent[chat_id] = (action, now)
+                    if self.interval > 0:
+                        self.due[chat_id] = now + self.interval
+                    else:
+                        del self.due[chat_id]
+            for chat_id, action in pending:
+                try:
+                    self.bot.send_chat_action(chat_id=chat_id, action=action)
+                except:
+                    # generally fails because of ratelimits or the bot being kicked
+                    logger.info("couldn't send %s to %d", action, chat_id)
 
     def dump(self) -> str:
-        if self.pending_actions:
-            return f'Pending actions: {self.pending_actions}'
+        with self.condition:
+            if self.chats:
+                return f'Pending actions: {self.chats}'
         return 'No pending actions.'
 
 
@@ -119,3 +160,65 @@ class Edits:
             edits = {f'{x[0].message_id}@{x[0].chat_id}': x[1] for x in self.pending_edits}
             return f'Pending edits: {edits}'
         return 'No pending edits.'
+
+
+class Relays:
+    """this class runs relayed messages in order. every source chat gets its own
+    fifo queue so messages are posted in the order they were sent, and different
+    chats are handled in parallel by a fixed number of workers"""
+    def __init__(self, sources, max_workers, max_queued):
+        self.queues = {chat_id: deque() for chat_id in sources}
+        self.max_queued = max_queued
+        self.rejected = 0
+        # chats that are either waiting in self.ready or being handled by a worker,
+        # along with the time the item currently being handled was queued
+        self.busy = {}
+        self.lock = threading.Lock()
+        self.ready = queue.Queue()
+        for i in range(max_workers):
+            threading.Thread(target=self.worker, name=f'relay_{i}', daemon=True).start()
+
+    def append(self, chat_id, fun, *args) -> bool:
+        """queues a message. returns False, and drops it, if there are too many
+        queued already"""
+        with self.lock:
+            if (queued := sum(len(x) for x in self.queues.values())) >= self.max_queued:
+                self.rejected += 1
+                logger.warning('%d relayed messages queued, dropping one from %d (%d dropped so far)',
+                               queued, chat_id, self.rejected)
+                return False
+            self.queues[chat_id].append((time.monotonic(), fun, args))
+            # if the chat is busy, the worker handling it will requeue it when done
+            if chat_id not in self.busy:
+                self.busy[chat_id] = None
+                self.ready.put(chat_id)
+        return True
+
+    def worker(self):
+        while True:
+            chat_id = self.ready.get()
+            with self.lock:
+                queued_at, fun, args = self.queues[chat_id].popleft()
+                self.busy[chat_id] = queued_at
+            try:
+                fun(*args)
+            except:
+                logger.exception('error relaying a message from %d', chat_id)
+            with self.lock:
+                # go to the back of the line so other chats get their turn
+                if self.queues[chat_id]:
+                    self.ready.put(chat_id)
+                else:
+                    del self.busy[chat_id]
+
+    def dump(self) -> str:
+        now = time.monotonic()
+        lines = []
+        with self.lock:
+            for chat_id, items in self.queues.items():
+                oldest = self.busy.get(chat_id) or (items[0][0] if items else None)
+                lag = now - oldest if oldest else 0
+                lines.append(f'{chat_id}: {len(items)} queued, {lag:.1f}s lag')
+        if lines:
+            return f'Relays ({self.rejected} rejected):\n' + '\n'.join(lines)
+        return 'No relays.'
@@ -8,7 +8,16 @@ from telegram.ext import CallbackContext
 
 from distort import sub_distort, sub_invert
 from translate import get_scramble_languages, sub_translate
-from utils import _config, ellipsis, get_random_string, get_relays, get_user_fullname, logger
+from utils import _config, ellipsis, get_random_string, get_relays, get_user_fullname
+
+
+def queued(fun):
+    """wraps a relay handler so that, instead of running right away, the update is
+    appended to the queue of the chat it comes from and handled in order"""
+    def callback(update: Update, context: CallbackContext) -> None:
+        # messages over the limit are dropped and logged by the queue
+        context.bot_data['relays'].append(update.message.chat_id, fun, update, context)
+    return callback
 
 
 def command_relay_text(update: Update, context: CallbackContext) -> None:
@@ -0,0 +1,336 @@
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+import os
+import threading
+import time
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from utils import _config, logger
+
+
+class Pool:
+    """a fixed number of workers for one kind of work, with a limit of jobs that can
+    be waiting. jobs over the limit are rejected right away instead of queueing
+    behind everything else"""
+    def __init__(self, name: str, max_workers: int, max_queued: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, fun, *args) -> bool:
+        """runs fun in the pool. returns False if the pool is saturated"""
+        with self.lock:
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                return False
+            self.queued += 1
+
+        def run():
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                fun(*args)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        self.executor.submit(run)
+        return True
+
+    def dump(self) -> str:
+        with self.lock:
+            return (f'{self.name}: {self.running}/{self.max_workers} running, '
+                    f'{self.queued}/{self.max_queued} queued, {self.completed} done, '
+                    f'{self.rejected} rejected')
+
+
+DEFAULTS = {
+    # wand and anything else that keeps a cpu busy. one more worker than distort can
+    # use at a time, so other commands still get one
+    'cpu': (int(_config('distort_max_concurrent') or 3) + 1, 8),
+    # ffmpeg and other external programs
+    'subprocess': (2, 8),
+    # scrapes and remote apis that mostly wait on the network
+    'network': (8, 32),
+}
+pools = {name: Pool(name, int(_config(f'pool_{name}_workers') or workers),
+                    int(_config(f'pool_{name}_queue') or queued))
+         for name, (workers, queued) in DEFAULTS.items()}
+
+
+def pooled(name: str, fun):
+    """wraps a handler so it runs in one of the pools instead of the pool of the
+    dispatcher. if that pool is saturated, the user is told to try later"""
+    pool = pools[name]
+
+    def run(update: Update, context: CallbackContext) -> None:
+        try:
+            fun(update, context)
+        except Exception as exc:
+            context.dispatcher.dispatch_error(update, exc)
+
+    @wraps(fun)
+    def callback(update: Update, context: CallbackContext) -> None:
+        if not pool.submit(run, update, context):
+            logger.info('%s pool is saturated, rejecting %s', name, fun.__name__)
+            if update.message:
+                update.message.reply_text("I'm busy right now. Try again in a while.")
+    return callback
+
+
+class FairScheduler:
+    """decides who goes next for an expensive resource. every user and every chat
+    has a bucket of credits that refills over time, and a job can only start if
+    both can pay for its estimated cost. waiting jobs are served round-robin
+    across users, so a user with a dozen jobs queued can't hold up everyone else.
+    no thread waits for its turn: jobs are handed over only when they may start"""
+    def __init__(self, name: str, max_running: int, capacity: float, refill: float, max_waiting: int):
+        self.name = name
+        self.max_running = max_running
+        self.capacity = capacity
+        # credits per second
+        self.refill = refill
+        # per user
+        self.max_waiting = max_waiting
+        self.condition = threading.Condition()
+        # user or chat -> [credits, last refill]
+        self.buckets = {}
+        # user_id -> deque of waiting jobs as [chat_id, cost, start]. the order of
+        # the users is the order they will be served in
+        self.queues = OrderedDict()
+        self.running = 0
+        self.served = 0
+        self.rejected = 0
+        threading.Thread(target=self.refiller, name=f'fair_{name}', daemon=True).start()
+
+    def credits(self, key) -> float:
+        now = time.monotonic()
+        bucket = self.buckets.setdefault(key, [self.capacity, now])
+        bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill)
+        bucket[1] = now
+        return bucket[0]
+
+    def next_job(self):
+        """returns the user and the first waiting job, in round-robin order, that can
+        be paid for"""
+        for user_id, jobs in self.queues.items():
+            chat_id, cost, _ = jobs[0]
+            if self.credits(('user', user_id)) >= cost and self.credits(('chat', chat_id)) >= cost:
+                return user_id, jobs[0]
+        return None
+
+    def submit(self, user_id: int, chat_id: int, cost: float, start) -> bool:
+        """queues a job. start is called when it's the job's turn, and must not block;
+        release has to be called once the job is done, unless start raises. returns
+        False if the user has too many jobs waiting already"""
+        with self.condition:
+            jobs = self.queues.setdefault(user_id, deque())
+            if len(jobs) >= self.max_waiting:
+                self.rejected += 1
+                return False
+            # jobs over the capacity would never start otherwise
+            jobs.append([chat_id, min(cost, self.capacity), start])
+            self.condition.notify()
+        self.dispatch()
+        return True
+
+    def dispatch(self) -> None:
+        """starts every waiting job that can start now"""
+        started = []
+        with self.condition:
+            while self.running < self.max_running and (found := self.next_job()):
+                user_id, (chat_id, cost, start) = found
+                jobs = self.queues.pop(user_id)
+                jobs.popleft()
+                if jobs:
+                    # the user goes to the back of the line
+                    self.queues[user_id] = jobs
+                self.buckets[('user', user_id)][0] -= cost
+                self.buckets[('chat', chat_id)][0] -= cost
+                self.running += 1
+                self.served += 1
+                started.append(start)
+        for start in started:
+            try:
+                start()
+            except:
+                logger.exception("couldn't start a %s job", self.name)
+                self.release()
+
+    def release(self, user_id: int = None, chat_id: int = None, refund: float = 0) -> None:
+        """frees the slot of a job. jobs that never ran can give back what they cost"""
+        with self.condition:
+            self.running -= 1
+            if refund:
+                for key in (('user', user_id), ('chat', chat_id)):
+                    self.buckets[key][0] = min(self.capacity, self.credits(key) + refund)
+        self.dispatch()
+
+    def refiller(self) -> None:
+        """credits refill over time, so waiting jobs are checked again every second"""
+        while True:
+            with self.condition:
+                while not self.queues:
+                    self.condition.wait()
+                self.condition.wait(timeout=1)
+            self.dispatch()
+
+    def dump(self) -> str:
+        with self.condition:
+            waiting = sum(len(x) for x in self.queues.values())
+            return (f'{self.name}: {self.running}/{self.max_running} running, {waiting} waiting '
+                    f'from {len(self.queues)} users, {self.served} served, {self.rejected} rejected')
+
+
+FAIR_DEFAULTS = {
+    # cost is megapixels times frames
+    'distort': (int(_config('distort_max_concurrent') or 3), 100, 1),
+    # cost is 1 per request
+    'generators': (int(_config('generator_max_concurrent') or 3), 3, .02),
+}
+fair = {name: FairScheduler(name, max_running,
+                            float(_config(f'fair_{name}_capacity') or capacity),
+                            float(_config(f'fair_{name}_refill') or refill),
+                            int(_config(f'fair_{name}_waiting') or 5))
+        for name, (max_running, capacity, refill) in FAIR_DEFAULTS.items()}
+# huggingface jobs take turns per space, so a few slow spaces don't hold up the rest
+space_fair = {}
+space_fair_lock = threading.Lock()
+
+
+def fair_space(space: str) -> FairScheduler:
+    """returns the fair queue of a huggingface space. the cost of a job is how many
+    times the space is run"""
+    with space_fair_lock:
+        if space not in space_fair:
+            space_fair[space] = FairScheduler(space, int(_config('fair_huggingface_running') or 2),
+                                              float(_config('fair_huggingface_capacity') or 20),
+                                              float(_config('fair_huggingface_refill') or .1),
+                                              int(_config('fair_huggingface_waiting') or 5))
+        return space_fair[space]
+
+
+def fair_pooled(fair_name: str, pool_name: str, fun, cost):
+    """like pooled, but the handler first waits its turn in one of the fair queues,
+    without taking a worker. cost is called with the update and the context and
+    estimates how expensive the job is, before anything is downloaded"""
+    scheduler, pool = fair[fair_name], pools[pool_name]
+
+    def run(update: Update, context: CallbackContext) -> None:
+        try:
+            fun(update, context)
+        except Exception as exc:
+            context.dispatcher.dispatch_error(update, exc)
+        finally:
+            scheduler.release()
+
+    @wraps(fun)
+    def callback(update: Update, context: CallbackContext) -> None:
+        user_id, chat_id = update.message.from_user.id, update.message.chat_id
+        cost_ = cost(update, context)
+
+        def start():
+            if pool.submit(run, update, context):
+                return
+            logger.info('%s pool is saturated, rejecting %s', pool_name, fun.__name__)
+            # it never ran, so it doesn't cost anything
+            scheduler.release(user_id, chat_id, min(cost_, scheduler.capacity))
+            try:
+                update.message.reply_text("I'm busy right now. Try again in a while.")
+            except:
+                logger.exception("couldn't tell the user that the pool is busy")
+
+        if not scheduler.submit(user_id, chat_id, cost_, start):
+            logger.info('%s: too many jobs waiting from %d', fair_name, update.message.from_user.id)
+            update.message.reply_text('You have too many requests waiting. Try again in a while.')
+    return callback
+
+
+class LoadController:
+    """trades quality for latency when the box is busy. every tick it looks at how
+    full the pools are, how long distort waited for the semaphore and the load
+    average, and steps the level down (cheaper) or back up (nicer) by one"""
+    # frames and scramble hops are multiplied by these. the working resolution is
+    # the largest side in pixels
+    LEVELS = [
+        {'frames': 1, 'resolution': None, 'preset': 'medium', 'hops': 1},
+        {'frames': .75, 'resolution': 1280, 'preset': 'fast', 'hops': .75},
+        {'frames': .5, 'resolution': 960, 'preset': 'veryfast', 'hops': .5},
+        {'frames': .25, 'resolution': 640, 'preset': 'ultrafast', 'hops': .25},
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.level = 0
+        # seconds waited for the semaphore, smoothed over ticks
+        self.wait = 0
+        self.max_wait = 0
+        self.pressure = 0
+        self.target_wait = float(_config('load_target_wait') or 5)
+        self.max_load = float(_config('load_max_per_cpu') or 1) * (os.cpu_count() or 1)
+        self.decisions = deque(maxlen=5)
+
+    def waited(self, seconds: float) -> None:
+        with self.lock:
+            self.max_wait = max(self.max_wait, seconds)
+
+    def cron(self, _: CallbackContext = None) -> None:
+        with self.lock:
+            self.wait = (self.wait + self.max_wait) / 2
+            self.max_wait = 0
+            signals = {
+                'queues': max(pool.queued / pool.max_queued for pool in pools.values()),
+                'wait': self.wait / self.target_wait,
+                'load': os.getloadavg()[0] / self.max_load,
+            }
+            self.pressure = max(signals.values())
+            if self.pressure > 1 and self.level < len(self.LEVELS) - 1:
+                level = self.level + 1
+            elif self.pressure < .6 and self.level > 0:
+                level = self.level - 1
+            else:
+                return
+            reason = ', '.join(f'{name} {value:.2f}' for name, value in signals.items())
+            logger.info('load level %d -> %d (%s)', self.level, level, reason)
+            self.decisions.append(f'{time.strftime("%H:%M:%S")} {self.level}->{level} ({reason})')
+            self.level = level
+
+    def frames(self, frames: int) -> int:
+        return max(2, round(frames * self.LEVELS[self.level]['frames']))
+
+    def resolution(self) -> int:
+        """returns the largest side to work at, or None for any size"""
+        return self.LEVELS[self.level]['resolution']
+
+    def preset(self) -> str:
+        return self.LEVELS[self.level]['preset']
+
+    def hops(self, hops: int) -> int:
+        return max(1, round(hops * self.LEVELS[self.level]['hops']))
+
+    def dump(self) -> str:
+        with self.lock:
+            return (f'Load level {self.level}/{len(self.LEVELS) - 1}: {self.LEVELS[self.level]}, '
+                    f'pressure {self.pressure:.2f}, semaphore wait {self.wait:.1f}s\n' +
+                    '\n'.join(self.decisions))
+
+
+controller = LoadController()
+
+
+def dump() -> str:
+    return ('Pools:\n' + '\n'.join(pool.dump() for pool in pools.values()) +
+            '\nFair queues:\n' + '\n'.join(scheduler.dump() for scheduler in fair.values()) +
+            ''.join('\n' + scheduler.dump() for scheduler in list(space_fair.values())) +
+            '\n' + controller.dump())
@@ -10,6 +10,7 @@ from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.error import NetworkError
 from telegram.ext import CallbackContext
 
+from uploads import send_media
 from utils import get_random_string
 
 
@@ -74,7 +75,8 @@ def command_sound(update: Update, context: CallbackContext) -> str:
         return
 
     try:
-        update.message.reply_voice(voice=open(output, 'rb'), quote=False)
+        with open(output, 'rb') as fp:
+            send_media(update.message.reply_voice, fp, quote=False, key=' '.join(input_files))
     except NetworkError:
         update.message.reply_text('The resulting file is too big.')
 
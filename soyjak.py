@@ -1,10 +1,13 @@
 import datetime
+import threading
+import time
 
 from bs4 import BeautifulSoup
 from telegram import ChatAction, Update
 from telegram.ext import CallbackContext
 
-from utils import _config, get_url, get_command_args, logger
+from uploads import send_media
+from utils import _config, _config_list, get_url, get_command_args, get_next_hour, logger, Prefetched
 
 
 SOYJAK_TPL = 'https://booru.soy/_images/%s/image.%s'
@@ -34,49 +37,135 @@ def get_soyjak(tag: str = None) -> str:
     raise ValueError('something came up')
 
 
+class SoyjakPool:
+    """keeps a few soyjaks already scraped for the random page and for some popular
+    tags, so commands don't have to wait for booru.soy. entries expire after a while"""
+    def __init__(self):
+        # tag ('' for random) -> [(url, type_, fetched_at), ...]
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.fill_lock = threading.Lock()
+
+    @staticmethod
+    def tags() -> list:
+        return [''] + [tag.lower() for tag in _config_list('soyjak_pool_tags')]
+
+    def take(self, tag: str = None) -> tuple:
+        """returns a fresh soyjak for the tag, or None if there are none ready"""
+        ttl = int(_config('soyjak_pool_ttl') or 60 * 60)
+        with self.lock:
+            pool = self.pools.get((tag or '').lower(), [])
+            while pool:
+                url, type_, fetched_at = pool.pop(0)
+                if time.monotonic() - fetched_at < ttl:
+                    return url, type_
+        return None
+
+    def fill(self) -> None:
+        """tops up every pool. only one fill runs at a time"""
+        if not self.fill_lock.acquire(blocking=False):
+            return
+        try:
+            ttl = int(_config('soyjak_pool_ttl') or 60 * 60)
+            size = int(_config('soyjak_pool_size') or 5)
+            for tag in self.tags():
+                with self.lock:
+                    pool = self.pools.setdefault(tag, [])
+                    pool[:] = [x for x in pool if time.monotonic() - x[2] < ttl]
+                    missing = size - len(pool)
+                for _ in range(missing):
+                    try:
+                        url, type_ = get_soyjak(tag)
+                    except:
+                        logger.exception('failed to fill the soyjak pool for "%s"', tag)
+                        break
+                    with self.lock:
+                        if url not in (x[0] for x in pool):
+                            pool.append((url, type_, time.monotonic()))
+        finally:
+            self.fill_lock.release()
+
+    def dump(self) -> str:
+        with self.lock:
+            if any(self.pools.values()):
+                return 'Soyjak pools: ' + ', '.join(f'{tag or "random"}#{len(pool)}'
+                                                    for tag, pool in self.pools.items())
+        return 'Soyjak pools are empty.'
+
+
+pool = SoyjakPool()
+
+
+def _is_cron_hour(hour: int) -> bool:
+    return not (hour % 2 == 0 or 2 < hour < 10)
+
+
+def _send_soyjak(context: CallbackContext, chat_id: int, url: str, type_: str) -> None:
+    send_media(getattr(context.bot, f'send_{type_}'), chat_id, url)
+
+
+prefetched = Prefetched()
 def cron_soyjak(context: CallbackContext) -> None:
     if not _config('soyjak_cron_chat_id'):
         return
 
     hour = datetime.datetime.now().astimezone().hour
-    if hour % 2 == 0 or 2 < hour < 10:
+    if not _is_cron_hour(hour):
         return
 
+    chat_id = int(_config('soyjak_cron_chat_id'))
+    if soyjak := prefetched.take():
+        try:
+            _send_soyjak(context, chat_id, *soyjak)
+            return
+        except:
+            logger.exception('failed to send the prefetched soyjak, fetching another one')
     try:
-        url, type_ = get_soyjak()
-        if type_ == 'animation':
-            context.bot.send_animation(int(_config('soyjak_cron_chat_id')), url)
-        elif type_ == 'photo':
-            context.bot.send_photo(int(_config('soyjak_cron_chat_id')), url)
-        elif type_ == 'video':
-            context.bot.send_video(int(_config('soyjak_cron_chat_id')), url)
+        _send_soyjak(context, chat_id, *(pool.take() or get_soyjak()))
     except:
         logger.exception('failed to send bihourly soyjak')
 
 
+def prefetch_soyjak(context: CallbackContext) -> None:
+    """runs a few minutes before cron_soyjak and picks the soyjak in a worker"""
+    if not _config('soyjak_cron_chat_id'):
+        return
+    if not _is_cron_hour(get_next_hour()):
+        return
+
+    def prefetch():
+        try:
+            prefetched.put(pool.take() or get_soyjak())
+        except:
+            logger.exception('failed to prefetch a soyjak')
+
+    context.dispatcher.run_async(prefetch)
+
+
+def cron_soyjak_pool(context: CallbackContext) -> None:
+    """keeps the soyjak pools full, in a worker so the job queue isn't blocked"""
+    context.dispatcher.run_async(pool.fill)
+
+
 def command_soyjak(update: Update, context: CallbackContext) -> None:
     """sends you a soyjak"""
+    tag = get_command_args(update, use_quote=False)
     context.bot_data['actions'].append(update.message.chat_id, ChatAction.UPLOAD_PHOTO)
     try:
-        url, type_ = get_soyjak(get_command_args(update, use_quote=False))
-    except Exception as exc:
-        logger.exception('soyjak raised exception')
-        update.message.reply_text(f'ACK! {str(exc)}')
-        return
-    for _ in range(10):
-        try:
-            logger.info('would post %s', (url, type_))
-            if type_ == 'animation':
-                update.message.reply_animation(url)
-            elif type_ == 'photo':
-                update.message.reply_photo(url)
-            elif type_ == 'video':
-                update.message.reply_video(url)
-            return
-        except Exception as exc:
-            logger.exception('soyjak raised exception')
-            #update.message.reply_text(f'ACK! {str(exc)}')
-            pass
-        finally:
-            context.bot_data['actions'].remove(update.message.chat_id, ChatAction.UPLOAD_PHOTO)
-    update.message.reply_text('ACK!')
+        for _ in range(3):
+            try:
+                url, type_ = pool.take(tag) or get_soyjak(tag)
+            except Exception as exc:
+                logger.exception('soyjak raised exception')
+                update.message.reply_text(f'ACK! {str(exc)}')
+                return
+            try:
+                logger.info('would post %s', (url, type_))
+                send_media(getattr(update.message, f'reply_{type_}'), url)
+                return
+            except Exception:
+                # telegram couldn't fetch this one, try another
+                logger.exception('soyjak raised exception')
+        update.message.reply_text('ACK!')
+    finally:
+        context.bot_data['actions'].remove(update.message.chat_id, ChatAction.UPLOAD_PHOTO)
@@ -0,0 +1,141 @@
+import json
+import os
+
+import pytest
+
+import _4chan as module
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf8') as fp:
+        return json.load(fp)
+
+
+class Response:
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+
+class Session:
+    """answers with the responses given, in order, and remembers the requests"""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, **_):
+        self.requests.append((url, headers or {}))
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(module.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def config(monkeypatch):
+    values = {'4chan_catalog_ttl': '300'}
+    monkeypatch.setattr(module, '_config', values.get)
+    return values
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def make(*responses):
+        session = Session(*responses)
+        monkeypatch.setattr(module, 'requests_session', session)
+        return session
+    return make
+
+
+def catalog_response():
+    return Response(200, load_fixture('4chan_catalog.json'),
+                    {'ETag': '"abc"', 'Last-Modified': 'Sat, 17 Oct 2026 12:20:00 GMT'})
+
+
+def test_catalog_is_reused_within_ttl(clock, config, session):
+    requests = session(catalog_response())
+    chan = module._4chan()
+    threads = chan.catalog('diy')
+    assert [thread['no'] for thread in threads] == [100001, 100002, 100003, 100004, 100005]
+    clock[0] += 299
+    assert chan.catalog('diy') is threads
+    assert requests.requests == [('https://a.4cdn.org/diy/catalog.json', {})]
+
+
+def test_catalog_is_revalidated_after_ttl(clock, config, session):
+    requests = session(catalog_response(), Response(304))
+    chan = module._4chan()
+    threads = chan.catalog('diy')
+    clock[0] += 301
+    assert chan.catalog('diy') is threads
+    assert requests.requests[1][1] == {'If-None-Match': '"abc"',
+                                       'If-Modified-Since': 'Sat, 17 Oct 2026 12:20:00 GMT'}
+    # a 304 starts the ttl again
+    clock[0] += 299
+    chan.catalog('diy')
+    assert len(requests.requests) == 2
+
+
+def test_catalog_is_replaced_when_it_changes(clock, config, session):
+    changed = [{'page': 1, 'threads': [{'no': 1, 'replies': 0}]}]
+    session(catalog_response(), Response(200, changed, {'ETag': '"def"'}))
+    chan = module._4chan()
+    chan.catalog('diy')
+    clock[0] += 301
+    assert [thread['no'] for thread in chan.catalog('diy')] == [1]
+    assert chan.catalogs['diy']['etag'] == '"def"'
+    assert chan.catalogs['diy']['last_modified'] is None
+
+
+def test_catalog_error(clock, config, session):
+    session(Response(404))
+    with pytest.raises(RuntimeError):
+        module._4chan().catalog('diy')
+
+
+def test_request_op_from_catalog(clock, config, session):
+    requests = session(catalog_response())
+    chan = module._4chan()
+    info = chan.thread_info('diy', 100001)
+    assert len(requests.requests) == 1
+    assert info['url'] == 'https://boards.4chan.org/diy/thread/100001'
+    assert info['subject'] == 'Cats & dogs'
+    assert info['text'] == 'Which one is better?\nPost yours'
+    assert info['image_url'] == 'https://i.4cdn.org/diy/1760702400000001.jpg'
+    assert info['image_info'] == 'cat.jpg (120 KB, 800x600)'
+    info = chan.thread_info('diy', 100004)
+    assert info['image_url'] is None and info['image_info'] == '(file deleted)'
+    assert len(requests.requests) == 1
+
+
+def test_request_op_falls_back_to_thread(clock, config, session):
+    requests = session(catalog_response(), Response(200, load_fixture('4chan_thread.json')))
+    chan = module._4chan()
+    info = chan.thread_info('diy', 99999)
+    assert requests.requests[1][0] == 'https://a.4cdn.org/diy/thread/99999.json'
+    assert info['subject'] == 'Old thread'
+    assert info['text'] == 'Fell off the catalog\n"still here"'
+    assert info['image_url'] == 'https://i.4cdn.org/diy/1760605200000000.webm'
+
+
+def test_request_op_missing_thread(clock, config, session):
+    session(catalog_response(), Response(404))
+    with pytest.raises(RuntimeError):
+        module._4chan().thread_info('diy', 1)
+
+
+def test_api_url(clock, config, session):
+    config['4chan_api_url'] = 'http://localhost:8080'
+    requests = session(catalog_response())
+    module._4chan().catalog('diy')
+    assert requests.requests[0][0] == 'http://localhost:8080/diy/catalog.json'
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from calc import calculate, MAX_DEPTH
+
+
+def load_corpus():
+    with open(os.path.join(os.path.dirname(__file__), 'calc_corpus.txt'), encoding='utf8') as fp:
+        return [line.rstrip('\n').split('\t') for line in fp if line.strip() and not line.startswith('#')]
+
+
+@pytest.mark.parametrize('expression,output', load_corpus())
+def test_corpus(expression, output):
+    if output == 'error':
+        with pytest.raises((ValueError, ArithmeticError)):
+            calculate(expression)
+    else:
+        assert calculate(expression) == output
+
+
+@pytest.mark.parametrize('expression,output', [
+    ('1+' * 1500 + '1', '1501'),
+    ('- ' * 1200 + '1', '1'),
+    ('- ' * 1201 + '1', '-1'),
+    ('(' * MAX_DEPTH + '1' + ')' * MAX_DEPTH, '1'),
+    ('s(' * MAX_DEPTH + '0' + ')' * MAX_DEPTH, '0'),
+])
+def test_long_expressions(expression, output):
+    assert calculate(expression) == output
+
+
+def test_too_deep():
+    with pytest.raises(ValueError, match='nested'):
+        calculate('(' * 300 + '1' + ')' * 300)
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from text import FortuneStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    def make(data: str):
+        path = tmp_path / 'trolldb.txt'
+        new = tmp_path / 'trolldb.new'
+        new.write_text(data, encoding='utf8')
+        os.replace(new, path)
+        if hasattr(make, 'store'):
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        else:
+            make.store = FortuneStore(str(path))
+        return make.store
+    return make
+
+
+def split_like_before(data: str) -> list[str]:
+    # what the fortunes were before they were indexed
+    return data.split('\n%\n')[:-1]
+
+
+@pytest.mark.parametrize('data', [
+    'first\n%\nsecond\n%\n',
+    'multi\nline\nfortune\n%\nand another\n%\n',
+    '100% sure\n%\n%percent at the start\n%\n',
+    'not a separator: \n%%\n still the same one\n%\n',
+    'empty ones are kept\n%\n\n%\nafter\n%\n',
+    'ends without a separator\n%\nthis is not a fortune\n%',
+    'no separator at all',
+])
+def test_boundaries(store, data):
+    fortunes = store(data)
+    fortunes.refresh()
+    assert list(fortunes.fortunes) == split_like_before(data)
+
+
+def test_random(store):
+    fortunes = store('uno  dos\n%\ntres \ncuatro\n%\n')
+    # cleaned like they always were
+    assert {fortunes.random() for _ in range(100)} == {'uno\ndos', 'tres cuatro'}
+
+
+def test_search_prefixes(store):
+    fortunes = store('olakease\n%\nhola caracola\n%\nOla de calor\n%\nnada que ver\n%\n')
+    results, more = fortunes.search('ola', 10)
+    # words that start with it, not words that contain it
+    assert sorted(results) == ['Ola de calor', 'olakease']
+    assert not more
+    assert fortunes.search('ola cal', 10) == (['Ola de calor'], False)
+    assert fortunes.search('ola zzz', 10) == ([], False)
+    assert fortunes.search('!!!', 10) == ([], False)
+
+
+def test_search_ranking(store):
+    fortunes = store('con pan y con queso\n%\npan con pan\n%\npan pan pan con\n%\n')
+    results, _ = fortunes.search('pan con', 10)
+    # the ones with the exact text first, then the ones where the words appear the most
+    assert results == ['pan pan pan con', 'pan con pan', 'con pan y con queso']
+
+
+def test_search_limits(store):
+    fortunes = store(''.join(f'fortune number {i}\n%\n' for i in range(50)))
+    results, more = fortunes.search('fortune', 10)
+    assert len(results) == 10 and more
+    results, more = fortunes.search('fortune', 100, max_candidates=20)
+    assert len(results) == 20 and more
+    results, more = fortunes.search('fortune', 100)
+    assert len(results) == 50 and not more
+
+
+def test_refresh(store):
+    fortunes = store('old fortune\n%\n')
+    assert fortunes.search('old', 10) == (['old fortune'], False)
+    store('new fortune\n%\n')
+    assert fortunes.search('old', 10) == ([], False)
+    assert fortunes.search('new', 10) == (['new fortune'], False)
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+import utils
+from utils import get_random_line, MmapIndex
+
+
+def write(path, data: bytes, bump: bool = False):
+    # replaced and not rewritten, so anything still reading the old mmap is safe
+    new = path.with_suffix('.new')
+    new.write_bytes(data)
+    os.replace(new, path)
+    if bump:
+        # in case the file system keeps mtimes too coarse to notice
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+@pytest.mark.parametrize('data', [
+    'one\ntwo\nthree\n',
+    'one\ntwo\nthree',
+    '\n\nblank lines\n\n',
+    'ñandú\n🥠 fortune\n',
+    '',
+])
+def test_lines_like_readlines(tmp_path, data):
+    path = tmp_path / 'lines.txt'
+    write(path, data.encode('utf8'))
+    index = MmapIndex(str(path))
+    assert index.refresh()
+    with open(path, 'rt', encoding='utf8') as fp:
+        lines = fp.readlines()
+    assert len(index) == len(lines)
+    assert list(index) == lines
+    assert [index[i] for i in range(len(index))] == lines
+
+
+def test_separator_not_kept(tmp_path):
+    path = tmp_path / 'fortunes'
+    write(path, b'first\nfortune\n%\nsecond\n%\nunfinished')
+    index = MmapIndex(str(path), b'\n%\n', keep_separator=False, allow_unterminated=False)
+    index.refresh()
+    assert list(index) == ['first\nfortune', 'second']
+
+
+def test_refresh(tmp_path):
+    path = tmp_path / 'lines.txt'
+    write(path, b'old\nlines\n')
+    index = MmapIndex(str(path))
+    assert index.refresh()
+    assert not index.refresh()
+    old = iter(index)
+    assert next(old) == 'old\n'
+    write(path, b'new\nlines\nhere\n', bump=True)
+    assert index.refresh()
+    assert list(index) == ['new\n', 'lines\n', 'here\n']
+    # an iteration that started before keeps reading what was there then
+    assert list(old) == ['lines\n']
+
+
+def test_random(tmp_path):
+    path = tmp_path / 'lines.txt'
+    write(path, b'a\nb\nc\n')
+    index = MmapIndex(str(path))
+    index.refresh()
+    assert {index.random() for _ in range(200)} == {'a\n', 'b\n', 'c\n'}
+
+
+def test_haiku(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'line_indexes', {})
+    five, seven = tmp_path / 'haiku5.txt', tmp_path / 'haiku7.txt'
+    write(five, b'an old silent pond\n')
+    write(seven, b'a frog jumps into the pond\n')
+    # /haiku puts three lines together, so they have to keep their newline
+    haiku = get_random_line(str(five)) + get_random_line(str(seven)) + get_random_line(str(five))
+    assert haiku == 'an old silent pond\na frog jumps into the pond\nan old silent pond\n'
+    write(five, b'splash! silence again\n', bump=True)
+    assert get_random_line(str(five)) == 'splash! silence again\n'
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from triggers import Triggers
+
+
+@pytest.fixture
+def make_triggers(tmp_path):
+    def make(*lines):
+        path = tmp_path / 'triggers.txt'
+        path.write_text(''.join(line + '\n' for line in lines), encoding='utf8')
+        triggers = Triggers()
+        triggers.FILENAME = str(path)
+        return triggers
+    return make
+
+
+def test_exact(make_triggers):
+    triggers = make_triggers('hello\thi', 'HELLO\tsecond')
+    assert triggers.match('Hello') == 'hi'
+    assert triggers.match('hello there') is None
+
+
+def test_substring_and_regex(make_triggers):
+    triggers = make_triggers('in:c++\tplus plus', 're:^\\d+ ?€$\tmoney')
+    assert triggers.match('i like C++ a lot') == 'plus plus'
+    assert triggers.match('20 €') == 'money'
+    assert triggers.match('20 $') is None
+    assert triggers.substrings and triggers.rx and not triggers.separate
+
+
+def test_shared_prefixes(make_triggers):
+    triggers = make_triggers('in:abc\tthree', 'in:ab\ttwo', 'in:abd\tother', 'in:b\tb', 'in:AB\tsame')
+    assert triggers.match('xabcx') == 'three'
+    assert triggers.match('xabx') == 'two'
+    assert triggers.match('ABD') == 'other'
+    assert triggers.match('xbx') == 'b'
+    assert triggers.match('xaxcx') is None
+
+
+def test_backreference(make_triggers):
+    triggers = make_triggers('in:zz\tsleep', 're:(b)\\1\tdouble b', 're:(?P<w>\\w+) (?P=w)\tagain')
+    assert triggers.match('xx bb yy') == 'double b'
+    assert triggers.match('xx ba yy') is None
+    assert triggers.match('so so') == 'again'
+    assert triggers.match('zz') == 'sleep'
+    assert len(triggers.separate) == 2
+
+
+def test_first_match_wins(make_triggers):
+    triggers = make_triggers('in:yy\tlate', 're:(x)\\1\tgrouped', 'in:xx\tplain')
+    # the earliest match wins, wherever the trigger is
+    assert triggers.match('xx yy') == 'grouped'
+    assert triggers.match('yy xx') == 'late'
+    triggers = make_triggers('in:xx\tplain', 're:(x)\\1\tgrouped')
+    assert triggers.match('xx') == 'plain'
+
+
+def test_invalid_regex(make_triggers):
+    triggers = make_triggers('re:(\tbroken', 'in:ok\tfine')
+    assert triggers.match('ok') == 'fine'
+    assert triggers.match('(') is None
+
+
+def test_inline_flags(make_triggers):
+    # can't be put together with the others, so it is matched on its own
+    triggers = make_triggers('re:(?s)a.b\tdotall', 'in:c\tsee')
+    assert triggers.match('a\nb') == 'dotall'
+    assert triggers.match('c') == 'see'
+    assert triggers.rx is None and len(triggers.separate) == 1
+
+
+def test_refresh(make_triggers):
+    triggers = make_triggers('hello\thi')
+    assert triggers.match('hello') == 'hi'
+    with open(triggers.FILENAME, 'wt', encoding='utf8') as fp:
+        fp.write('hello\tbye\n')
+    stat = os.stat(triggers.FILENAME)
+    os.utime(triggers.FILENAME, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert triggers.match('hello') == 'bye'
+    os.remove(triggers.FILENAME)
+    assert triggers.match('hello') is None
@@ -0,0 +1,121 @@
+from types import SimpleNamespace
+
+import pytest
+
+import twitter as module
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(module.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def instances(monkeypatch):
+    names = ['a.example', 'b.example', 'c.example']
+    monkeypatch.setattr(module, '_config_list', lambda k, type_=str: names if k == 'twitter_nitter_instances' else [])
+    monkeypatch.setattr(module, '_config', lambda k=None: None)
+    return names
+
+
+def test_ranked_by_latency(clock, instances):
+    nitter = module.NitterInstances()
+    # nothing is known yet, so they are tried in the order they were given
+    assert nitter.ranked() == instances
+    nitter.success('a.example', 2.)
+    nitter.success('b.example', .5)
+    nitter.success('c.example', 1.)
+    assert nitter.ranked() == ['b.example', 'c.example', 'a.example']
+
+
+def test_latency_is_averaged(clock, instances):
+    nitter = module.NitterInstances()
+    nitter.ranked()
+    nitter.success('a.example', 1.)
+    assert nitter.stats['a.example']['latency'] == 1.
+    nitter.success('a.example', 2.)
+    assert nitter.stats['a.example']['latency'] == pytest.approx(1.2)
+    # a single slow answer doesn't send a fast instance to the back
+    nitter.success('b.example', 2.)
+    nitter.success('c.example', 2.5)
+    nitter.success('a.example', 3.)
+    assert nitter.stats['a.example']['latency'] == pytest.approx(1.56)
+    assert nitter.ranked() == ['a.example', 'b.example', 'c.example']
+
+
+def test_unknown_instances_first(clock, instances):
+    nitter = module.NitterInstances()
+    nitter.ranked()
+    nitter.success('a.example', .1)
+    nitter.success('b.example', .2)
+    # new instances are tried before the known ones, so they get a latency
+    assert nitter.ranked() == ['c.example', 'a.example', 'b.example']
+
+
+def test_failures_back_off(clock, instances):
+    nitter = module.NitterInstances()
+    nitter.ranked()
+    nitter.success('a.example', .1)
+    nitter.success('b.example', .2)
+    nitter.success('c.example', .3)
+    nitter.failure('a.example')
+    assert nitter.stats['a.example']['down_until'] == 1000 + 120
+    # instances that are down are only tried if the others fail too
+    assert nitter.ranked() == ['b.example', 'c.example', 'a.example']
+    clock[0] += 121
+    assert nitter.ranked()[0] == 'a.example'
+    nitter.failure('a.example')
+    assert nitter.stats['a.example']['down_until'] == clock[0] + 240
+    for _ in range(10):
+        nitter.failure('a.example')
+    assert nitter.stats['a.example']['down_until'] == clock[0] + 60 * 60
+    nitter.success('a.example', .1)
+    assert nitter.stats['a.example']['failures'] == 0
+    assert nitter.ranked()[0] == 'a.example'
+    assert '(down)' not in nitter.dump()
+
+
+class Session:
+    """answers every instance with what answers says, and remembers the requests"""
+    def __init__(self, answers):
+        self.answers = answers
+        self.requests = []
+
+    def get(self, url, headers=None, **_):
+        self.requests.append((url, headers))
+        answer = self.answers[url.split('/')[2]]
+        if isinstance(answer, Exception):
+            raise answer
+        return SimpleNamespace(status_code=answer, headers={}, content=b'')
+
+
+def test_fetch_fails_over(clock, instances, monkeypatch):
+    session = Session({'a.example': ConnectionError('timed out'), 'b.example': 500, 'c.example': 304})
+    monkeypatch.setattr(module, 'requests_session', session)
+    poller = module.FeedPoller()
+    assert poller.fetch('user') == []
+    assert [url for url, _ in session.requests] == [f'https://{instance}/user/with_replies/rss'
+                                                   for instance in instances]
+    assert poller.instances.ranked() == ['c.example', 'a.example', 'b.example']
+    # the validators of a feed are only sent to the instance they came from
+    poller.feed('user').update(instance='c.example', etag='"x"', last_modified=None)
+    session.requests.clear()
+    poller.fetch('user')
+    assert session.requests == [('https://c.example/user/with_replies/rss', {'If-None-Match': '"x"'})]
+
+
+def test_quiet_feeds_are_polled_less_often(clock, instances):
+    poller = module.FeedPoller()
+    entry = SimpleNamespace(guid='https://a.example/user/status/123#m')
+    poller.reschedule('user', [entry])
+    assert poller.feed('user')['interval'] == 60
+    poller.reschedule('user', [entry])
+    assert poller.feed('user')['interval'] == 90
+    for _ in range(20):
+        poller.reschedule('user', [])
+    assert poller.feed('user')['interval'] == 15 * 60
+    assert poller.feed('user')['next_poll'] == clock[0] + 15 * 60
+    poller.reschedule('user', [SimpleNamespace(guid='https://a.example/user/status/124#m')])
+    assert poller.feed('user')['interval'] == 60
@@ -1,10 +1,14 @@
-import random
+from array import array
+from bisect import bisect_left
+from heapq import nsmallest
+import re
+import threading
 
 from telegram import Update
 from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.ext import CallbackContext
 
-from utils import _config, ellipsis, get_random_line
+from utils import _config, ellipsis, get_random_line, logger, MmapIndex
 
 
 def clean_fortune(fortune: str) -> str:
@@ -12,41 +16,97 @@ def clean_fortune(fortune: str) -> str:
     return fortune.replace(' \n', ' ').replace('  ', '\n').strip()
 
 
-def get_all_fortunes() -> list[str]:
-    with open('assets/trolldb.txt', 'rt', encoding='utf8') as fp:
-        return fp.read().split('\n%\n')[:-1]
+RX_WORD = re.compile(r'\w+')
+class FortuneStore:
+    """the fortune database. fortunes are read from disk when they're needed through
+    an offset index, and searched with an inverted index. both are rebuilt when the
+    file changes"""
+    def __init__(self, filename: str):
+        self.fortunes = MmapIndex(filename, b'\n%\n', keep_separator=False, allow_unterminated=False)
+        self.lock = threading.Lock()
+        # (word -> array of the fortunes that contain it, every word sorted so the
+        # ones that start with a prefix can be found)
+        self.index = None
+
+    def refresh(self) -> None:
+        with self.lock:
+            if not self.fortunes.refresh() and self.index:
+                return
+            words = {}
+            for i, fortune in enumerate(self.fortunes):
+                for word in set(RX_WORD.findall(clean_fortune(fortune).lower())):
+                    words.setdefault(word, array('I')).append(i)
+            self.index = (words, sorted(words))
+            logger.info('indexed %d words in %d fortunes', len(words), len(self.fortunes))
+
+    def random(self) -> str:
+        self.refresh()
+        return clean_fortune(self.fortunes.random())
+
+    @staticmethod
+    def _matching(index: tuple, prefix: str) -> set:
+        """returns the fortunes that contain a word that starts with prefix"""
+        words, vocabulary = index
+        matching = set()
+        i = bisect_left(vocabulary, prefix)
+        while i < len(vocabulary) and vocabulary[i].startswith(prefix):
+            matching.update(words[vocabulary[i]])
+            i += 1
+        return matching
+
+    def search(self, criteria: str, max_results: int, max_candidates: int = 1000) -> tuple[list[str], bool]:
+        """returns the fortunes that have words starting with all the words in the
+        criteria, best matches first, and whether there were more than max_results.
+        only the first max_candidates matches are read and ranked, so short prefixes
+        that match half the database stay cheap"""
+        self.refresh()
+        index = self.index
+        criteria = criteria.lower()
+        terms = RX_WORD.findall(criteria)
+        if not terms:
+            return [], False
+        candidates = None
+        for term in sorted(terms, key=len, reverse=True):
+            matching = self._matching(index, term)
+            candidates = matching if candidates is None else candidates & matching
+            if not candidates:
+                return [], False
+
+        def rank(fortune):
+            # the exact text first, then the ones where the words show up the most
+            lower = fortune.lower()
+            return criteria not in lower, -sum(lower.count(term) for term in terms), len(fortune)
+
+        more = len(candidates) > max_candidates
+        if more:
+            candidates = nsmallest(max_candidates, candidates)
+        results = sorted((clean_fortune(self.fortunes[i]) for i in candidates), key=rank)
+        return results[:max_results], more or len(results) > max_results
+
+
+fortune_store = FortuneStore('assets/trolldb.txt')
 
 
 def get_fortune() -> str:
     """gets a fortune at random and cleans it"""
-    return clean_fortune(random.choice(get_all_fortunes()))
-
-
-def search_fortunes(criteria: str) -> str:
-    """searches the fortune database for fortunes that match the criteria and
-    returns them and then None if there are more results"""
-    results = 0
-    for fortune in get_all_fortunes():
-        clean = clean_fortune(fortune)
-        if criteria.lower() in clean.lower():
-            results += 1
-            yield clean
-        if results >= int(_config('fortune_max_results')):
-            yield None
-            return
+    return fortune_store.random()
 
 
 def command_fortune(update: Update, context: CallbackContext) -> None:
-    """handles the /fortune command, which prints a random fortune or a list of
-    a max of fortune_max_results that match the parameter"""
+    """prints a random fortune, or the ones with words that start with the words
+    you give (/fortune ola finds "olakease" but not "hola")"""
     def msg(text):
         update.message.reply_text(ellipsis(text, MAX_MESSAGE_LENGTH),
                                   disable_web_page_preview=True, quote=False)
     if context.args:
-        if fortunes := list(search_fortunes(' '.join(context.args))):
-            for fortune in fortunes:
-                msg(fortune if fortune else 'Too many results. I only showed the first %d.' % int(_config('fortune_max_results')))
-        else:
+        max_results = int(_config('fortune_max_results'))
+        fortunes, more = fortune_store.search(' '.join(context.args), max_results,
+                                              int(_config('fortune_max_candidates') or 1000))
+        for fortune in fortunes:
+            msg(fortune)
+        if more:
+            msg('Too many results. I only showed the first %d.' % max_results)
+        elif not fortunes:
             msg('No results.')
     else:
         msg(get_fortune())
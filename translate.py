@@ -8,6 +8,7 @@ from telegram.constants import MAX_MESSAGE_LENGTH, PARSEMODE_HTML
 from telegram.ext import CallbackContext
 
 
+from scheduler import controller
 from utils import (_config, clean_up, ellipsis, get_command_args,
                    get_random_string, logger, remove_command)
 
@@ -111,7 +112,7 @@ def get_scramble_languages(count=None) -> list[str]:
     scramble text"""
     languages = [x.strip() for x in _config('translate_scrambler_languages').split(',')]
     random.shuffle(languages)
-    count = count or int(_config('translate_scrambler_count'))
+    count = count or controller.hops(int(_config('translate_scrambler_count')))
     return (['auto'] +
             languages[:count] +
             [_config('translate_default_language')])
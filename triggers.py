@@ -0,0 +1,145 @@
+import os
+import re
+import threading
+
+from utils import logger
+
+
+def _combinable(pattern: str) -> bool:
+    """whether a valid pattern can go in the single expression. patterns with groups
+    of their own can't, because their backreferences would point to the wrong group
+    and fail silently, and neither can inline flags that only work at the start.
+    they are slower to match one by one, but they work"""
+    if re.compile(pattern, re.IGNORECASE).groups:
+        return False
+    try:
+        re.compile(f'x|(?:{pattern})', re.IGNORECASE)
+    except re.error:
+        return False
+    return True
+
+
+def _trie_pattern(substrings: list[tuple[str, str]]) -> str:
+    """puts [(group name, substring), ...] together in a single expression that
+    shares their common prefixes, so re only has to try the few that can follow at
+    each character instead of all of them. each substring ends in an empty group
+    named after it. if several of them match at the same place, the longest wins"""
+    root = {}
+    for name, substring in substrings:
+        node = root
+        for char in substring:
+            node = node.setdefault(char, {})
+        node.setdefault(None, name)
+
+    def build(node):
+        # runs of characters without branches are written as they are, so the
+        # recursion is only as deep as the branches
+        prefix = ''
+        while len(node) == 1 and None not in node:
+            (char, node), = node.items()
+            prefix += re.escape(char)
+        alternatives = [re.escape(char) + build(child) for char, child in node.items() if char is not None]
+        if None in node:
+            alternatives.append(f'(?P<{node[None]}>)')
+        return prefix + (alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')')
+    return build(root)
+
+
+class Triggers:
+    """the text triggers in triggers.txt, one per line as trigger<tab>answer.
+    triggers match the whole message, regardless of case. triggers that start
+    with in: match if they appear anywhere in the message, and triggers that
+    start with re: are regular expressions. the file is read again when it changes"""
+    FILENAME = 'triggers.txt'
+
+    def __init__(self):
+        self.mtime = None
+        self.lock = threading.Lock()
+        # casefolded trigger -> answer
+        self.exact = {}
+        # every substring trigger in a single expression, one group each
+        self.substrings = None
+        # the same for the regex triggers
+        self.rx = None
+        # group name -> answer
+        self.answers = {}
+        # [(position, expression, answer), ...] for those that can't be put together
+        self.separate = []
+
+    def refresh(self) -> None:
+        try:
+            mtime = os.stat(self.FILENAME).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            exact, substrings, patterns, answers = {}, [], [], {}
+            try:
+                if mtime:
+                    with open(self.FILENAME, 'rt', encoding='utf8') as fp:
+                        for line in fp:
+                            if '\t' not in line:
+                                continue
+                            trigger, answer = line.rstrip('\n').split('\t', 1)
+                            name = f't{len(answers)}'
+                            if trigger.startswith('in:'):
+                                substrings.append((name, trigger[3:]))
+                            elif trigger.startswith('re:'):
+                                try:
+                                    re.compile(trigger[3:], re.IGNORECASE)
+                                except re.error:
+                                    logger.exception('invalid trigger: %s', trigger)
+                                    continue
+                                patterns.append((name, trigger[3:]))
+                            else:
+                                # the first one wins, like it always did
+                                exact.setdefault(trigger.casefold(), answer)
+                                continue
+                            answers[name] = answer
+            except OSError:
+                logger.exception("couldn't read the triggers")
+            substrings_rx = re.compile(_trie_pattern(substrings), re.IGNORECASE) if substrings else None
+            combined = [(name, pattern) for name, pattern in patterns if _combinable(pattern)]
+            rx = None
+            if combined:
+                try:
+                    # the group that tells which one matched goes after the pattern and
+                    # is empty: a group in front of each alternative would keep re from
+                    # skipping them by their first character, which is many times slower
+                    rx = re.compile('|'.join(f'(?:{pattern})(?P<{name}>)' for name, pattern in combined),
+                                    re.IGNORECASE)
+                except re.error:
+                    logger.exception("the triggers can't be put together, matching them one by one")
+                    combined = []
+            in_rx = {name for name, _ in combined}
+            separate = [(int(name[1:]), re.compile(pattern, re.IGNORECASE), answers[name])
+                        for name, pattern in patterns if name not in in_rx]
+            self.exact = exact
+            self.answers = answers
+            self.substrings = substrings_rx
+            self.rx = rx
+            self.separate = separate
+            # even if something failed, so it isn't tried again on every message
+            self.mtime = mtime
+            logger.info('loaded %d triggers', len(exact) + len(answers))
+
+    def match(self, text: str) -> str:
+        """returns the answer to a message, or None if no trigger matches it"""
+        self.refresh()
+        if (answer := self.exact.get(text.casefold())) is not None:
+            return answer
+        # the one that matches first, and if several start at the same place, the
+        # first one in the file, or the longest if they are all substrings
+        matches = [(match.start(), i, answer) for i, rx, answer in self.separate
+                   if (match := rx.search(text))]
+        for rx in (self.substrings, self.rx):
+            if rx and (match := rx.search(text)):
+                name = match.lastgroup
+                matches.append((match.start(), int(name[1:]), self.answers[name]))
+        return min(matches)[2] if matches else None
+
+
+triggers = Triggers()
@@ -1,10 +1,17 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
+import os
 import re
+import threading
+import time
 
 import feedparser
 from telegram import Update
 from telegram.ext import CallbackContext
 
-from utils import _config, is_admin, get_url, logger
+from utils import _config, _config_list, is_admin, logger, requests_session
 
 
 def _get_twitter_feeds() -> dict:
@@ -30,44 +37,289 @@ def _create_link(screen_name: str, id_: int) -> str:
     return f'https://vxtwitter.com/{screen_name}/status/{id_}'
 
 
-def cron_twitter(context: CallbackContext) -> None:
-    """this is the twitter cron job that looks for new tweets and posts them"""
-    entries = {}
-
-    for screen_name, chat_ids in _get_twitter_feeds():  # these are already deduplicated
-        # feedparse allows you to specify the url directly, but it doesn't seem to ever
-        # time out. also, get_url uses the same http session to perform all requests, so
-        # we get better performance.
-        for term in [screen_name, screen_name[1:]] if screen_name.startswith('@') else [screen_name]:
-            feed_url = (f'https://{_config("twitter_nitter_instance")}/search/rss?f=tweets&q={term[1:]}' if term.startswith('@')
-                        else f'https://{_config("twitter_nitter_instance")}/{term}/with_replies/rss')
-            feed = feedparser.parse(get_url(feed_url))
-
-            if feed['bozo'] == 1:
+def get_tweet_time(id_: int) -> float:
+    """returns when a tweet was posted. it's part of its id"""
+    return ((id_ >> 22) + 1288834974657) / 1000
+
+
+class SeenTweets:
+    """the ids of the tweets that have already been posted. they are kept in the
+    order they were last seen in a feed, so the ones that no feed returns anymore can
+    be forgotten, and are saved to disk so nothing is posted twice after a restart"""
+    FILENAME = 'seen_tweets.json.gz'
+
+    def __init__(self):
+        # id -> when it was last seen in a feed, oldest first
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_entries = int(_config('twitter_seen_max_entries') or 10000)
+        self.max_age = int(_config('twitter_seen_max_days') or 30) * 24 * 60 * 60
+        self.polls = 0
+        self.new_ids = 0
+        self.last_new_ids = 0
+        self.saved_at = time.monotonic()
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, id_: int) -> bool:
+        """marks a tweet as seen. returns False if it had already been seen. tweets
+        that are seen again are kept for longer, since feeds keep returning them"""
+        with self.lock:
+            new = self.ids.pop(id_, None) is None
+            self.ids[id_] = int(time.time())
+            if new:
+                self.gc()
+            return new
+
+    def polled(self, new_ids: int) -> None:
+        with self.lock:
+            self.polls += 1
+            self.new_ids += new_ids
+            self.last_new_ids = new_ids
+
+    def last(self) -> int:
+        with self.lock:
+            return max(self.ids) if self.ids else None
+
+    def gc(self):
+        """forgets the tweets over the limit and the ones no feed has returned in a
+        while. a tweet older than that is never posted (see _post_tweets), so a feed
+        that returns it again doesn't get it posted twice"""
+        while self.ids:
+            id_, seen_at = next(iter(self.ids.items()))
+            if len(self.ids) <= self.max_entries and time.time() - seen_at < self.max_age:
+                break
+            del self.ids[id_]
+
+    def save(self, force: bool = True):
+        """saves the ids. if not forced, only every now and then, since every poll
+        updates when the tweets in it were last seen"""
+        with self.lock:
+            if not force and time.monotonic() - self.saved_at < 60 * 60:
+                return
+            self.saved_at = time.monotonic()
+            data = list(self.ids.items())
+        try:
+            with gzip.open(self.FILENAME + '.tmp', 'wt', encoding='utf8') as fp:
+                json.dump(data, fp, separators=(',', ':'))
+            os.replace(self.FILENAME + '.tmp', self.FILENAME)
+        except:
+            logger.exception("couldn't save the seen tweets")
+
+    def load(self):
+        try:
+            with gzip.open(self.FILENAME, 'rt', encoding='utf8') as fp:
+                self.ids = OrderedDict(json.load(fp))
+        except FileNotFoundError:
+            return
+        except:
+            logger.exception("couldn't load the seen tweets")
+            return
+        self.gc()
+        logger.info('loaded %d seen tweets', len(self.ids))
+
+    def dump(self) -> str:
+        with self.lock:
+            average = self.new_ids / self.polls if self.polls else 0
+            return (f'{len(self.ids)} entries saved, {self.last_new_ids} new in the last poll, '
+                    f'{average:.2f} new per poll over {self.polls} polls.')
+
+
+class NitterInstances:
+    """the nitter instances feeds can be retrieved from, ranked by how fast they have
+    been answering. instances that fail are left alone for a while"""
+    def __init__(self):
+        # instance -> {'latency': ..., 'failures': ..., 'down_until': ...}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def instances() -> list:
+        return _config_list('twitter_nitter_instances') or [_config('twitter_nitter_instance')]
+
+    def ranked(self) -> list:
+        with self.lock:
+            stats = [(instance, self.stats.setdefault(instance, {'latency': 0, 'failures': 0, 'down_until': 0}))
+                     for instance in self.instances()]
+            return [instance for instance, _ in sorted(stats, key=lambda x: (x[1]['down_until'] > time.monotonic(),
+                                                                               x[1]['latency']))]
+
+    def success(self, instance: str, latency: float) -> None:
+        with self.lock:
+            stats = self.stats[instance]
+            stats['latency'] = latency if not stats['latency'] else .8 * stats['latency'] + .2 * latency
+            stats['failures'] = 0
+            stats['down_until'] = 0
+
+    def failure(self, instance: str) -> None:
+        with self.lock:
+            stats = self.stats[instance]
+            stats['failures'] += 1
+            stats['down_until'] = time.monotonic() + min(60 * 2 ** stats['failures'], 60 * 60)
+            logger.info('%s failed %d times in a row', instance, stats['failures'])
+
+    def dump(self) -> str:
+        with self.lock:
+            return ', '.join(f'{instance} {stats["latency"]:.2f}s' +
+                             (' (down)' if stats['down_until'] > time.monotonic() else '')
+                             for instance, stats in self.stats.items())
+
+
+class FeedPoller:
+    """retrieves all the feeds at the same time, with a limit of requests per
+    instance. feeds are only parsed if they have changed, and feeds that don't
+    change often are retrieved less often"""
+    def __init__(self):
+        self.instances = NitterInstances()
+        self.executor = ThreadPoolExecutor(max_workers=int(_config('twitter_max_workers') or 8),
+                                           thread_name_prefix='twitter')
+        # instance -> semaphore
+        self.hosts = {}
+        # term -> {'instance': ..., 'etag': ..., 'last_modified': ..., 'interval': ...,
+        #          'next_poll': ..., 'newest': ...}
+        self.feeds = {}
+        self.lock = threading.Lock()
+        # cron_twitter runs in a worker, and only one can run at a time
+        self.running = threading.Lock()
+
+    def host(self, instance: str) -> threading.Semaphore:
+        with self.lock:
+            if instance not in self.hosts:
+                self.hosts[instance] = threading.Semaphore(int(_config('twitter_max_per_host') or 2))
+            return self.hosts[instance]
+
+    def feed(self, term: str) -> dict:
+        with self.lock:
+            return self.feeds.setdefault(term, {'instance': None, 'etag': None, 'last_modified': None,
+                                                'interval': 60, 'next_poll': 0, 'newest': None})
+
+    @staticmethod
+    def _feed_url(instance: str, term: str) -> str:
+        if term.startswith('@'):
+            return f'https://{instance}/search/rss?f=tweets&q={term[1:]}'
+        return f'https://{instance}/{term}/with_replies/rss'
+
+    def fetch(self, term: str) -> list:
+        """retrieves a feed, trying every instance until one works. returns its
+        entries, or an empty list if it hasn't changed"""
+        feed = self.feed(term)
+        for instance in self.instances.ranked():
+            headers = {}
+            # validators are only good for the instance they came from
+            if feed['instance'] == instance:
+                if feed['etag']:
+                    headers['If-None-Match'] = feed['etag']
+                if feed['last_modified']:
+                    headers['If-Modified-Since'] = feed['last_modified']
+            try:
+                with self.host(instance):
+                    start = time.monotonic()
+                    r = requests_session.get(self._feed_url(instance, term), headers=headers)
+                    latency = time.monotonic() - start
+            except Exception as exc:
+                logger.info('Error retrieving %s from %s: %s', term, instance, repr(exc))
+                self.instances.failure(instance)
+                continue
+            if r.status_code == 304:
+                self.instances.success(instance, latency)
+                return []
+            if r.status_code != 200:
+                logger.info('Error retrieving %s from %s: %d', term, instance, r.status_code)
+                self.instances.failure(instance)
+                continue
+            parsed = feedparser.parse(r.content)
+            if parsed['bozo'] == 1:
                 # failed to parse the feed
-                logger.info('Error retrieving %s: %s', term, repr(feed.get('bozo_exception', '???')))
-            elif not feed.entries:
+                logger.info('Error retrieving %s from %s: %s', term, instance,
+                            repr(parsed.get('bozo_exception', '???')))
+                self.instances.failure(instance)
+                continue
+            self.instances.success(instance, latency)
+            feed.update(instance=instance, etag=r.headers.get('ETag'),
+                        last_modified=r.headers.get('Last-Modified'))
+            if not parsed.entries:
                 logger.info('%s has no tweets', term)
-            else:
-                for entry in feed.entries:
-                    entry.id = get_id_from_guid(entry.guid)
-                    recipients = set(chat_ids)
-                    if entry.id in entries:
-                        entries[entry.id].recipients.union(recipients)
-                    else:
-                        entry.recipients = recipients
-                        entries[entry.id] = entry
+            return parsed.entries
+        return []
+
+    def reschedule(self, term: str, entries: list) -> None:
+        """polls active feeds more often and quiet ones less often"""
+        feed = self.feed(term)
+        newest = max((get_id_from_guid(entry.guid) for entry in entries), default=None)
+        if newest and newest != feed['newest']:
+            feed['newest'] = newest
+            feed['interval'] = 60
+        else:
+            feed['interval'] = min(feed['interval'] * 1.5, int(_config('twitter_max_interval') or 15 * 60))
+        feed['next_poll'] = time.monotonic() + feed['interval']
+
+    def poll(self, feeds) -> dict:
+        """retrieves every feed that is due and returns all their entries by id"""
+        def fetch(term):
+            try:
+                entries = self.fetch(term)
+            except:
+                logger.exception('Error retrieving %s', term)
+                entries = []
+            self.reschedule(term, entries)
+            return entries
+
+        futures = {}
+        for screen_name, chat_ids in feeds:  # these are already deduplicated
+            for term in [screen_name, screen_name[1:]] if screen_name.startswith('@') else [screen_name]:
+                # the interval of the job is the shortest a feed can be polled
+                if self.feed(term)['next_poll'] <= time.monotonic() + 5:
+                    futures[self.executor.submit(fetch, term)] = chat_ids
+
+        entries = {}
+        for future, chat_ids in futures.items():
+            for entry in future.result():
+                entry.id = get_id_from_guid(entry.guid)
+                if entry.id in entries:
+                    entries[entry.id].recipients |= set(chat_ids)
+                else:
+                    entry.recipients = set(chat_ids)
+                    entries[entry.id] = entry
+        return entries
+
+
+poller = FeedPoller()
+
+
+def cron_twitter(context: CallbackContext) -> None:
+    """this is the twitter cron job. it runs in a worker so slow instances don't
+    hold up the job queue"""
+    context.dispatcher.run_async(_cron_twitter, context)
+
+
+def _cron_twitter(context: CallbackContext) -> None:
+    """looks for new tweets and posts them"""
+    if not poller.running.acquire(blocking=False):
+        logger.info('The previous poll is still running')
+        return
+    try:
+        _post_tweets(context, poller.poll(_get_twitter_feeds()))
+    finally:
+        poller.running.release()
+
 
+def _post_tweets(context: CallbackContext, entries: dict) -> None:
     if sorted_entries := dict(sorted(entries.items())):
-        first_run = context.bot_data['seen_twitter_ids'] is None
-        if first_run:
-            context.bot_data['seen_twitter_ids'] = []
+        seen = context.bot_data['seen_twitter_ids']
+        # if nothing has ever been seen, this is a new install: don't post the backlog
+        first_run = len(seen) == 0
 
+        new_entries = 0
         for entry in sorted_entries.values():
-            if entry.id in context.bot_data['seen_twitter_ids']:
+            if not seen.add(entry.id):
                 continue
-            context.bot_data['seen_twitter_ids'].append(entry.id)
-            if not first_run:
+            new_entries += 1
+            if time.time() - get_tweet_time(entry.id) > seen.max_age:
+                # it could have been forgotten already, so it may not be new at all
+                logger.info('Not posting %d, it is too old', entry.id)
+            elif not first_run:
                 url = _create_link(entry.author[1:], entry.id)
                 for chat_id in entry.recipients:
                     logger.info('Posting %s -> %d', url, chat_id)
@@ -75,6 +327,8 @@ def cron_twitter(context: CallbackContext) -> None:
                         context.bot.send_message(chat_id, url)
                     except:
                         logger.exception("Couldn't post")
+        seen.polled(new_entries)
+        seen.save(force=new_entries > 0)
     else:
         logger.info('Nothing to work with.')
 
@@ -82,9 +336,10 @@ def cron_twitter(context: CallbackContext) -> None:
 def command_twitter(update: Update, context: CallbackContext) -> None:
     """shows latest saved tweets for each account we're watching"""
     if is_admin(update.message.from_user.id):
-        if context.bot_data['seen_twitter_ids'] is not None and len(context.bot_data['seen_twitter_ids']) > 0:
-            update.message.reply_text(f'Last tweet saved: {_create_link("someone", context.bot_data["seen_twitter_ids"][-1])}\n'
-                                      f'{len(context.bot_data["seen_twitter_ids"])} entries saved.')
+        seen = context.bot_data['seen_twitter_ids']
+        if len(seen) > 0:
+            update.message.reply_text(f'Last tweet saved: {_create_link("someone", seen.last())}\n'
+                                      f'{seen.dump()}\nInstances: {poller.instances.dump()}')
         else:
             update.message.reply_text('Nothing saved (yet).')
     else:
@@ -0,0 +1,101 @@
+import atexit
+import json
+import os
+import threading
+
+from telegram import Message
+from telegram.error import BadRequest
+
+from utils import _config, logger
+
+
+class FileIds:
+    """remembers the telegram file_id of media the bot sends again and again, keyed
+    by its url or by whatever identifies it, so it isn't uploaded twice. changes are
+    written to disk every now and then instead of on every send"""
+    FILENAME = 'file_ids.json'
+
+    def __init__(self):
+        # kind -> {key: file_id}, least recently used first
+        self.file_ids = {}
+        self.lock = threading.Lock()
+        self.max_entries = int(_config('file_ids_max_entries') or 10000)
+        self.dirty = False
+        try:
+            with open(self.FILENAME, 'r', encoding='utf8') as fp:
+                self.file_ids = json.load(fp)
+        except FileNotFoundError:
+            pass
+        except:
+            logger.exception("couldn't load the file_ids")
+
+    def get(self, kind: str, key: str) -> str:
+        with self.lock:
+            file_ids = self.file_ids.get(kind, {})
+            if (file_id := file_ids.pop(key, None)) is not None:
+                file_ids[key] = file_id
+            return file_id
+
+    def set(self, kind: str, key: str, file_id: str) -> None:
+        with self.lock:
+            file_ids = self.file_ids.setdefault(kind, {})
+            file_ids.pop(key, None)
+            if file_id:
+                file_ids[key] = file_id
+                while len(file_ids) > self.max_entries:
+                    del file_ids[next(iter(file_ids))]
+            self.dirty = True
+
+    def save(self, _=None) -> None:
+        """writes the file_ids to disk if they changed. it's a job and runs at exit"""
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                with open(self.FILENAME + '.tmp', 'w', encoding='utf8') as fp:
+                    json.dump(self.file_ids, fp)
+                os.replace(self.FILENAME + '.tmp', self.FILENAME)
+                self.dirty = False
+            except:
+                logger.exception("couldn't save the file_ids")
+
+    def dump(self) -> str:
+        with self.lock:
+            if any(self.file_ids.values()):
+                return 'Known file_ids: ' + ', '.join(f'{kind}#{len(file_ids)}'
+                                                      for kind, file_ids in self.file_ids.items())
+        return 'There are no known file_ids.'
+
+
+file_ids = FileIds()
+atexit.register(file_ids.save)
+
+
+def _message_file_id(message: Message, kind: str) -> str:
+    media = getattr(message, kind, None)
+    if isinstance(media, list):
+        # photos come in several sizes; the largest one is the last
+        media = media[-1] if media else None
+    return media.file_id if media else None
+
+
+def send_media(fun, *args, key: str = None, **kwargs) -> Message:
+    """sends media with fun, which is one of the reply_* methods of a message or the
+    send_* methods of the bot. the media is the last positional argument. urls are
+    remembered as they are, and files or blobs only if they are given a key that
+    identifies them, since one-off results would never be sent again. if the same
+    media has been sent before, its file_id is sent instead of uploading it again"""
+    kind = fun.__name__.split('_', 1)[1]
+    *args, media = args
+    key = key or (media if isinstance(media, str) else None)
+    if not key:
+        return fun(*args, media, **kwargs)
+    if file_id := file_ids.get(kind, key):
+        try:
+            return fun(*args, file_id, **kwargs)
+        except BadRequest:
+            logger.info('file_id for %s %s was rejected, uploading it', kind, key)
+            file_ids.set(kind, key, None)
+    message = fun(*args, media, **kwargs)
+    file_ids.set(kind, key, _message_file_id(message, kind))
+    return message
@@ -1,12 +1,20 @@
+from array import array
 from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor, wait
 import configparser
+import datetime
+from glob import glob
+from hashlib import sha1
 import logging
-from math import ceil, floor, sqrt
+from math import ceil, sqrt
+import mmap
 import os
 import pprint
 import random
 import re
 import string
+import threading
+import time
 import unicodedata
 
 import emoji
@@ -58,10 +66,81 @@ def get_relays() -> dict:
     return {}
 
 
+class MmapIndex:
+    """splits a file into records that end with a separator and keeps where every
+    record starts, so any of them can be read without reading the whole file. the
+    file is mmapped, and the index is rebuilt when the file changes"""
+    def __init__(self, filename: str, separator: bytes = b'\n', keep_separator: bool = True,
+                 allow_unterminated: bool = True):
+        self.filename = filename
+        self.separator = separator
+        self.keep_separator = keep_separator
+        # whether there can be a last record that doesn't end with a separator
+        self.allow_unterminated = allow_unterminated
+        self.lock = threading.Lock()
+        self.mtime = None
+        # (mmap, array of offsets). record i spans from offsets[i] to offsets[i + 1]
+        self.state = (b'', array('I', [0]))
+
+    def refresh(self) -> bool:
+        """rebuilds the index if the file has changed. returns True if it did"""
+        mtime = os.stat(self.filename).st_mtime_ns
+        if mtime == self.mtime:
+            return False
+        with self.lock:
+            if mtime == self.mtime:
+                return False
+            with open(self.filename, 'rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                # empty files can't be mmapped
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            offsets = array('I', [0])
+            position = mm.find(self.separator)
+            while position != -1:
+                offsets.append(position + len(self.separator))
+                position = mm.find(self.separator, offsets[-1])
+            if self.allow_unterminated and offsets[-1] < size:
+                offsets.append(size)
+            # readers that already took the old mmap keep it alive until they're done
+            self.state = (mm, offsets)
+            self.mtime = mtime
+            logger.info('indexed %d records in %s', len(offsets) - 1, self.filename)
+        return True
+
+    def __len__(self) -> int:
+        return len(self.state[1]) - 1
+
+    def _record(self, state: tuple, i: int) -> str:
+        mm, offsets = state
+        record = mm[offsets[i]:offsets[i + 1]]
+        if not self.keep_separator and record.endswith(self.separator):
+            record = record[:-len(self.separator)]
+        return record.decode('utf8')
+
+    def __getitem__(self, i: int) -> str:
+        return self._record(self.state, i)
+
+    def __iter__(self):
+        state = self.state
+        for i in range(len(state[1]) - 1):
+            yield self._record(state, i)
+
+    def random(self) -> str:
+        state = self.state
+        return self._record(state, random.randrange(len(state[1]) - 1))
+
+
+line_indexes = {}
+line_indexes_lock = threading.Lock()
 def get_random_line(filename: str) -> str:
-    """gets a random line from the provided file name"""
-    with open(filename, 'rt', encoding='utf8') as fp:
-        return random.choice(fp.readlines())
+    """gets a random line from the provided file name. the lines of every file are
+    indexed the first time and read from the index afterwards"""
+    with line_indexes_lock:
+        if filename not in line_indexes:
+            line_indexes[filename] = MmapIndex(filename)
+        index = line_indexes[filename]
+    index.refresh()
+    return index.random()
 
 
 def get_command_args(update, use_quote: bool = True) -> str:
@@ -182,6 +261,76 @@ def get_url(url: str, use_tor: bool = False) -> bytes:
     return requests_session.get(url, timeout=timeout).content
 
 
+def fetch_media(url: str, filename: str, content_types: tuple = None, max_bytes: int = None) -> str:
+    """streams a file to disk in chunks using the shared requests session. gives up
+    as soon as it's clear that it's not one of content_types or that it's larger
+    than max_bytes"""
+    max_bytes = max_bytes or int(_config('media_max_bytes') or 50 * 1024 * 1024)
+    logger.info('downloading %s into %s', url, filename)
+    r = requests_session.get(url, stream=True, timeout=int(_config('http_timeout') or 5))
+    try:
+        if r.status_code != 200:
+            raise RuntimeError(f"couldn't download {url}: {r.status_code}")
+        content_type = r.headers.get('Content-Type', '').split(';')[0].strip()
+        if content_types and not content_type.startswith(content_types):
+            raise ValueError(f'unexpected content type: {content_type}')
+        if int(r.headers.get('Content-Length') or 0) > max_bytes:
+            raise ValueError(f'file is too large ({r.headers["Content-Length"]} bytes; maximum is {max_bytes})')
+        size = 0
+        with open(filename, 'wb') as fp:
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f'file is too large (maximum is {max_bytes} bytes)')
+                fp.write(chunk)
+    except:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    finally:
+        r.close()
+    logger.info('done downloading %s (%d bytes)', url, size)
+    return filename
+
+
+class MediaCache:
+    """keeps converted media around, keyed by a hash of where they came from, so the
+    same file isn't converted twice"""
+    DIRECTORY = 'media_cache'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def path(self, key: str, extension: str) -> str:
+        return os.path.join(self.DIRECTORY, f'{sha1(key.encode("utf8")).hexdigest()}.{extension}')
+
+    def get(self, key: str, extension: str) -> str:
+        """returns the path of the cached file, or None"""
+        path = self.path(key, extension)
+        try:
+            # keep track of when it was last used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        logger.info('%s is cached in %s', key, path)
+        return path
+
+    def put(self, key: str, extension: str, filename: str) -> str:
+        """moves a file into the cache and returns its new path"""
+        path = self.path(key, extension)
+        with self.lock:
+            os.makedirs(self.DIRECTORY, exist_ok=True)
+            os.replace(filename, path)
+            files = sorted(glob(os.path.join(self.DIRECTORY, '*')), key=os.path.getmtime)
+            for old_file in files[:max(0, len(files) - int(_config('media_cache_max_files') or 100))]:
+                logger.info('evicting %s from the media cache', old_file)
+                os.remove(old_file)
+        return path
+
+
+media_cache = MediaCache()
+
+
 class Downloader:
     """this is a context manager that downloads files through
         http using the shared requests session"""
@@ -191,10 +340,8 @@ class Downloader:
         self.fp = None
 
     def __enter__(self):
-        self.fp = open(self.filename, 'w+b')
-        logger.info('downloading %s into %s', self.url, self.filename)
-        self.fp.write(get_url(self.url))
-        self.fp.seek(0)
+        fetch_media(self.url, self.filename)
+        self.fp = open(self.filename, 'rb')
         return self.fp
 
     def __exit__(self, *_):
@@ -213,18 +360,86 @@ def image_to_b64(i):
     return 'data:image/jpeg;base64,' + b64encode(i).decode('utf-8')
 
 
-def create_gallery(images):
-    """creates a gallery from a list of images"""
-    size = images[0].width
-    side = ceil(sqrt(len(images)))
-    with Image(width=size * side, height=size * side) as canvas:
-        for i, image in enumerate(images):
-            left = (i % side + 1) * size - size
-            top = floor(i / side) * size
-            canvas.composite(image, left=left, top=top)
+gallery_executor = ThreadPoolExecutor(max_workers=int(_config('gallery_max_workers') or 4),
+                                      thread_name_prefix='gallery')
+def create_gallery(sources) -> bytes:
+    """creates a gallery from a list of images given as blobs or urls. the images are
+    downloaded and decoded at the same time and made to fit squares of the same size"""
+    def load(source):
+        return Image(blob=get_url(source) if isinstance(source, str) else source)
+
+    def fit(image, size):
+        if max(image.width, image.height) != size:
+            image.transform(resize=f'{size}x{size}')
+
+    futures = [gallery_executor.submit(load, source) for source in sources]
+    wait(futures)
+    images = [future.result() for future in futures if not future.exception()]
+    try:
+        if len(images) != len(futures):
+            raise next(future.exception() for future in futures if future.exception())
+        size = max(max(image.width, image.height) for image in images)
+        futures = [gallery_executor.submit(fit, image, size) for image in images]
+        wait(futures)
+        tiles = []
+        for image, future in zip(images, futures):
+            if exc := future.exception():
+                logger.error("couldn't fit a gallery tile", exc_info=exc)
+            else:
+                tiles.append(image)
+        if len(tiles) != len(images):
+            logger.warning('skipped %d of %d gallery tiles', len(images) - len(tiles), len(images))
+        if not tiles:
+            raise ValueError("Couldn't create the gallery.")
+        side = ceil(sqrt(len(tiles)))
+        with Image(width=size * side, height=size * side) as canvas:
+            for i, image in enumerate(tiles):
+                # centered in its square
+                left = i % side * size + (size - image.width) // 2
+                top = i // side * size + (size - image.height) // 2
+                canvas.composite(image, left=left, top=top)
+            return canvas.make_blob(format='jpeg')
+    finally:
+        for image in images:
             image.close()
-            image.destroy()
-        return canvas.make_blob(format='jpeg')
+
+
+def get_next_hour() -> int:
+    """returns the hour of the next o'clock"""
+    now = datetime.datetime.now().astimezone()
+    return (now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)).hour
+
+
+class Prefetched:
+    """holds something that was prepared ahead of time (like the next scheduled
+    post) until it's taken or it gets too old to be used"""
+    def __init__(self, discard=None):
+        self.value = None
+        self.prepared_at = 0
+        # this is called with values that are replaced or too old
+        self.discard = discard
+        self.lock = threading.Lock()
+
+    def put(self, value):
+        with self.lock:
+            old, self.value = self.value, value
+            self.prepared_at = time.monotonic()
+        if old is not None and self.discard:
+            self.discard(old)
+
+    def take(self):
+        """returns the value and forgets about it, or None if it's missing or stale"""
+        with self.lock:
+            value, self.value = self.value, None
+            age = time.monotonic() - self.prepared_at
+        if value is None:
+            return None
+        if age > int(_config('prefetch_max_age') or 15) * 60:
+            logger.info('prefetched value is %d seconds old, discarding it', age)
+            if self.discard:
+                self.discard(value)
+            return None
+        return value
 
 
 # this is a prettyprinter implementation that escapes non-ascii characters